@@ -6,21 +6,90 @@
 
 import socket
 import threading
-import json
 import time
 import platform
 import subprocess
-import base64
 import io
 import os
 import sys
+import hashlib
+import json
+import zlib
+import codecs
+import signal
+import collections
 from datetime import datetime
 
-try:
-    from PIL import ImageGrab
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
+from protocol import (FILE_CHUNK_SIZE, FILE_WINDOW, LEGACY_PROTOCOL, PROTOCOL_VERSION, encode_message,
+                      negotiate, payload_bytes, recv_message)
+from video_codec import (CODEC_TILES, KEYFRAME_INTERVAL, MAX_THUMBNAIL_FPS, NUMPY_AVAILABLE, QUALITY_PRESETS,
+                         TARGET_LATENCY_MS, THUMBNAIL_SETTINGS, BitrateController, FrameChangeDetector, FramePipeline, TileEncoder,
+                         encode_video_frame)
+from frame_source import PIL_AVAILABLE, create_frame_source
+
+# 分块下载等待控制端确认的超时（秒）
+DOWNLOAD_ACK_TIMEOUT = 60
+
+# 控制端可指定的最大块大小
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 由输入线程按顺序执行的鼠标键盘操作
+INPUT_ACTIONS = ('mouse_move', 'mouse_click', 'mouse_scroll', 'keyboard_press', 'keyboard_type')
+
+# keyboard_type逐字输入的默认间隔（秒），消息中的interval字段可覆盖，0表示不等待
+TYPE_INTERVAL = 0.01
+
+# keyboard_type每输入这么多个字符检查一次是否已取消
+TYPE_BATCH = 16
+
+# 命令输出合并成command_output发送：攒够这么多字符或距上次发送超过这么多秒就发送一次
+COMMAND_OUTPUT_CHUNK = 16 * 1024
+COMMAND_OUTPUT_INTERVAL = 0.2
+
+# 不流式返回时（旧版控制端）command_result最多保留的输出字符数
+COMMAND_OUTPUT_LIMIT = 4 * 1024 * 1024
+
+# 不流式返回的命令（旧版控制端、批量任务）默认的执行时间上限（秒），这些命令无法从控制端取消
+COMMAND_TIMEOUT = 60
+
+# 命令输出的编码
+COMMAND_ENCODING = 'gbk' if platform.system() == 'Windows' else 'utf-8'
+
+# 命令处理工作池: 类别 -> (最多线程数, 最多排队任务数)
+WORKER_POOLS = {
+    'capture': (1, 4),     # 截图
+    'process': (4, 16),    # run_command
+    'io': (2, 32),         # 磁盘、目录、打开、删除等文件操作
+    'transfer': (4, 8),    # 分块下载，等待确认期间长时间占用线程
+}
+
+# 交给工作池执行的命令 -> 类别，其余命令在接收线程中直接处理
+ACTION_POOLS = {
+    'screenshot': 'capture',
+    'run_command': 'process',
+    'get_drives': 'io',
+    'list_files': 'io',
+    'open_file': 'io',
+    'upload_file': 'io',
+    'delete_file': 'io',
+    'create_folder': 'io',
+    'download_file': 'io',       # 分块下载改用transfer，见receive_commands
+}
+
+# 工作池满时用命令原本的回复类型返回错误，控制端按已有方式显示
+BUSY_REPLY_TYPES = {
+    'screenshot': 'error',
+    'run_command': 'command_result',
+    'get_drives': 'drives_list',
+    'list_files': 'file_list',
+    'open_file': 'file_open',
+    'download_file': 'file_download',
+    'upload_file': 'file_upload',
+    'delete_file': 'file_delete',
+    'create_folder': 'folder_create',
+}
+
+if not PIL_AVAILABLE:
     print("警告: PIL/Pillow未安装，截图功能将不可用")
 
 try:
@@ -40,17 +109,120 @@ except ImportError:
     PYNPUT_AVAILABLE = False
     print("警告: pynput未安装，部分控制功能将不可用")
 
+class WorkerPool:
+    """线程数和排队数都有上限的工作池
+
+    线程按需启动，最多workers个；所有线程都忙时任务排队，
+    执行中和排队的任务已有workers + max_queue个时submit返回False，由调用方回复繁忙，
+    不再无限制地创建线程。
+    """
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.tasks = collections.deque()  # (函数, 参数)
+        self.cond = threading.Condition()
+        self.threads = 0
+        self.idle = 0
+        self.active = 0  # 正在执行的任务数
+
+        # 统计计数
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, func, *args):
+        """提交任务，队列已满时返回False"""
+        with self.cond:
+            if len(self.tasks) + self.active >= self.workers + self.max_queue:
+                self.rejected += 1
+                return False
+            self.tasks.append((func, args))
+            self.submitted += 1
+            # 没有执行任务的线程（空闲、刚启动或刚做完）每个只能接走一个任务，
+            # 排队的任务比它们多时再启动线程，连续提交的任务不会都排在第一个后面
+            if len(self.tasks) > self.threads - self.active and self.threads < self.workers:
+                self.threads += 1
+                threading.Thread(target=self.worker, name=f'pool-{self.name}', daemon=True).start()
+            else:
+                self.cond.notify()
+            return True
+
+    def worker(self):
+        """工作线程：依次执行队列中的任务"""
+        while True:
+            with self.cond:
+                while not self.tasks:
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                func, args = self.tasks.popleft()
+                self.active += 1
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 工作池 {self.name} 任务错误: {e}")
+            finally:
+                with self.cond:
+                    self.active -= 1
+
+    def get_stats(self):
+        """返回工作池统计"""
+        with self.cond:
+            return {
+                'threads': self.threads,
+                'busy': self.active,
+                'queued': len(self.tasks),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+            }
+
+
 class RemoteAgent:
-    def __init__(self, server_ip, server_port=5000, agent_id=None, custom_name=None):
+    def __init__(self, server_ip, server_port=5000, agent_id=None, custom_name=None,
+                 keyframe_interval=KEYFRAME_INTERVAL, frame_source='screen', type_interval=TYPE_INTERVAL):
         self.server_ip = server_ip
         self.server_port = server_port
         self.agent_id = agent_id or self.get_default_id()
         self.custom_name = custom_name  # 自定义主机名
+        self.keyframe_interval = keyframe_interval  # 画面不变时重发整帧的间隔（秒）
+        self.frame_source_spec = frame_source  # 画面来源描述，见frame_source.py
+        self.frame_source = None
+        self.type_interval = type_interval  # keyboard_type逐字输入的默认间隔（秒）
 
         self.sock = None
+        self.send_lock = threading.Lock()  # 多个线程共用一个socket，整帧发送需互斥
+        self.peer_protocol = LEGACY_PROTOCOL  # 与服务器协商的协议版本
         self.running = True
-        self.video_streaming = False
-        self.video_quality = 'medium'  # 视频质量: low, medium, high, ultra
+        # 当前视频流: {'viewers': set(start_video的请求ID), 'active': bool}，多个观看者共享一路视频流
+        self.video_session = None
+        self.video_lock = threading.Lock()
+        self.thumbnail_session = None  # 屏幕墙缩略图流: {'active': bool, 'detector': FrameChangeDetector}
+        self.video_quality = 'medium'  # 视频质量: low, medium, high, ultra, auto
+        self.video_detector = None  # 当前视频流的画面变化检测器，请求整帧时通过它强制发送
+        self.video_bitrate = None  # 自动质量时的码率控制器
+
+        # 命令处理工作池: {类别: WorkerPool}，接收线程只负责分发，不被耗时的命令阻塞
+        self.pools = {name: WorkerPool(name, workers, max_queue)
+                      for name, (workers, max_queue) in WORKER_POOLS.items()}
+
+        # 进行中的分块下载: {request_id: {'acked': 已确认偏移量, 'cancelled': bool}}
+        self.downloads = {}
+        self.download_cond = threading.Condition()
+
+        # 进行中的分块上传: {目标路径: {'file': 临时文件, 'offset': 已写入字节, ...}}，只在接收线程中访问
+        self.uploads = {}
+
+        # 待执行的鼠标键盘事件: [(action, data)]，由输入线程按顺序执行，连续的鼠标移动只保留最新一个
+        self.input_events = []
+        self.input_cond = threading.Condition()
+        self.input_thread = None
+        self.input_coalesced = 0  # 被合并掉的鼠标移动数
+        self.input_generation = 0  # 每次取消输入加1，正在执行的输入发现变化后停止
+
+        # 正在执行的命令: {request_id: {'process': Popen, 'cancelled': bool, ...}}，cancel_command据此结束进程
+        self.commands = {}
+        self.commands_lock = threading.Lock()
 
         # 鼠标键盘控制器
         if PYNPUT_AVAILABLE:
@@ -99,12 +271,14 @@ class RemoteAgent:
                 
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.connect((self.server_ip, self.server_port))
+                self.peer_protocol = LEGACY_PROTOCOL
                 
-                # 发送注册信息
+                # 发送注册信息（声明支持的协议版本，服务器回复welcome后切换）
                 self.send_json({
                     'type': 'agent',
                     'agent_id': self.agent_id,
-                    'info': self.system_info
+                    'info': self.system_info,
+                    'protocol': PROTOCOL_VERSION
                 })
                 
                 print(f"[{self.get_time()}] 连接成功! Agent ID: {self.agent_id}")
@@ -141,99 +315,138 @@ class RemoteAgent:
                 if not data:
                     break
 
+                # 服务器确认协议版本
+                if data.get('type') == 'welcome':
+                    self.peer_protocol = negotiate(data.get('protocol'))
+                    print(f"[{self.get_time()}] 协议版本: v{self.peer_protocol}")
+                    continue
+
                 action = data.get('action')
+                # 请求ID：回复时原样带回，服务器据此只发给发起请求的控制端
+                request_id = data.get('request_id')
 
-                if action == 'screenshot':
-                    threading.Thread(target=self.handle_screenshot, daemon=True).start()
+                if action in ACTION_POOLS:
+                    self.dispatch_command(action, data, request_id)
 
                 elif action == 'start_video':
-                    quality = data.get('quality', 'medium')
-                    self.video_quality = quality
-                    self.video_streaming = True
-                    threading.Thread(target=self.handle_video_stream, daemon=True).start()
+                    self.start_video_session(data, request_id)
+
+                elif action == 'video_feedback':
+                    bitrate = self.video_bitrate
+                    if bitrate and data.get('sent_at') is not None:
+                        bitrate.on_feedback(data['sent_at'], data.get('decode_ms', 0))
+
+                elif action == 'request_keyframe':
+                    detector = self.video_detector
+                    if detector:
+                        detector.request_keyframe()
 
                 elif action == 'stop_video':
-                    self.video_streaming = False
-
-                elif action == 'run_command':
-                    command = data.get('command', '')
-                    as_admin = data.get('as_admin', False)
-                    threading.Thread(target=self.handle_command, args=(command, as_admin), daemon=True).start()
-
-                # 鼠标键盘控制
-                elif action == 'mouse_move':
-                    x = data.get('x', 0)
-                    y = data.get('y', 0)
-                    self.handle_mouse_move(x, y)
-
-                elif action == 'mouse_click':
-                    button = data.get('button', 'left')
-                    clicks = data.get('clicks', 1)
-                    x = data.get('x', None)
-                    y = data.get('y', None)
-                    self.handle_mouse_click(button, clicks, x, y)
-
-                elif action == 'mouse_scroll':
-                    dx = data.get('dx', 0)
-                    dy = data.get('dy', 0)
-                    self.handle_mouse_scroll(dx, dy)
-
-                elif action == 'keyboard_press':
-                    key = data.get('key', '')
-                    self.handle_keyboard_press(key)
-
-                elif action == 'keyboard_type':
-                    text = data.get('text', '')
-                    self.handle_keyboard_type(text)
-
-                # 文件操作
-                elif action == 'get_drives':
-                    # 获取所有磁盘驱动器
-                    self.handle_get_drives()
-
-                elif action == 'list_files':
-                    path = data.get('path', 'C:\\')
-                    self.handle_list_files(path)
-
-                elif action == 'open_file':
-                    filepath = data.get('filepath', '')
-                    self.handle_open_file(filepath)
+                    self.stop_video_session(request_id)
 
-                elif action == 'download_file':
-                    filepath = data.get('filepath', '')
-                    self.handle_download_file(filepath)
+                elif action == 'start_thumbnails':
+                    self.start_thumbnails(data, request_id)
+
+                elif action == 'stop_thumbnails':
+                    self.stop_thumbnails()
+
+                # 鼠标键盘控制，交给输入线程执行，接收线程不被输入操作阻塞
+                elif action in INPUT_ACTIONS:
+                    self.queue_input(action, data)
+
+                elif action == 'cancel_input':
+                    self.cancel_input()
+
+                elif action == 'cancel_command':
+                    self.cancel_command(request_id)
 
-                elif action == 'upload_file':
+                # 分块传输的确认和数据，按到达顺序在接收线程中处理
+                elif action == 'download_ack':
+                    self.handle_download_ack(request_id, data.get('offset', 0))
+
+                elif action == 'cancel_download':
+                    self.handle_download_ack(request_id, cancel=True)
+
+                elif action == 'upload_start':
                     filepath = data.get('filepath', '')
-                    content = data.get('content', '')
-                    self.handle_upload_file(filepath, content)
+                    self.handle_upload_start(filepath, data.get('size', 0), data.get('sha256', ''), request_id)
 
-                elif action == 'delete_file':
+                elif action == 'upload_chunk':
                     filepath = data.get('filepath', '')
-                    self.handle_delete_file(filepath)
+                    self.handle_upload_chunk(filepath, data.get('offset', 0), data.get('crc32'),
+                                             data.get('data'), request_id)
 
-                elif action == 'create_folder':
-                    folderpath = data.get('folderpath', '')
-                    self.handle_create_folder(folderpath)
+                elif action == 'upload_finish':
+                    filepath = data.get('filepath', '')
+                    self.handle_upload_finish(filepath, request_id)
 
             except Exception as e:
                 print(f"[{self.get_time()}] 接收命令错误: {e}")
                 break
+
+        # 连接已断开，视频流和缩略图流停止；缩略图还有控制端在观看时服务器会在重连后重新启动
+        self.stop_video_session()
+        self.stop_thumbnails()
+        # 连接已断开，进行中的下载收不到确认了，全部取消
+        self.cancel_downloads()
+        # 上传的临时文件保留，控制端重连后从已写入的位置继续
+        self.close_uploads()
     
-    def handle_screenshot(self):
+    def dispatch_command(self, action, data, request_id=None):
+        """把耗时的命令交给对应类别的工作池，工作池已满时直接回复繁忙"""
+        category = ACTION_POOLS[action]
+        if action == 'screenshot':
+            task = (self.handle_screenshot, request_id)
+        elif action == 'run_command':
+            task = (self.handle_command, data.get('command', ''), data.get('as_admin', False), request_id,
+                    data.get('stream', False), data.get('timeout'))
+        elif action == 'get_drives':
+            task = (self.handle_get_drives, request_id)
+        elif action == 'list_files':
+            task = (self.handle_list_files, data.get('path', 'C:\\'), request_id)
+        elif action == 'open_file':
+            task = (self.handle_open_file, data.get('filepath', ''), request_id)
+        elif action == 'download_file' and data.get('chunked'):
+            # 新版控制端：分块流式下载
+            task = (self.handle_download_stream, data.get('filepath', ''), request_id,
+                    data.get('chunk_size'), data.get('window'))
+            category = 'transfer'
+        elif action == 'download_file':
+            task = (self.handle_download_file, data.get('filepath', ''), request_id)
+        elif action == 'upload_file':
+            task = (self.handle_upload_file, data.get('filepath', ''), data.get('content', ''), request_id)
+        elif action == 'delete_file':
+            task = (self.handle_delete_file, data.get('filepath', ''), request_id)
+        else:  # create_folder
+            task = (self.handle_create_folder, data.get('folderpath', ''), request_id)
+
+        pool = self.pools[category]
+        if pool.submit(*task):
+            return
+        message = f"被控端繁忙: {category}类任务已有 {pool.max_queue} 个在排队，请稍后重试"
+        print(f"[{self.get_time()}] 拒绝 {action}: {message}")
+        reply = {'type': BUSY_REPLY_TYPES[action], 'error': message, 'message': message, 'busy': True}
+        for key in ('path', 'filepath', 'folderpath', 'command'):
+            if key in data:
+                reply[key] = data[key]
+        if action == 'run_command':
+            reply['output'] = message
+        self.send_json(reply, request_id)
+
+    def handle_screenshot(self, request_id=None):
         """处理截图请求"""
         if not PIL_AVAILABLE:
             self.send_json({
                 'type': 'error',
                 'message': 'PIL/Pillow未安装，无法截图'
-            })
+            }, request_id)
             return
         
         try:
             print(f"[{self.get_time()}] 正在截图...")
             
             # 截取屏幕
-            screenshot = ImageGrab.grab()
+            screenshot = self.get_frame_source().grab()
             
             # 调整大小以减少传输数据量
             screenshot.thumbnail((1280, 720))
@@ -243,14 +456,11 @@ class RemoteAgent:
             screenshot.save(buffer, format='JPEG', quality=85)
             img_data = buffer.getvalue()
             
-            # Base64编码
-            img_b64 = base64.b64encode(img_data).decode('utf-8')
-            
-            # 发送截图
+            # 发送截图（二进制字段由协议层按服务器版本编码）
             self.send_json({
                 'type': 'screenshot',
-                'image': img_b64
-            })
+                'image': img_data
+            }, request_id)
             
             print(f"[{self.get_time()}] 截图已发送 ({len(img_data)} bytes)")
             
@@ -259,165 +469,483 @@ class RemoteAgent:
             self.send_json({
                 'type': 'error',
                 'message': f'截图失败: {str(e)}'
-            })
+            }, request_id)
     
-    def handle_video_stream(self):
-        """处理视频流 - 支持多种质量"""
+    def start_video_session(self, data, request_id=None):
+        """处理start_video：没有视频流时启动，已有视频流时加入为观看者并发送一次整帧"""
+        with self.video_lock:
+            session = self.video_session
+            if session is not None:
+                session['viewers'].add(request_id)
+                viewers = len(session['viewers'])
+            else:
+                session = {'viewers': {request_id}, 'active': True}
+                self.video_session = session
+                viewers = 0
+
+        if viewers:
+            print(f"[{self.get_time()}] 新的观看者加入视频流 (观看者: {viewers})")
+            detector = self.video_detector
+            if detector:
+                detector.request_keyframe()
+            return
+
+        self.video_quality = data.get('quality', 'medium')
+        codecs = data.get('codecs', [])
+        keyframe_interval = data.get('keyframe_interval', self.keyframe_interval)
+        target_latency = data.get('target_latency', TARGET_LATENCY_MS)
+        threading.Thread(target=self.run_video_session,
+                         args=(session, request_id, codecs, keyframe_interval, target_latency),
+                         daemon=True).start()
+
+    def stop_video_session(self, request_id=None):
+        """处理stop_video：移除对应的观看者，最后一个观看者离开时停止视频流
+
+        request_id不属于任何观看者时（旧版控制端、服务器重启等）直接停止整个视频流
+        """
+        with self.video_lock:
+            session = self.video_session
+            if session is None:
+                return
+            if request_id in session['viewers']:
+                session['viewers'].discard(request_id)
+            else:
+                session['viewers'].clear()
+            if not session['viewers']:
+                session['active'] = False
+                self.video_session = None
+
+    def run_video_session(self, session, *args):
+        """运行一路视频流，结束（停止或出错）后清除会话，之后的start_video会重新启动"""
+        try:
+            self.handle_video_stream(*args, session=session)
+        finally:
+            with self.video_lock:
+                session['active'] = False
+                if self.video_session is session:
+                    self.video_session = None
+
+    def handle_video_stream(self, request_id=None, codecs=(), keyframe_interval=KEYFRAME_INTERVAL,
+                            target_latency=TARGET_LATENCY_MS, session=None):
+        """处理视频流 - 支持多种质量
+
+        画面不变时跳过缩放和编码，只每隔keyframe_interval秒重发一次整帧；
+        控制端声明支持图块增量编码时只发送变化的图块；
+        质量为auto时按控制端反馈的延迟自动调整，目标往返延迟为target_latency毫秒；
+        采集、编码、发送在FramePipeline中并行
+        """
+        if session is None:
+            session = {'viewers': {request_id}, 'active': True}
         if not PIL_AVAILABLE:
             self.send_json({
                 'type': 'error',
                 'message': 'PIL/Pillow未安装，无法视频流'
-            })
+            }, request_id)
             return
 
-        # 根据质量设置参数
-        quality_settings = {
-            'low': {'size': (640, 480), 'quality': 50, 'fps': 5},
-            'medium': {'size': (800, 600), 'quality': 70, 'fps': 10},
-            'high': {'size': (1280, 720), 'quality': 85, 'fps': 15},
-            'ultra': {'size': (1920, 1080), 'quality': 90, 'fps': 20}  # 90%无损画质
-        }
+        try:
+            source = self.get_frame_source()
+        except Exception as e:
+            print(f"[{self.get_time()}] 画面来源错误: {e}")
+            self.send_json({
+                'type': 'error',
+                'message': f'无法取得画面: {str(e)}'
+            }, request_id)
+            return
 
-        settings = quality_settings.get(self.video_quality, quality_settings['medium'])
+        # 根据质量设置参数
+        bitrate = BitrateController(target_latency) if self.video_quality == 'auto' else None
+        self.video_bitrate = bitrate
+        settings = QUALITY_PRESETS.get(self.video_quality, QUALITY_PRESETS['medium'])
         print(f"[{self.get_time()}] 开始视频流 (质量: {self.video_quality})...")
 
-        frame_count = 0
-        while self.running and self.video_streaming:
-            try:
-                # 截取屏幕
-                screenshot = ImageGrab.grab()
-
-                # 调整大小
-                screenshot.thumbnail(settings['size'])
-
-                # 转换为JPEG
-                buffer = io.BytesIO()
-                screenshot.save(buffer, format='JPEG', quality=settings['quality'])
-                img_data = buffer.getvalue()
-                
-                # Base64编码
-                img_b64 = base64.b64encode(img_data).decode('utf-8')
-                
-                # 发送帧
-                self.send_json({
-                    'type': 'video_frame',
-                    'image': img_b64,
-                    'frame': frame_count
-                })
-                
-                frame_count += 1
+        encoder = TileEncoder() if NUMPY_AVAILABLE and CODEC_TILES in codecs else None
+        detector = FrameChangeDetector(keyframe_interval)
+        self.video_detector = detector
+
+        current = {'settings': settings, 'frame': 0}
+
+        def encode(screenshot):
+            if bitrate:
+                level = bitrate.level
+                current['settings'] = bitrate.update()
+                if bitrate.level != level:
+                    s = current['settings']
+                    print(f"[{self.get_time()}] 自动质量: 档位 {level} -> {bitrate.level} "
+                          f"({s['size'][0]}x{s['size'][1]}, 质量{s['quality']}, {s['fps']}fps)")
+            message = encode_video_frame(screenshot, current['settings'], detector, encoder)
+            if message is not None:
+                # 帧号在编码阶段分配：编码之后不再丢帧，控制端看到的帧号保持连续
+                message['type'] = 'video_frame'
+                message['frame'] = current['frame']
+                current['frame'] += 1
+            return message
+
+        def send(message):
+            message['sent_at'] = time.time()  # 控制端在video_feedback中回显，用于计算往返延迟
+            self.send_json(message)
+            if bitrate:
+                bitrate.on_frame_sent()
+
+        # 采集、编码、发送三个阶段并行，采集按截止时间保持目标帧率
+        pipeline = FramePipeline(
+            capture=source.grab,
+            encode=encode,
+            send=send,
+            fps=lambda: current['settings']['fps'],
+            running=lambda: self.running and session['active']
+        )
+        pipeline.run()
+        if pipeline.error:
+            print(f"[{self.get_time()}] 视频流错误: {pipeline.error}")
+            # 按启动时的请求ID回报，服务器据此清除该视频流的记录
+            self.send_json({
+                'type': 'error',
+                'message': f'视频流中断: {pipeline.error}'
+            }, request_id)
+
+        if self.video_detector is detector:
+            self.video_detector = None
+        if self.video_bitrate is bitrate:
+            self.video_bitrate = None
+        print(f"[{self.get_time()}] 视频流已停止 (截取 {pipeline.captured_count} 帧, 发送 {pipeline.sent} 帧, "
+              f"画面未变跳过 {detector.skipped} 帧, 编码不及丢弃 {pipeline.dropped} 帧)")
+
+    def start_thumbnails(self, data, request_id=None):
+        """处理start_thumbnails：以很低的帧率发送小尺寸缩略图（屏幕墙），画面不变时不发送"""
+        with self.video_lock:
+            session = self.thumbnail_session
+            if session is not None:
+                # 已在运行：下一帧发送一次，保证新的观看者拿到当前画面
+                session['detector'].request_keyframe()
+                return
+            session = {'active': True, 'detector': FrameChangeDetector(self.keyframe_interval)}
+            self.thumbnail_session = session
 
-                # 控制帧率
-                time.sleep(1.0 / settings['fps'])
-                
-            except Exception as e:
-                print(f"[{self.get_time()}] 视频流错误: {e}")
-                break
-        
-        print(f"[{self.get_time()}] 视频流已停止")
-    
-    def handle_command(self, command, as_admin=False):
-        """处理命令执行 - 支持管理员权限"""
-        print(f"[{self.get_time()}] 执行命令: {command} (管理员: {as_admin})")
-        
+        settings = dict(THUMBNAIL_SETTINGS)
         try:
-            # 如果需要管理员权限
-            if as_admin and platform.system() == 'Windows':
-                # 使用PowerShell以管理员权限运行
-                ps_command = f'Start-Process -Verb RunAs -FilePath cmd.exe -ArgumentList "/c {command}" -Wait -WindowStyle Hidden'
-                result = subprocess.run(['powershell', '-Command', ps_command],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=60,
-                                      encoding='gbk',
-                                      errors='ignore')
-            # 检查是否是脚本文件
-            elif command.endswith('.bat') or command.endswith('.ps1') or command.endswith('.py'):
-                if os.path.exists(command):
-                    # 执行脚本文件
-                    if command.endswith('.bat'):
-                        cmd_list = ['cmd', '/c', command]
-                        if as_admin:
-                            cmd_list = ['powershell', '-Command', f'Start-Process -Verb RunAs -FilePath cmd.exe -ArgumentList "/c {command}" -Wait']
-                        result = subprocess.run(cmd_list,
-                                              capture_output=True,
-                                              text=True,
-                                              timeout=60,
-                                              encoding='gbk',
-                                              errors='ignore')
-                    elif command.endswith('.ps1'):
-                        cmd_list = ['powershell', '-File', command]
-                        if as_admin:
-                            cmd_list = ['powershell', '-Command', f'Start-Process -Verb RunAs -FilePath powershell.exe -ArgumentList "-File {command}" -Wait']
-                        result = subprocess.run(cmd_list,
-                                              capture_output=True,
-                                              text=True,
-                                              timeout=60,
-                                              encoding='gbk',
-                                              errors='ignore')
-                    elif command.endswith('.py'):
-                        cmd_list = ['python', command]
-                        if as_admin:
-                            cmd_list = ['powershell', '-Command', f'Start-Process -Verb RunAs -FilePath python.exe -ArgumentList "{command}" -Wait']
-                        result = subprocess.run(cmd_list,
-                                              capture_output=True,
-                                              text=True,
-                                              timeout=60,
-                                              encoding='gbk',
-                                              errors='ignore')
-                else:
-                    output = f"错误: 文件不存在 - {command}"
-                    self.send_json({
-                        'type': 'command_result',
-                        'command': command,
-                        'output': output
-                    })
-                    return
-            else:
-                # 执行普通命令
-                result = subprocess.run(command,
-                                      shell=True,
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=60,
-                                      encoding='gbk',
-                                      errors='ignore')
-            
-            output = result.stdout + result.stderr
-            if not output:
-                output = "命令执行完成 (无输出)"
-            
+            if data.get('size'):
+                settings['size'] = tuple(int(v) for v in data['size'][:2])
+            settings['quality'] = int(data.get('quality', settings['quality']))
+            settings['fps'] = min(max(float(data.get('fps', settings['fps'])), 0.1), MAX_THUMBNAIL_FPS)
+        except (TypeError, ValueError):
+            settings = dict(THUMBNAIL_SETTINGS)
+        threading.Thread(target=self.run_thumbnails, args=(session, settings, request_id), daemon=True).start()
+
+    def stop_thumbnails(self):
+        """处理stop_thumbnails"""
+        with self.video_lock:
+            session = self.thumbnail_session
+            if session is not None:
+                session['active'] = False
+                self.thumbnail_session = None
+
+    def run_thumbnails(self, session, settings, request_id=None):
+        """发送屏幕墙缩略图，复用视频的流水线和变化检测"""
+        print(f"[{self.get_time()}] 开始发送缩略图 ({settings['size'][0]}x{settings['size'][1]}, {settings['fps']}fps)")
+        try:
+            source = self.get_frame_source()
+
+            def encode(screenshot):
+                return encode_video_frame(screenshot, settings, session['detector'])
+
+            def send(message):
+                message['type'] = 'thumbnail'
+                message['sent_at'] = time.time()
+                self.send_json(message)
+
+            pipeline = FramePipeline(
+                capture=source.grab,
+                encode=encode,
+                send=send,
+                fps=lambda: settings['fps'],
+                running=lambda: self.running and session['active']
+            )
+            pipeline.run()
+            if pipeline.error:
+                print(f"[{self.get_time()}] 缩略图错误: {pipeline.error}")
+            print(f"[{self.get_time()}] 缩略图已停止 (发送 {pipeline.sent} 张)")
+        except Exception as e:
+            print(f"[{self.get_time()}] 缩略图错误: {e}")
             self.send_json({
-                'type': 'command_result',
-                'command': command,
-                'output': output,
-                'returncode': result.returncode
-            })
-            
-            print(f"[{self.get_time()}] 命令执行完成")
-            
-        except subprocess.TimeoutExpired:
-            output = "错误: 命令执行超时 (30秒)"
+                'type': 'error',
+                'message': f'无法发送缩略图: {str(e)}'
+            }, request_id)
+        finally:
+            with self.video_lock:
+                session['active'] = False
+                if self.thumbnail_session is session:
+                    self.thumbnail_session = None
+
+    def get_frame_source(self):
+        """取得截图和视频使用的画面来源（首次使用时创建）"""
+        if self.frame_source is None:
+            self.frame_source = create_frame_source(self.frame_source_spec)
+        return self.frame_source
+
+    def build_command(self, command, as_admin=False):
+        """把命令转换为Popen参数，返回 (参数, 是否经过shell)；脚本文件不存在时返回None"""
+        # 如果需要管理员权限
+        if as_admin and platform.system() == 'Windows':
+            # 使用PowerShell以管理员权限运行
+            ps_command = f'Start-Process -Verb RunAs -FilePath cmd.exe -ArgumentList "/c {command}" -Wait -WindowStyle Hidden'
+            return ['powershell', '-Command', ps_command], False
+
+        # 检查是否是脚本文件
+        if command.endswith('.bat') or command.endswith('.ps1') or command.endswith('.py'):
+            if not os.path.exists(command):
+                return None
+            if command.endswith('.bat'):
+                cmd_list = ['cmd', '/c', command]
+                if as_admin:
+                    cmd_list = ['powershell', '-Command', f'Start-Process -Verb RunAs -FilePath cmd.exe -ArgumentList "/c {command}" -Wait']
+            elif command.endswith('.ps1'):
+                cmd_list = ['powershell', '-File', command]
+                if as_admin:
+                    cmd_list = ['powershell', '-Command', f'Start-Process -Verb RunAs -FilePath powershell.exe -ArgumentList "-File {command}" -Wait']
+            else:
+                cmd_list = ['python', command]
+                if as_admin:
+                    cmd_list = ['powershell', '-Command', f'Start-Process -Verb RunAs -FilePath python.exe -ArgumentList "{command}" -Wait']
+            return cmd_list, False
+
+        # 执行普通命令
+        return command, True
+
+    def handle_command(self, command, as_admin=False, request_id=None, stream=False, timeout=None):
+        """处理命令执行 - 支持管理员权限
+
+        stdout和stderr合并读取，stream为True时（新版控制端）输出按大小或时间合并成
+        command_output陆续发送，结束时再发一条command_result；否则输出全部收集后放在command_result中。
+        流式返回且带请求ID的命令默认没有时间限制，可以用cancel_command结束；
+        其他命令默认COMMAND_TIMEOUT秒后结束，timeout（秒）由控制端指定。
+        """
+        print(f"[{self.get_time()}] 执行命令: {command} (管理员: {as_admin})")
+        if not timeout and (not stream or request_id is None):
+            timeout = COMMAND_TIMEOUT
+
+        built = self.build_command(command, as_admin)
+        if built is None:
             self.send_json({
                 'type': 'command_result',
                 'command': command,
-                'output': output
-            })
+                'output': f"错误: 文件不存在 - {command}",
+                'error': True
+            }, request_id)
+            return
+        args, shell = built
+
+        try:
+            process = subprocess.Popen(args, shell=shell, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       # 独立进程组，取消时连同子进程一起结束
+                                       start_new_session=platform.system() != 'Windows')
         except Exception as e:
-            output = f"错误: {str(e)}"
             self.send_json({
                 'type': 'command_result',
                 'command': command,
-                'output': output
-            })
+                'output': f"错误: {str(e)}",
+                'error': True
+            }, request_id)
+            return
+
+        state = {'process': process, 'cancelled': False, 'timed_out': False,
+                 'cond': threading.Condition(), 'pending': [], 'size': 0, 'eof': False}
+        if request_id is not None:
+            with self.commands_lock:
+                self.commands[request_id] = state
+        threading.Thread(target=self.read_command_output, args=(state,), daemon=True).start()
+
+        deadline = time.time() + timeout if timeout else None
+        collected = []
+        collected_size = 0
+        truncated = False
+        seq = 0
+        last_flush = time.time()
+        try:
+            while True:
+                cond = state['cond']
+                with cond:
+                    while not state['eof'] and state['size'] < COMMAND_OUTPUT_CHUNK:
+                        now = time.time()
+                        wait = COMMAND_OUTPUT_INTERVAL - (now - last_flush) if state['pending'] else None
+                        if deadline is not None and not state['timed_out']:
+                            wait = deadline - now if wait is None else min(wait, deadline - now)
+                        if wait is not None and wait <= 0:
+                            break
+                        cond.wait(wait)
+                    text = ''.join(state['pending'])
+                    state['pending'].clear()
+                    state['size'] = 0
+                    eof = state['eof']
+                    cond.notify()  # 读取线程可能因积压过多在等待
+
+                if deadline is not None and not eof and not state['timed_out'] and time.time() >= deadline:
+                    state['timed_out'] = True
+                    self.kill_process_tree(process)
+
+                if text:
+                    if stream:
+                        for start in range(0, len(text), COMMAND_OUTPUT_CHUNK):
+                            self.send_json({
+                                'type': 'command_output',
+                                'command': command,
+                                'seq': seq,
+                                'output': text[start:start + COMMAND_OUTPUT_CHUNK]
+                            }, request_id)
+                            seq += 1
+                    else:
+                        piece = text[:COMMAND_OUTPUT_LIMIT - collected_size]
+                        collected.append(piece)
+                        collected_size += len(piece)
+                        truncated = truncated or len(piece) < len(text)
+                    last_flush = time.time()
+                if eof:
+                    break
+
+            returncode = process.wait()
+        finally:
+            if request_id is not None:
+                with self.commands_lock:
+                    self.commands.pop(request_id, None)
+
+        if state['cancelled']:
+            status = "命令已取消"
+        elif state['timed_out']:
+            status = f"错误: 命令执行超时 ({timeout:g}秒)"
+        else:
+            status = None
+
+        if stream:
+            output = status or f"命令执行完成 (返回码 {returncode})"
+        else:
+            output = ''.join(collected)
+            if truncated:
+                output += f"\n... 输出过长，只保留前 {COMMAND_OUTPUT_LIMIT} 个字符"
+            if status:
+                output = f"{output}\n{status}" if output else status
+            elif not output:
+                output = "命令执行完成 (无输出)"
+
+        self.send_json({
+            'type': 'command_result',
+            'command': command,
+            'output': output,
+            'returncode': returncode,
+            'streamed': stream,
+            'cancelled': state['cancelled']
+        }, request_id)
+
+        print(f"[{self.get_time()}] 命令执行完成 (返回码 {returncode}, 分块 {seq})")
+
+    def read_command_output(self, state):
+        """读取命令输出的线程：有数据就解码放入state['pending']，由handle_command合并发送"""
+        process = state['process']
+        cond = state['cond']
+        decoder = codecs.getincrementaldecoder(COMMAND_ENCODING)(errors='ignore')
+        try:
+            while True:
+                data = process.stdout.read1(65536)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    with cond:
+                        # 发送跟不上时暂停读取，由管道让命令进程等待，内存中的输出不会无限增长
+                        while state['size'] >= COMMAND_OUTPUT_CHUNK * 4:
+                            cond.wait()
+                        state['pending'].append(text)
+                        state['size'] += len(text)
+                        cond.notify()
+        except Exception as e:
+            print(f"[{self.get_time()}] 读取命令输出错误: {e}")
+        finally:
+            process.stdout.close()
+            with cond:
+                state['pending'].append(decoder.decode(b'', final=True))
+                state['eof'] = True
+                cond.notify()
+
+    def cancel_command(self, request_id):
+        """结束request_id对应的正在执行的命令"""
+        with self.commands_lock:
+            state = self.commands.get(request_id)
+        if state is None:
+            return
+        state['cancelled'] = True
+        self.kill_process_tree(state['process'])
+        print(f"[{self.get_time()}] 已取消命令 (请求 {request_id})")
+
+    def kill_process_tree(self, process):
+        """结束命令进程及其子进程"""
+        if process.poll() is not None:
+            return
+        try:
+            if platform.system() == 'Windows':
+                subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                               capture_output=True, timeout=10)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except Exception:
+            process.kill()
+
+    def queue_input(self, action, data):
+        """把鼠标键盘事件放入输入队列
+
+        执行跟不上时，队尾连续的鼠标移动只保留最新的位置，
+        点击、滚轮和按键保持原有顺序，不会被合并
+        """
+        with self.input_cond:
+            if action == 'mouse_move' and self.input_events and self.input_events[-1][0] == 'mouse_move':
+                self.input_events[-1] = (action, data)
+                self.input_coalesced += 1
+            else:
+                self.input_events.append((action, data))
+            if self.input_thread is None:
+                self.input_thread = threading.Thread(target=self.input_loop, daemon=True)
+                self.input_thread.start()
+            self.input_cond.notify()
+
+    def cancel_input(self):
+        """丢弃还没执行的输入事件，并停止正在进行的keyboard_type"""
+        with self.input_cond:
+            dropped = len(self.input_events)
+            self.input_events.clear()
+            self.input_generation += 1
+        print(f"[{self.get_time()}] 已取消输入 (丢弃 {dropped} 个待执行事件)")
+
+    def input_cancelled(self, generation):
+        """取出事件之后是否调用过cancel_input"""
+        return not self.running or self.input_generation != generation
+
+    def input_loop(self):
+        """输入线程：按顺序执行输入队列中的事件"""
+        while self.running:
+            with self.input_cond:
+                while self.running and not self.input_events:
+                    self.input_cond.wait()
+                if not self.running:
+                    break
+                action, data = self.input_events.pop(0)
+                generation = self.input_generation
+            if action == 'mouse_move':
+                self.handle_mouse_move(data.get('x', 0), data.get('y', 0))
+            elif action == 'mouse_click':
+                self.handle_mouse_click(data.get('button', 'left'), data.get('clicks', 1),
+                                        data.get('x', None), data.get('y', None))
+            elif action == 'mouse_scroll':
+                self.handle_mouse_scroll(data.get('dx', 0), data.get('dy', 0))
+            elif action == 'keyboard_press':
+                self.handle_keyboard_press(data.get('key', ''))
+            elif action == 'keyboard_type':
+                self.handle_keyboard_type(data.get('text', ''), data.get('interval'), generation)
 
     def handle_mouse_move(self, x, y):
-        """处理鼠标移动"""
+        """处理鼠标移动（频繁调用，不逐条打印）"""
         if not PYAUTOGUI_AVAILABLE:
             return
         try:
             pyautogui.moveTo(x, y, duration=0)
-            print(f"[{self.get_time()}] 鼠标移动到: ({x}, {y})")
         except Exception as e:
             print(f"[{self.get_time()}] 鼠标移动错误: {e}")
 
@@ -455,44 +983,49 @@ class RemoteAgent:
         except Exception as e:
             print(f"[{self.get_time()}] 键盘按键错误: {e}")
 
-    def handle_keyboard_type(self, text):
-        """处理键盘输入"""
+    def handle_keyboard_type(self, text, interval=None, generation=None):
+        """处理键盘输入，在输入线程中分批输入，每批之间检查是否已被cancel_input取消
+
+        Args:
+            interval: 字符间隔（秒），None时使用self.type_interval
+            generation: 取出该事件时的input_generation
+        """
         if not PYAUTOGUI_AVAILABLE:
             return
+        if interval is None:
+            interval = self.type_interval
+        if generation is None:
+            generation = self.input_generation
         try:
-            pyautogui.write(text, interval=0.05)
+            for start in range(0, len(text), TYPE_BATCH):
+                if self.input_cancelled(generation):
+                    print(f"[{self.get_time()}] 键盘输入已取消 (已输入 {start}/{len(text)} 个字符)")
+                    return
+                # 每批只在write内部按interval等待，不再叠加pyautogui.PAUSE
+                pyautogui.write(text[start:start + TYPE_BATCH], interval=interval, _pause=False)
         except Exception as e:
             print(f"[{self.get_time()}] 键盘输入错误: {e}")
 
-    def send_json(self, data):
-        """发送JSON数据"""
+    def send_json(self, data, request_id=None):
+        """发送JSON数据
+
+        Args:
+            request_id: 对应请求的ID，不为None时附带在消息中用于服务器定向回复
+        """
         try:
-            msg = json.dumps(data).encode('utf-8')
-            length = len(msg)
-            self.sock.sendall(length.to_bytes(4, 'big') + msg)
+            if request_id is not None:
+                data['request_id'] = request_id
+            frame = encode_message(data, self.peer_protocol)
+            with self.send_lock:
+                self.sock.sendall(frame)
             return True
         except Exception as e:
             return False
     
     def recv_json(self):
-        """接收JSON数据"""
+        """接收一条消息（兼容JSON帧和二进制帧）"""
         try:
-            # 接收长度
-            raw_len = self.sock.recv(4)
-            if not raw_len or len(raw_len) < 4:
-                return None
-            
-            msg_len = int.from_bytes(raw_len, 'big')
-            
-            # 接收数据
-            msg = b''
-            while len(msg) < msg_len:
-                chunk = self.sock.recv(min(msg_len - len(msg), 4096))
-                if not chunk:
-                    return None
-                msg += chunk
-            
-            return json.loads(msg.decode('utf-8'))
+            return recv_message(self.sock)
         except Exception as e:
             return None
     
@@ -500,7 +1033,7 @@ class RemoteAgent:
         """获取当前时间字符串"""
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    def handle_get_drives(self):
+    def handle_get_drives(self, request_id=None):
         """获取所有磁盘驱动器"""
         try:
             import string
@@ -561,18 +1094,18 @@ class RemoteAgent:
                 })
 
             print(f"[{self.get_time()}] 获取到 {len(drives)} 个驱动器")
-            self.send_json({'type': 'drives_list', 'drives': drives})
+            self.send_json({'type': 'drives_list', 'drives': drives}, request_id)
         except Exception as e:
             print(f"[{self.get_time()}] 获取驱动器错误: {e}")
-            self.send_json({'type': 'drives_list', 'error': str(e)})
+            self.send_json({'type': 'drives_list', 'error': str(e)}, request_id)
 
-    def handle_list_files(self, path):
+    def handle_list_files(self, path, request_id=None):
         """列出目录文件"""
         try:
             print(f"[{self.get_time()}] 列出目录: {path}")
 
             if not os.path.exists(path):
-                self.send_json({'type': 'file_list', 'path': path, 'error': '路径不存在'})
+                self.send_json({'type': 'file_list', 'path': path, 'error': '路径不存在'}, request_id)
                 return
 
             files, folders = [], []
@@ -592,62 +1125,158 @@ class RemoteAgent:
                 except:
                     pass
 
-            self.send_json({'type': 'file_list', 'path': path, 'items': folders + files})
+            self.send_json({'type': 'file_list', 'path': path, 'items': folders + files}, request_id)
         except Exception as e:
-            self.send_json({'type': 'file_list', 'path': path, 'error': str(e)})
+            self.send_json({'type': 'file_list', 'path': path, 'error': str(e)}, request_id)
 
-    def handle_open_file(self, filepath):
+    def handle_open_file(self, filepath, request_id=None):
         """打开查看文件"""
         try:
             print(f"[{self.get_time()}] 打开文件: {filepath}")
 
             if not os.path.exists(filepath):
-                self.send_json({'type': 'file_open', 'filepath': filepath, 'error': '文件不存在'})
+                self.send_json({'type': 'file_open', 'filepath': filepath, 'error': '文件不存在'}, request_id)
                 return
 
             if os.path.isdir(filepath):
-                self.send_json({'type': 'file_open', 'filepath': filepath, 'error': '不能打开文件夹'})
+                self.send_json({'type': 'file_open', 'filepath': filepath, 'error': '不能打开文件夹'}, request_id)
                 return
 
             # 检查文件大小
             file_size = os.path.getsize(filepath)
             max_size = 10 * 1024 * 1024  # 10MB
             if file_size > max_size:
-                self.send_json({'type': 'file_open', 'filepath': filepath, 'error': f'文件过大 ({file_size} bytes)，超过10MB限制'})
+                self.send_json({'type': 'file_open', 'filepath': filepath, 'error': f'文件过大 ({file_size} bytes)，超过10MB限制'}, request_id)
                 return
 
             with open(filepath, 'rb') as f:
-                content_b64 = base64.b64encode(f.read()).decode('utf-8')
+                content = f.read()
 
-            print(f"[{self.get_time()}] 文件已编码，大小: {len(content_b64)} bytes")
-            self.send_json({'type': 'file_open', 'filepath': filepath, 'filename': os.path.basename(filepath), 'content': content_b64})
+            print(f"[{self.get_time()}] 文件已读取，大小: {len(content)} bytes")
+            self.send_json({'type': 'file_open', 'filepath': filepath, 'filename': os.path.basename(filepath), 'content': content}, request_id)
         except Exception as e:
             print(f"[{self.get_time()}] 打开文件错误: {e}")
-            self.send_json({'type': 'file_open', 'filepath': filepath, 'error': str(e)})
+            self.send_json({'type': 'file_open', 'filepath': filepath, 'error': str(e)}, request_id)
 
-    def handle_download_file(self, filepath):
+    def handle_download_file(self, filepath, request_id=None):
         """下载文件"""
         try:
             print(f"[{self.get_time()}] 下载文件: {filepath}")
 
             if not os.path.exists(filepath):
-                self.send_json({'type': 'file_download', 'filepath': filepath, 'error': '文件不存在'})
+                self.send_json({'type': 'file_download', 'filepath': filepath, 'error': '文件不存在'}, request_id)
                 return
 
             if os.path.isdir(filepath):
-                self.send_json({'type': 'file_download', 'filepath': filepath, 'error': '不能下载文件夹'})
+                self.send_json({'type': 'file_download', 'filepath': filepath, 'error': '不能下载文件夹'}, request_id)
                 return
 
             with open(filepath, 'rb') as f:
-                content_b64 = base64.b64encode(f.read()).decode('utf-8')
+                content = f.read()
 
-            print(f"[{self.get_time()}] 文件已编码，大小: {len(content_b64)} bytes")
-            self.send_json({'type': 'file_download', 'filepath': filepath, 'filename': os.path.basename(filepath), 'content': content_b64})
+            print(f"[{self.get_time()}] 文件已读取，大小: {len(content)} bytes")
+            self.send_json({'type': 'file_download', 'filepath': filepath, 'filename': os.path.basename(filepath), 'content': content}, request_id)
         except Exception as e:
             print(f"[{self.get_time()}] 下载文件错误: {e}")
-            self.send_json({'type': 'file_download', 'filepath': filepath, 'error': str(e)})
+            self.send_json({'type': 'file_download', 'filepath': filepath, 'error': str(e)}, request_id)
 
-    def handle_upload_file(self, filepath, content_b64):
+    def handle_download_stream(self, filepath, request_id=None, chunk_size=None, window=None):
+        """分块下载文件
+
+        依次发送 file_download_start、带偏移量和crc32的 file_download_chunk、带sha256的 file_download_end。
+        未被控制端确认的块不超过window个，内存占用与文件大小无关，服务器队列也不会堆积整个文件。
+        """
+        try:
+            chunk_size = max(4096, min(int(chunk_size or FILE_CHUNK_SIZE), MAX_CHUNK_SIZE))
+            window = max(1, int(window or FILE_WINDOW))
+            print(f"[{self.get_time()}] 分块下载文件: {filepath}")
+
+            if not os.path.exists(filepath):
+                self.send_json({'type': 'file_download', 'filepath': filepath, 'error': '文件不存在'}, request_id)
+                return
+
+            if os.path.isdir(filepath):
+                self.send_json({'type': 'file_download', 'filepath': filepath, 'error': '不能下载文件夹'}, request_id)
+                return
+
+            with self.download_cond:
+                state = {'acked': 0, 'cancelled': False}
+                self.downloads[request_id] = state
+
+            size = os.path.getsize(filepath)
+            self.send_json({
+                'type': 'file_download_start',
+                'filepath': filepath,
+                'filename': os.path.basename(filepath),
+                'size': size,
+                'chunk_size': chunk_size
+            }, request_id)
+
+            sha256 = hashlib.sha256()
+            offset = 0
+            with open(filepath, 'rb') as f:
+                while True:
+                    # 等待确认，在途数据不超过window块
+                    with self.download_cond:
+                        deadline = time.time() + DOWNLOAD_ACK_TIMEOUT
+                        while offset - state['acked'] >= window * chunk_size and not state['cancelled']:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                raise TimeoutError('等待控制端确认超时')
+                            self.download_cond.wait(remaining)
+                        if state['cancelled']:
+                            print(f"[{self.get_time()}] 下载已取消: {filepath}")
+                            return
+
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    sent = self.send_json({
+                        'type': 'file_download_chunk',
+                        'filepath': filepath,
+                        'offset': offset,
+                        'crc32': zlib.crc32(chunk),
+                        'data': chunk
+                    }, request_id)
+                    if not sent:
+                        raise ConnectionError('发送失败，连接已断开')
+                    offset += len(chunk)
+
+            self.send_json({
+                'type': 'file_download_end',
+                'filepath': filepath,
+                'size': offset,
+                'sha256': sha256.hexdigest()
+            }, request_id)
+            print(f"[{self.get_time()}] 文件已发送，大小: {offset} bytes")
+        except Exception as e:
+            print(f"[{self.get_time()}] 下载文件错误: {e}")
+            self.send_json({'type': 'file_download_end', 'filepath': filepath, 'error': str(e)}, request_id)
+        finally:
+            with self.download_cond:
+                self.downloads.pop(request_id, None)
+
+    def handle_download_ack(self, request_id, offset=0, cancel=False):
+        """处理控制端对分块下载的确认或取消"""
+        with self.download_cond:
+            state = self.downloads.get(request_id)
+            if state is None:
+                return
+            if cancel:
+                state['cancelled'] = True
+            else:
+                state['acked'] = max(state['acked'], offset)
+            self.download_cond.notify_all()
+
+    def cancel_downloads(self):
+        """取消所有进行中的分块下载"""
+        with self.download_cond:
+            for state in self.downloads.values():
+                state['cancelled'] = True
+            self.download_cond.notify_all()
+
+    def handle_upload_file(self, filepath, content, request_id=None):
         """上传文件"""
         try:
             print(f"[{self.get_time()}] 上传文件: {filepath}")
@@ -658,21 +1287,138 @@ class RemoteAgent:
                 os.makedirs(dir_path, exist_ok=True)
 
             with open(filepath, 'wb') as f:
-                f.write(base64.b64decode(content_b64))
+                f.write(payload_bytes(content))
+
+            print(f"[{self.get_time()}] 文件上传成功: {filepath}")
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'success': True}, request_id)
+        except Exception as e:
+            print(f"[{self.get_time()}] 上传文件错误: {e}")
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'error': str(e)}, request_id)
+
+    def handle_upload_start(self, filepath, size, sha256, request_id=None):
+        """分块上传开始：根据已有的临时文件确定续传位置并回复upload_status
+
+        数据先写入 <目标>.part，<目标>.part.json 记录文件大小和sha256；
+        同一个文件（大小和sha256都相同）再次上传时从临时文件末尾继续。
+        """
+        try:
+            print(f"[{self.get_time()}] 分块上传文件: {filepath} ({size} bytes)")
+            part_path = filepath + '.part'
+            meta_path = part_path + '.json'
+            self.close_upload(filepath)
+
+            # 确保目录存在
+            dir_path = os.path.dirname(filepath)
+            if dir_path and not os.path.exists(dir_path):
+                os.makedirs(dir_path, exist_ok=True)
+
+            offset = 0
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta.get('size') == size and meta.get('sha256') == sha256 and os.path.exists(part_path):
+                    offset = min(os.path.getsize(part_path), size)
+            except (OSError, ValueError):
+                pass
+
+            if offset:
+                print(f"[{self.get_time()}] 从 {offset} 字节处续传")
+                f = open(part_path, 'r+b')
+                f.truncate(offset)
+                f.seek(offset)
+            else:
+                with open(meta_path, 'w', encoding='utf-8') as meta_file:
+                    json.dump({'size': size, 'sha256': sha256}, meta_file)
+                f = open(part_path, 'wb')
+
+            self.uploads[filepath] = {
+                'file': f,
+                'offset': offset,
+                'size': size,
+                'sha256': sha256,
+                'reported': None  # 最近一次回复给控制端的续传位置，避免重复回复
+            }
+            self.send_json({'type': 'upload_status', 'filepath': filepath, 'offset': offset}, request_id)
+        except Exception as e:
+            print(f"[{self.get_time()}] 上传文件错误: {e}")
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'error': str(e)}, request_id)
 
+    def handle_upload_chunk(self, filepath, offset, crc32, data, request_id=None):
+        """写入一个上传数据块，偏移量不连续或crc32不符时回复当前位置让控制端重发"""
+        upload = self.uploads.get(filepath)
+        if upload is None:
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'error': '上传未开始或已中断'}, request_id)
+            return
+
+        chunk = payload_bytes(data)
+        if offset != upload['offset'] or zlib.crc32(chunk) != crc32:
+            if upload['reported'] != upload['offset']:
+                upload['reported'] = upload['offset']
+                self.send_json({'type': 'upload_status', 'filepath': filepath, 'offset': upload['offset']}, request_id)
+            return
+
+        try:
+            upload['file'].write(chunk)
+            upload['file'].flush()
+        except Exception as e:
+            self.close_upload(filepath)
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'error': str(e)}, request_id)
+            return
+        upload['offset'] += len(chunk)
+        upload['reported'] = None
+        self.send_json({'type': 'upload_ack', 'filepath': filepath, 'offset': upload['offset']}, request_id)
+
+    def handle_upload_finish(self, filepath, request_id=None):
+        """分块上传结束：核对大小和sha256后把临时文件改名为目标文件"""
+        upload = self.uploads.pop(filepath, None)
+        part_path = filepath + '.part'
+        meta_path = part_path + '.json'
+        try:
+            if upload is None:
+                raise ValueError('上传未开始或已中断')
+            upload['file'].close()
+            if upload['offset'] != upload['size']:
+                raise ValueError(f"文件大小不一致 ({upload['offset']} != {upload['size']})")
+
+            sha256 = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(block)
+            if sha256.hexdigest() != upload['sha256']:
+                # 临时文件已损坏，删除后下次重新上传
+                os.remove(part_path)
+                os.remove(meta_path)
+                raise ValueError('sha256校验失败')
+
+            os.replace(part_path, filepath)
+            os.remove(meta_path)
             print(f"[{self.get_time()}] 文件上传成功: {filepath}")
-            self.send_json({'type': 'file_upload', 'filepath': filepath, 'success': True})
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'success': True}, request_id)
         except Exception as e:
             print(f"[{self.get_time()}] 上传文件错误: {e}")
-            self.send_json({'type': 'file_upload', 'filepath': filepath, 'error': str(e)})
+            self.send_json({'type': 'file_upload', 'filepath': filepath, 'error': str(e)}, request_id)
+
+    def close_upload(self, filepath):
+        """关闭某个上传的临时文件（保留文件用于续传）"""
+        upload = self.uploads.pop(filepath, None)
+        if upload:
+            try:
+                upload['file'].close()
+            except:
+                pass
+
+    def close_uploads(self):
+        """关闭所有上传的临时文件"""
+        for filepath in list(self.uploads):
+            self.close_upload(filepath)
 
-    def handle_delete_file(self, filepath):
+    def handle_delete_file(self, filepath, request_id=None):
         """删除文件或文件夹"""
         try:
             print(f"[{self.get_time()}] 删除: {filepath}")
 
             if not os.path.exists(filepath):
-                self.send_json({'type': 'file_delete', 'filepath': filepath, 'error': '文件或文件夹不存在'})
+                self.send_json({'type': 'file_delete', 'filepath': filepath, 'error': '文件或文件夹不存在'}, request_id)
                 return
 
             if os.path.isdir(filepath):
@@ -685,31 +1431,36 @@ class RemoteAgent:
                 os.remove(filepath)
                 print(f"[{self.get_time()}] 已删除文件: {filepath}")
 
-            self.send_json({'type': 'file_delete', 'filepath': filepath, 'success': True})
+            self.send_json({'type': 'file_delete', 'filepath': filepath, 'success': True}, request_id)
         except Exception as e:
             print(f"[{self.get_time()}] 删除错误: {e}")
-            self.send_json({'type': 'file_delete', 'filepath': filepath, 'error': str(e)})
+            self.send_json({'type': 'file_delete', 'filepath': filepath, 'error': str(e)}, request_id)
 
-    def handle_create_folder(self, folderpath):
+    def handle_create_folder(self, folderpath, request_id=None):
         """创建文件夹"""
         try:
             print(f"[{self.get_time()}] 创建文件夹: {folderpath}")
 
             if os.path.exists(folderpath):
-                self.send_json({'type': 'folder_create', 'folderpath': folderpath, 'error': '文件夹已存在'})
+                self.send_json({'type': 'folder_create', 'folderpath': folderpath, 'error': '文件夹已存在'}, request_id)
                 return
 
             os.makedirs(folderpath, exist_ok=True)
             print(f"[{self.get_time()}] 文件夹创建成功: {folderpath}")
-            self.send_json({'type': 'folder_create', 'folderpath': folderpath, 'success': True})
+            self.send_json({'type': 'folder_create', 'folderpath': folderpath, 'success': True}, request_id)
         except Exception as e:
             print(f"[{self.get_time()}] 创建文件夹错误: {e}")
-            self.send_json({'type': 'folder_create', 'folderpath': folderpath, 'error': str(e)})
+            self.send_json({'type': 'folder_create', 'folderpath': folderpath, 'error': str(e)}, request_id)
 
     def stop(self):
         """停止agent"""
         self.running = False
-        self.video_streaming = False
+        with self.input_cond:
+            self.input_events.clear()
+            self.input_generation += 1
+            self.input_cond.notify_all()
+        self.stop_video_session()
+        self.stop_thumbnails()
         if self.sock:
             self.sock.close()
 
@@ -722,6 +1473,8 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, default=5000, help='服务器端口')
     parser.add_argument('--name', type=str, default=None, help='自定义主机名')
     parser.add_argument('--config', type=str, default='agent_config.ini', help='配置文件路径')
+    parser.add_argument('--frame-source', type=str, default=None,
+                        help='画面来源: screen / synthetic:<text|noise|static> / replay:<路径>')
     parser.add_argument('--silent', action='store_true', help='静默模式（无输出）')
     args = parser.parse_args()
 
@@ -729,6 +1482,9 @@ if __name__ == '__main__':
     SERVER_IP = None
     SERVER_PORT = 5000
     CUSTOM_NAME = None
+    KEYFRAME_SECONDS = KEYFRAME_INTERVAL
+    FRAME_SOURCE = 'screen'
+    TYPE_SECONDS = TYPE_INTERVAL
 
     if os.path.exists(args.config):
         try:
@@ -740,6 +1496,11 @@ if __name__ == '__main__':
                 SERVER_PORT = config['Server'].getint('port', 5000)
             if 'Agent' in config:
                 CUSTOM_NAME = config['Agent'].get('name', None)
+            if 'Video' in config:
+                KEYFRAME_SECONDS = config['Video'].getfloat('keyframe_interval', KEYFRAME_INTERVAL)
+                FRAME_SOURCE = config['Video'].get('frame_source', 'screen') or 'screen'
+            if 'Input' in config:
+                TYPE_SECONDS = config['Input'].getfloat('type_interval', TYPE_INTERVAL)
         except Exception as e:
             if not args.silent:
                 print(f"读取配置文件失败: {e}")
@@ -751,6 +1512,8 @@ if __name__ == '__main__':
         SERVER_PORT = args.port
     if args.name:
         CUSTOM_NAME = args.name
+    if args.frame_source:
+        FRAME_SOURCE = args.frame_source
 
     # 如果没有配置且不是静默模式，则交互式输入
     if not SERVER_IP and not args.silent:
@@ -774,7 +1537,8 @@ if __name__ == '__main__':
         sys.stdout = open(os.devnull, 'w')
         sys.stderr = open(os.devnull, 'w')
 
-    agent = RemoteAgent(SERVER_IP, SERVER_PORT, custom_name=CUSTOM_NAME)
+    agent = RemoteAgent(SERVER_IP, SERVER_PORT, custom_name=CUSTOM_NAME, keyframe_interval=KEYFRAME_SECONDS,
+                        frame_source=FRAME_SOURCE, type_interval=TYPE_SECONDS)
 
     try:
         agent.connect()
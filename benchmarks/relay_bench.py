@@ -0,0 +1,85 @@
+"""
+远程控制系统 - 中转性能基准
+比较服务器转发一条带二进制负载的消息（截图/视频帧/文件）时每MB负载消耗的CPU时间
+
+  legacy:  旧版中转路径，完整json.loads后每个控制端各做一次json.dumps
+  relay-v1: decode_relay处理旧版被控端的JSON帧，agent_id拼接到头部，不重新序列化
+  relay-v2: decode_relay处理v2二进制帧，只解析头JSON，负载原样转发
+
+只测量中转进程内的解码/编码开销，不含socket收发。
+
+用法:
+    python benchmarks/relay_bench.py --size 256 --controllers 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import decode_relay, encode_message  # noqa: E402
+
+
+def legacy_relay(body, controllers):
+    """旧版服务器：解析整条JSON，每个控制端重新序列化一次"""
+    msg = json.loads(body.decode('utf-8'))
+    msg['agent_id'] = 'bench-agent'
+    for _ in range(controllers):
+        data = json.dumps(msg).encode('utf-8')
+        len(data).to_bytes(4, 'big') + data
+
+
+def fast_relay(body, controllers, version):
+    """新版服务器：只解析路由字段，编码结果由所有控制端共享"""
+    msg = decode_relay(body)
+    msg['agent_id'] = 'bench-agent'
+    for _ in range(controllers):
+        msg.encode(version)
+
+
+def measure(func, body, count):
+    """运行count次，返回CPU秒数"""
+    start = time.process_time()
+    for _ in range(count):
+        func(body)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='中转路径CPU开销基准')
+    parser.add_argument('--size', type=int, default=256, help='负载大小(KB)')
+    parser.add_argument('--controllers', type=int, default=4, help='接收该消息的控制端数量')
+    parser.add_argument('--count', type=int, default=0, help='每种路径的转发次数，0表示按约64MB负载自动计算')
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size * 1024)
+    count = args.count or max(1, (64 * 1024 * 1024) // len(payload))
+    mb = len(payload) * count / (1024 * 1024)
+
+    message = {'type': 'video_frame', 'format': 'jpeg', 'request_id': 'r' * 32, 'image': payload}
+    # 帧正文（去掉4字节长度头），与服务器recv_frame返回的内容一致
+    v1_body = encode_message(message, 1)[4:]
+    v2_body = encode_message(message, 2)[4:]
+
+    cases = [
+        ('legacy', lambda body: legacy_relay(body, args.controllers), v1_body),
+        ('relay-v1', lambda body: fast_relay(body, args.controllers, 1), v1_body),
+        ('relay-v2', lambda body: fast_relay(body, args.controllers, 2), v2_body),
+    ]
+
+    print(f"负载 {args.size} KB x {count} 条 ({mb:.1f} MB), 每条发给 {args.controllers} 个控制端")
+    print(f"{'路径':<10}{'CPU秒':>10}{'CPU毫秒/MB':>14}{'相对legacy':>12}")
+    baseline = None
+    for name, func, body in cases:
+        seconds = measure(func, body, count)
+        per_mb = seconds * 1000 / mb
+        if baseline is None:
+            baseline = per_mb
+        print(f"{name:<10}{seconds:>10.3f}{per_mb:>14.3f}{baseline / per_mb if per_mb else float('inf'):>11.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+远程控制系统 - 视频编码基准
+用合成或回放的画面驱动被控端的视频编码路径（变化检测 -> 缩放 -> 整帧JPEG/图块增量），
+对每个质量档位报告可达帧率、每帧字节数和每帧CPU时间，不需要显示器
+
+  fps:      只算编码（不含采集和网络）时单线程每秒能处理的帧数
+  字节/帧:  平均每个采集帧发送的字节数（画面不变而跳过的帧按0计）
+  CPU/帧:   平均每个采集帧在编码路径上消耗的CPU毫秒数
+  发送帧:   实际需要发送的帧数 / 采集帧数
+
+用法:
+    python benchmarks/video_bench.py --source synthetic:text --source synthetic:noise --frames 60
+    python benchmarks/video_bench.py --source replay:recordings/ --codec tiles
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_source import SYNTHETIC_SCENES, create_frame_source  # noqa: E402
+from video_codec import (NUMPY_AVAILABLE, QUALITY_PRESETS, FrameChangeDetector, TileEncoder,  # noqa: E402
+                         encode_video_frame)
+
+
+def run(source_spec, preset, codec, frames):
+    """用一个新的画面来源编码frames帧，返回 (墙钟秒, CPU秒, 字节数, 发送帧数)"""
+    source = create_frame_source(source_spec)
+    settings = QUALITY_PRESETS[preset]
+    # 关闭定期整帧刷新，结果只取决于画面内容
+    detector = FrameChangeDetector(keyframe_interval=0)
+    encoder = TileEncoder() if codec == 'tiles' else None
+
+    images = [source.grab() for _ in range(frames)]  # 采集不计入编码开销
+    total_bytes = 0
+    sent = 0
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for image in images:
+        message = encode_video_frame(image, settings, detector, encoder)
+        if message is not None:
+            total_bytes += len(message['image'])
+            sent += 1
+    return time.perf_counter() - wall_start, time.process_time() - cpu_start, total_bytes, sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description='视频编码路径基准')
+    parser.add_argument('--source', action='append', default=None,
+                        help='画面来源，可重复指定（默认三个合成场景）')
+    parser.add_argument('--codec', choices=('jpeg', 'tiles', 'all'), default='all',
+                        help='jpeg为整帧编码，tiles为图块增量编码（需要NumPy）')
+    parser.add_argument('--preset', action='append', choices=sorted(QUALITY_PRESETS), default=None,
+                        help='质量档位，可重复指定（默认全部）')
+    parser.add_argument('--frames', type=int, default=60, help='每种组合编码的帧数')
+    args = parser.parse_args()
+
+    sources = args.source or [f'synthetic:{scene}' for scene in SYNTHETIC_SCENES]
+    presets = args.preset or list(QUALITY_PRESETS)
+    codecs = ['jpeg', 'tiles'] if args.codec == 'all' else [args.codec]
+    if 'tiles' in codecs and not NUMPY_AVAILABLE:
+        print('NumPy未安装，跳过tiles编码')
+        codecs.remove('tiles')
+
+    print(f"每种组合 {args.frames} 帧")
+    print(f"{'来源':<18}{'档位':<8}{'编码':<7}{'fps':>9}{'字节/帧':>12}{'CPU毫秒/帧':>13}{'发送帧':>10}")
+    for source_spec in sources:
+        for preset in presets:
+            for codec in codecs:
+                wall, cpu, total_bytes, sent = run(source_spec, preset, codec, args.frames)
+                fps = args.frames / wall if wall else float('inf')
+                print(f"{source_spec:<18}{preset:<8}{codec:<7}{fps:>9.1f}{total_bytes / args.frames:>12.0f}"
+                      f"{cpu * 1000 / args.frames:>13.2f}{f'{sent}/{args.frames}':>10}")
+
+
+if __name__ == '__main__':
+    main()
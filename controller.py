@@ -7,10 +7,31 @@ import sys
 import socket
 import threading
 import json
-import base64
+import collections
+import csv
 import os
+import uuid
+import time
+import hashlib
+import zlib
 from datetime import datetime
 
+from protocol import (FILE_CHUNK_SIZE, FILE_WINDOW, LEGACY_PROTOCOL, PROTOCOL_VERSION, encode_message,
+                      negotiate, payload_bytes, recv_message)
+from video_codec import CODEC_TILES, THUMBNAIL_SETTINGS
+
+# 分块上传等待被控端回复的超时（秒），超时后重新发起upload_start续传
+UPLOAD_REPLY_TIMEOUT = 30
+
+# 分块上传的最大尝试次数（每次断线或超时后从被控端已写入的位置继续）
+UPLOAD_MAX_ATTEMPTS = 20
+
+# 远程控制时鼠标移动的最大发送频率（次/秒），可在config.ini的[controller] mouse_move_hz中修改，0表示不限制
+MOUSE_MOVE_MAX_HZ = 30
+
+# 批量任务结果树最多显示的任务数
+MAX_JOB_ITEMS = 50
+
 try:
     from PyQt5 import QtWidgets, QtGui, QtCore
     from PyQt5.QtWidgets import *
@@ -22,20 +43,238 @@ except ImportError:
     sys.exit(1)
 
 
+class FrameLatencyStats:
+    """视频帧各阶段延迟和丢帧统计
+
+    每一帧沿途带有时间戳: 被控端 captured_at/encoded_at/sent_at，服务器 relay_in/relay_out，
+    控制端 recv_at/decoded_at/shown_at。相邻时间戳之差即各阶段耗时；
+    跨机器的阶段（标*）直接相减，只有各机器时钟同步时才准确。
+    """
+
+    # (名称, 显示名, 起点时间戳, 终点时间戳)
+    STAGES = [
+        ('encode', '编码', 'captured_at', 'encoded_at'),
+        ('agent_send', '被控端发送', 'encoded_at', 'sent_at'),
+        ('uplink', '上行网络*', 'sent_at', 'relay_in'),
+        ('relay', '服务器排队', 'relay_in', 'relay_out'),
+        ('downlink', '下行网络*', 'relay_out', 'recv_at'),
+        ('decode', '控制端解码', 'recv_at', 'decoded_at'),
+        ('display', '界面显示', 'decoded_at', 'shown_at'),
+        ('total', '端到端*', 'captured_at', 'shown_at'),
+    ]
+
+    TIMESTAMPS = ['captured_at', 'encoded_at', 'sent_at', 'relay_in', 'relay_out', 'recv_at', 'decoded_at', 'shown_at']
+
+    def __init__(self, window=300, max_rows=100000):
+        self.window = window      # 计算百分位使用的最近帧数
+        self.max_rows = max_rows  # 保留用于导出的帧数上限
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = {name: collections.deque(maxlen=self.window) for name, _, _, _ in self.STAGES}
+            self.rows = collections.deque(maxlen=self.max_rows)
+            self.last_seq = None
+            self.relay_dropped = 0    # 帧号不连续：服务器发送队列替换掉的旧帧
+            self.capture_dropped = 0  # 被控端编码前替换掉的截图（被控端累计值）
+            self.shown = 0
+
+    def on_received(self, frame):
+        """接收线程收到一帧时调用"""
+        frame['recv_at'] = time.time()
+        seq = frame.get('frame')
+        with self.lock:
+            if isinstance(seq, int):
+                if self.last_seq is not None and seq > self.last_seq + 1:
+                    self.relay_dropped += seq - self.last_seq - 1
+                self.last_seq = seq
+            self.capture_dropped = frame.get('capture_dropped', self.capture_dropped)
+
+    def on_shown(self, frame, agent_id):
+        """GUI线程显示一帧后调用"""
+        frame['shown_at'] = time.time()
+        row = {'frame': frame.get('frame'), 'agent_id': agent_id}
+        for key in self.TIMESTAMPS:
+            row[key] = frame.get(key)
+        with self.lock:
+            for name, _, start, end in self.STAGES:
+                if frame.get(start) is not None and frame.get(end) is not None:
+                    value = (frame[end] - frame[start]) * 1000
+                    row[name] = round(value, 2)
+                    self.samples[name].append(value)
+                else:
+                    row[name] = None
+            self.rows.append(row)
+            self.shown += 1
+
+    @staticmethod
+    def percentile(values, p):
+        ordered = sorted(values)
+        return ordered[int(round(p / 100 * (len(ordered) - 1)))]
+
+    def summary(self, decoder_dropped=0):
+        """返回叠加显示的统计文本"""
+        lines = [f"{'阶段(ms)':<10}{'p50':>8}{'p95':>8}{'p99':>8}"]
+        with self.lock:
+            for name, label, _, _ in self.STAGES:
+                values = self.samples[name]
+                if not values:
+                    continue
+                lines.append(f"{label:<10}{self.percentile(values, 50):>8.1f}"
+                             f"{self.percentile(values, 95):>8.1f}{self.percentile(values, 99):>8.1f}")
+            lines.append(f"已显示 {self.shown} 帧  丢帧: 被控端 {self.capture_dropped}  "
+                         f"服务器 {self.relay_dropped}  控制端 {decoder_dropped}")
+        lines.append("* 跨机器，需各机器时钟同步")
+        return '\n'.join(lines)
+
+    def export_csv(self, path):
+        """把每一帧的时间戳和各阶段耗时写入CSV，返回行数"""
+        with self.lock:
+            rows = list(self.rows)
+        fields = ['frame', 'agent_id'] + self.TIMESTAMPS + [f'{name}_ms' for name, _, _, _ in self.STAGES]
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for row in rows:
+                writer.writerow([row['frame'], row['agent_id']] + [row[key] for key in self.TIMESTAMPS] +
+                                [row[name] for name, _, _, _ in self.STAGES])
+        return len(rows)
+
+
+class FrameDecoder:
+    """视频帧解码线程：在GUI线程之外解码、合成图块并缩放到显示尺寸
+
+    接收线程调用submit()入队，解码线程每次取出全部积压的帧:
+      - 最后一个整帧（普通JPEG帧或关键帧）之前的帧直接丢弃，不解码
+      - 之后的图块增量帧按顺序绘制到画布上（增量帧依赖前一帧，不能跳过）
+      - 只把最终画面缩放一次，通过on_frame交给GUI线程，GUI线程只需替换pixmap
+    """
+
+    def __init__(self, on_frame, on_gap):
+        self.on_frame = on_frame  # on_frame(dict): 解码完成，dict含image/size/agent_id/frame/decode_time/generation
+        self.on_gap = on_gap      # on_gap(agent_id): 增量帧不连续，需要整帧
+        self.cond = threading.Condition()
+        self.pending = []         # [(帧消息, 图像字段, agent_id, 入队时间)]
+        self.target_size = (800, 600)  # 显示尺寸，由GUI线程更新
+        self.canvas = None        # 图块合成画布（原始尺寸）
+        self.seq = None           # 画布上最近一帧的序号
+        self.generation = 0       # reset()后加1，丢弃旧视频流的结果
+        self.dropped = 0          # 积压时未解码直接丢弃的帧数
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, frame, image, agent_id):
+        """接收线程调用：帧入队"""
+        with self.cond:
+            self.pending.append((frame, image, agent_id, time.time()))
+            self.cond.notify()
+
+    def reset(self):
+        """清除积压的帧和合成状态（停止或重新开始视频时）"""
+        with self.cond:
+            self.pending = []
+            self.canvas = None
+            self.seq = None
+            self.generation += 1
+            self.dropped = 0
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                items, self.pending = self.pending, []
+                canvas, seq, generation = self.canvas, self.seq, self.generation
+            try:
+                result = self.decode(items, canvas, seq)
+            except Exception as e:
+                print(f"视频帧解码错误: {e}")
+                continue
+            if result is None:
+                continue
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                self.canvas, self.seq = result['canvas'], result['seq']
+            if result['image'] is not None:
+                result['generation'] = generation
+                self.on_frame(result)
+
+    @staticmethod
+    def is_full_frame(frame):
+        return frame.get('codec') != CODEC_TILES or frame.get('keyframe')
+
+    def decode(self, items, canvas, seq):
+        """解码一批帧，返回新的合成状态和缩放好的最终画面"""
+        start = 0
+        for i, (frame, _, _, _) in enumerate(items):
+            if self.is_full_frame(frame):
+                start = i
+        self.dropped += start
+
+        shown = None
+        for frame, image, agent_id, queued_at in items[start:]:
+            data = payload_bytes(image)
+            if self.is_full_frame(frame):
+                decoded = QImage.fromData(data)
+                if decoded.isNull():
+                    continue
+                if frame.get('codec') == CODEC_TILES:
+                    canvas = decoded.convertToFormat(QImage.Format_RGB32)
+                else:
+                    canvas = decoded
+                    seq = None
+            else:
+                # 增量帧必须紧接在已显示的帧之后，中间有帧被丢弃时请求整帧
+                if canvas is None or seq is None or frame.get('frame') != seq + 1:
+                    self.on_gap(agent_id)
+                    continue
+                painter = QPainter(canvas)
+                for x, y, w, h, offset, length in frame.get('tiles', []):
+                    painter.drawImage(x, y, QImage.fromData(data[offset:offset + length]))
+                painter.end()
+            if frame.get('codec') == CODEC_TILES:
+                seq = frame.get('frame')
+            shown = (frame, agent_id, queued_at)
+
+        if shown is None:
+            return {'canvas': canvas, 'seq': seq, 'image': None}
+        frame, agent_id, queued_at = shown
+        width, height = self.target_size
+        return {
+            'canvas': canvas,
+            'seq': seq,
+            'image': canvas.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation),
+            'size': (canvas.width(), canvas.height()),
+            'agent_id': agent_id,
+            'frame': frame,
+            'decode_time': time.time() - queued_at,  # 含排队等待的时间
+            'decoded_at': time.time(),
+        }
+
+
 class ControllerGUI(QMainWindow):
     # 定义信号
     update_host_list_signal = pyqtSignal(list)
     update_image_signal = pyqtSignal(bytes, str)
+    video_frame_ready_signal = pyqtSignal(object)  # 解码线程完成一帧 (FrameDecoder的结果dict)
     update_log_signal = pyqtSignal(str)
     update_file_list_signal = pyqtSignal(str, list)  # 文件列表更新信号
     show_file_content_signal = pyqtSignal(str, str, str)  # 显示文件内容信号 (filepath, filename, content)
     reconnect_success_signal = pyqtSignal()  # 重连成功信号
+    update_thumbnails_signal = pyqtSignal(object, bytes)  # 屏幕墙缩略图批次信号 (索引, 首尾相接的JPEG)
+    transfer_progress_signal = pyqtSignal(str, object, object)  # 传输进度信号 (说明, 已完成字节, 总字节)，已完成<0表示结束
+    command_finished_signal = pyqtSignal(object, str)  # 某台主机的命令结束 (request_id, agent_id)
+    job_status_signal = pyqtSignal(object)  # 批量任务进度摘要 (job_status消息)
+    job_group_signal = pyqtSignal(object)  # 批量任务某一组的完整输出 (job_group消息)
 
     def __init__(self):
         super().__init__()
         self.server_ip = None
         self.server_port = 5000
         self.sock = None
+        self.send_lock = threading.Lock()  # GUI线程和接收线程都会发送，整帧发送需互斥
+        self.peer_protocol = LEGACY_PROTOCOL  # 与服务器协商的协议版本
         self.connected = False
         self.auto_reconnect = True  # 自动重连标志
 
@@ -48,30 +287,72 @@ class ControllerGUI(QMainWindow):
         # 当前主机列表
         self.current_hosts = []
 
-        # 视频质量设置
-        self.video_quality = 'medium'
+        # 视频质量设置（auto: 被控端按延迟自动调整）
+        self.video_quality = 'auto'
 
         # 鼠标键盘控制模式
         self.remote_control_mode = False
         self.keyboard_control_mode = False
+        # 鼠标移动限频发送：间隔内只记下最新位置，到时间发送最新的一个
+        self.mouse_move_hz = self.load_mouse_move_hz()
+        self.pending_mouse_move = None  # (targets, x, y)
+        self.mouse_move_sent_at = 0
 
         # 视频流状态
         self.video_streaming = False
         self.current_video_target = None
 
+        # 视频帧在解码线程中解码、合成和缩放，GUI线程只替换pixmap
+        self.video_decoder = FrameDecoder(self.video_frame_ready_signal.emit, self.request_keyframe)
+        self.latency_stats = FrameLatencyStats()  # 各阶段延迟统计，叠加显示在视频上
+        self.keyframe_requested_at = 0
+        self.video_request_id = None  # start_video的请求ID，反馈和关键帧请求沿用它
+        self.feedback_sent_at = 0
+
+        # 屏幕墙状态（只在GUI线程中访问）：最新缩略图只保存JPEG数据，滚动到可见时才解码
+        self.wall_streaming = False
+        self.wall_targets = []
+        self.wall_request_id = None
+        self.wall_items = {}    # {agent_id: QListWidgetItem}
+        self.wall_images = {}   # {agent_id: 最新缩略图JPEG}
+        self.wall_dirty = set()  # 收到新缩略图但还没解码显示的agent_id
+
+        # 正在执行的命令: {request_id: {'command': 命令, 'targets': 还没结束的agent_id集合}}，只在GUI线程中访问
+        self.running_commands = {}
+        # 批量任务结果树中的任务节点: {job_id: QTreeWidgetItem}，只在GUI线程中访问
+        self.job_items = {}
+
+        # 进行中的分块下载: {request_id: 下载状态}，在GUI线程创建，由接收线程写入文件
+        self.downloads = {}
+
+        # 进行中的分块上传: {request_id: 上传状态}，由上传线程发送，接收线程更新确认位置
+        self.uploads = {}
+        self.upload_cond = threading.Condition()
+        self.connection_seq = 0  # 每次连接成功加1，上传线程据此发现断线重连
+
         # 原始图像尺寸（用于坐标转换）
         self.original_image_width = 1920
         self.original_image_height = 1080
 
         self.init_ui()
 
+        self.mouse_move_timer = QTimer(self)
+        self.mouse_move_timer.setSingleShot(True)
+        self.mouse_move_timer.timeout.connect(self.flush_mouse_move)
+
         # 连接信号
         self.update_host_list_signal.connect(self.update_host_list)
         self.update_image_signal.connect(self.update_image)
+        self.video_frame_ready_signal.connect(self.show_video_frame)
         self.update_log_signal.connect(self.append_log)
         self.update_file_list_signal.connect(self.update_file_list)
         self.show_file_content_signal.connect(self.show_file_content)
         self.reconnect_success_signal.connect(self.on_reconnect_success)
+        self.transfer_progress_signal.connect(self.update_transfer_progress)
+        self.update_thumbnails_signal.connect(self.update_thumbnails)
+        self.command_finished_signal.connect(self.on_command_finished)
+        self.job_status_signal.connect(self.update_job_status)
+        self.job_group_signal.connect(self.show_job_group)
 
     def init_ui(self):
         """初始化UI"""
@@ -402,6 +683,13 @@ class ControllerGUI(QMainWindow):
         """)
         file_layout.addWidget(self.file_list)
 
+        # 文件传输进度（有传输时才显示）
+        self.transfer_progress = QProgressBar()
+        self.transfer_progress.setRange(0, 100)
+        self.transfer_progress.setMaximumHeight(18)
+        self.transfer_progress.hide()
+        file_layout.addWidget(self.transfer_progress)
+
         file_group.setLayout(file_layout)
         layout.addWidget(file_group)
 
@@ -497,15 +785,81 @@ class ControllerGUI(QMainWindow):
         video_layout.addWidget(self.stop_video_btn)
         control_layout.addLayout(video_layout)
 
+        # 屏幕墙按钮
+        wall_layout = QHBoxLayout()
+        self.start_wall_btn = QPushButton("🧱 屏幕墙")
+        self.start_wall_btn.setMinimumHeight(35)
+        self.start_wall_btn.setToolTip("选中的所有主机每秒发送一张缩略图，以网格显示")
+        self.start_wall_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                border: none;
+                border-radius: 5px;
+                font-weight: bold;
+                font-size: 13px;
+            }
+            QPushButton:hover {
+                background-color: #2471a3;
+            }
+            QPushButton:pressed {
+                background-color: #1f618d;
+            }
+        """)
+        self.start_wall_btn.clicked.connect(self.start_wall)
+        wall_layout.addWidget(self.start_wall_btn)
+
+        self.stop_wall_btn = QPushButton("⏹ 停止屏幕墙")
+        self.stop_wall_btn.setMinimumHeight(35)
+        self.stop_wall_btn.setToolTip("停止接收缩略图")
+        self.stop_wall_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #e74c3c;
+                color: white;
+                border: none;
+                border-radius: 5px;
+                font-weight: bold;
+                font-size: 13px;
+            }
+            QPushButton:hover {
+                background-color: #c0392b;
+            }
+            QPushButton:pressed {
+                background-color: #a93226;
+            }
+            QPushButton:disabled {
+                background-color: #bdc3c7;
+            }
+        """)
+        self.stop_wall_btn.clicked.connect(self.stop_wall)
+        self.stop_wall_btn.setEnabled(False)
+        wall_layout.addWidget(self.stop_wall_btn)
+        control_layout.addLayout(wall_layout)
+
+        # 延迟统计按钮
+        latency_layout = QHBoxLayout()
+        self.latency_btn = QPushButton("📈 延迟统计")
+        self.latency_btn.setCheckable(True)
+        self.latency_btn.setToolTip("在视频上叠加显示各阶段延迟的p50/p95/p99和丢帧数")
+        self.latency_btn.toggled.connect(self.toggle_latency_overlay)
+        latency_layout.addWidget(self.latency_btn)
+        export_latency_btn = QPushButton("💾 导出CSV")
+        export_latency_btn.setToolTip("导出每一帧的时间戳和各阶段耗时")
+        export_latency_btn.clicked.connect(self.export_latency_csv)
+        latency_layout.addWidget(export_latency_btn)
+        control_layout.addLayout(latency_layout)
+
         # 视频质量选择
         quality_layout = QHBoxLayout()
         quality_label = QLabel("📊 视频质量:")
         quality_label.setStyleSheet("font-weight: bold;")
         quality_layout.addWidget(quality_label)
         self.quality_combo = QComboBox()
-        self.quality_combo.addItems(['低 (640x480)', '中 (800x600)', '高 (1280x720)', '超高 (1920x1080 90%无损)'])
-        self.quality_combo.setCurrentIndex(1)
-        self.quality_combo.setToolTip("选择视频质量：低质量适合网络较差时使用，超高质量为90%无损画质")
+        self.quality_combo.addItems(['低 (640x480)', '中 (800x600)', '高 (1280x720)', '超高 (1920x1080 90%无损)',
+                                     '自动 (按延迟调节)'])
+        self.quality_combo.setCurrentIndex(4)
+        self.quality_combo.setToolTip("选择视频质量：低质量适合网络较差时使用，超高质量为90%无损画质，"
+                                      "自动模式根据网络延迟实时调整分辨率、画质和帧率")
         self.quality_combo.setStyleSheet("""
             QComboBox {
                 border: 2px solid #bdc3c7;
@@ -653,13 +1007,52 @@ class ControllerGUI(QMainWindow):
         scroll = QScrollArea()
         scroll.setWidget(self.image_label)
         scroll.setWidgetResizable(True)
+
+        # 延迟统计叠加层（浮在视频左上角）
+        self.latency_overlay = QLabel(scroll)
+        self.latency_overlay.setStyleSheet("""
+            QLabel {
+                background-color: rgba(0, 0, 0, 170);
+                color: #2ecc71;
+                font-family: Consolas, monospace;
+                font-size: 12px;
+                padding: 6px;
+                border-radius: 4px;
+            }
+        """)
+        self.latency_overlay.move(10, 10)
+        self.latency_overlay.hide()
+        self.latency_timer = QTimer(self)
+        self.latency_timer.timeout.connect(self.refresh_latency_overlay)
         scroll.setStyleSheet("""
             QScrollArea {
                 border: none;
                 background-color: #2c3e50;
             }
         """)
-        image_layout.addWidget(scroll)
+        # 屏幕墙：多台主机的低帧率缩略图网格
+        self.wall_list = QListWidget()
+        self.wall_list.setViewMode(QListView.IconMode)
+        self.wall_list.setIconSize(QSize(*THUMBNAIL_SETTINGS['size']))
+        self.wall_list.setResizeMode(QListView.Adjust)
+        self.wall_list.setMovement(QListView.Static)
+        self.wall_list.setUniformItemSizes(True)
+        self.wall_list.setSpacing(8)
+        self.wall_list.setStyleSheet("""
+            QListWidget {
+                background-color: #2c3e50;
+                color: #ecf0f1;
+                border: none;
+            }
+        """)
+        self.wall_list.itemDoubleClicked.connect(self.on_wall_item_double_clicked)
+        self.wall_list.verticalScrollBar().valueChanged.connect(self.refresh_wall_visible)
+
+        self.display_tabs = QTabWidget()
+        self.display_tabs.addTab(scroll, "🖥️ 单台主机")
+        self.display_tabs.addTab(self.wall_list, "🧱 屏幕墙")
+        self.display_tabs.currentChanged.connect(self.refresh_wall_visible)
+        image_layout.addWidget(self.display_tabs)
 
         image_group.setLayout(image_layout)
         layout.addWidget(image_group, 3)
@@ -760,6 +1153,14 @@ class ControllerGUI(QMainWindow):
         """)
         exec_layout.addWidget(self.admin_checkbox)
 
+        # 多台主机执行时服务器同时下发的主机数，0表示使用服务器默认值
+        exec_layout.addWidget(QLabel("并发:"))
+        self.job_concurrency_spin = QSpinBox()
+        self.job_concurrency_spin.setRange(0, 10000)
+        self.job_concurrency_spin.setSpecialValueText("默认")
+        self.job_concurrency_spin.setToolTip("多台主机执行时同时运行的主机数，其余主机排队等待")
+        exec_layout.addWidget(self.job_concurrency_spin)
+
         send_cmd_btn = QPushButton("▶️ 执行命令")
         send_cmd_btn.setMinimumHeight(35)
         send_cmd_btn.setStyleSheet("""
@@ -777,8 +1178,42 @@ class ControllerGUI(QMainWindow):
         """)
         send_cmd_btn.clicked.connect(self.send_command)
         exec_layout.addWidget(send_cmd_btn)
+
+        self.cancel_cmd_btn = QPushButton("⏹️ 停止命令")
+        self.cancel_cmd_btn.setMinimumHeight(35)
+        self.cancel_cmd_btn.setEnabled(False)
+        self.cancel_cmd_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #c0392b;
+                color: white;
+                border: none;
+                border-radius: 5px;
+                font-weight: bold;
+                font-size: 13px;
+            }
+            QPushButton:hover {
+                background-color: #a93226;
+            }
+            QPushButton:disabled {
+                background-color: #95a5a6;
+            }
+        """)
+        self.cancel_cmd_btn.clicked.connect(self.cancel_commands)
+        exec_layout.addWidget(self.cancel_cmd_btn)
         cmd_layout.addLayout(exec_layout)
 
+        # 批量任务结果：多台主机执行同一命令时由服务器按相同输出分组汇总，双击分组查看完整输出
+        job_label = QLabel("📊 批量任务结果 (双击分组查看完整输出和主机):")
+        job_label.setStyleSheet("font-weight: bold; margin-top: 5px;")
+        cmd_layout.addWidget(job_label)
+
+        self.job_tree = QTreeWidget()
+        self.job_tree.setHeaderLabels(["命令 / 输出", "主机数", "返回码"])
+        self.job_tree.setColumnWidth(0, 420)
+        self.job_tree.setMaximumHeight(180)
+        self.job_tree.itemDoubleClicked.connect(self.on_job_item_double_clicked)
+        cmd_layout.addWidget(self.job_tree)
+
         # 日志输出
         log_label = QLabel("📋 执行日志:")
         log_label.setStyleSheet("font-weight: bold; margin-top: 5px;")
@@ -978,11 +1413,13 @@ class ControllerGUI(QMainWindow):
             # 设置socket超时
             self.sock.settimeout(30)  # 30秒超时
             self.sock.connect((self.server_ip, self.server_port))
+            self.peer_protocol = LEGACY_PROTOCOL
 
             # 发送注册信息
-            self.send_json({'type': 'controller', 'action': 'register'})
+            self.send_json({'type': 'controller', 'action': 'register', 'protocol': PROTOCOL_VERSION})
 
             self.connected = True
+            self.connection_seq += 1
             self.auto_reconnect = True
             self.connect_btn.setText("🔌 断开连接")
             self.connect_btn.setStyleSheet("""
@@ -1033,6 +1470,16 @@ class ControllerGUI(QMainWindow):
         self.video_streaming = False
         self.current_video_target = None
         self.start_video_btn.setEnabled(True)
+        # 服务器在连接断开时已取消本控制端的缩略图订阅
+        self.reset_wall_state()
+
+        # 未完成的下载无法继续，清理临时文件
+        for request_id in list(self.downloads):
+            self.abort_download(request_id, '连接已断开', notify_agent=False)
+
+        # 唤醒上传线程，重连后从被控端已写入的位置续传
+        with self.upload_cond:
+            self.upload_cond.notify_all()
         self.stop_video_btn.setEnabled(False)
 
         # 清除图像显示
@@ -1080,11 +1527,13 @@ class ControllerGUI(QMainWindow):
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(30)
             self.sock.connect((self.server_ip, self.server_port))
+            self.peer_protocol = LEGACY_PROTOCOL
 
             # 发送注册信息
-            self.send_json({'type': 'controller', 'action': 'register'})
+            self.send_json({'type': 'controller', 'action': 'register', 'protocol': PROTOCOL_VERSION})
 
             self.connected = True
+            self.connection_seq += 1
 
             # 使用信号更新UI，避免跨线程访问
             self.reconnect_success_signal.emit()
@@ -1139,30 +1588,54 @@ class ControllerGUI(QMainWindow):
                         break
                     continue
 
+                if msg_type == 'welcome':
+                    # 服务器确认协议版本
+                    self.peer_protocol = negotiate(data.get('protocol'))
+                    continue
+
                 if msg_type == 'host_list':
                     hosts = data.get('hosts', [])
                     self.update_host_list_signal.emit(hosts)
 
                 elif msg_type == 'screenshot':
-                    img_b64 = data.get('image')
                     agent_id = data.get('agent_id', 'Unknown')
-                    img_data = base64.b64decode(img_b64)
+                    img_data = payload_bytes(data.get('image'))
                     self.update_image_signal.emit(img_data, agent_id)
                     self.update_log_signal.emit(f"[{agent_id}] 收到截图 ({len(img_data)} bytes)")
 
                 elif msg_type == 'video_frame':
                     # 只在视频流状态时才更新视频帧
                     if self.video_streaming:
-                        img_b64 = data.get('image')
                         agent_id = data.get('agent_id', 'Unknown')
-                        img_data = base64.b64decode(img_b64)
-                        self.update_image_signal.emit(img_data, agent_id)
+                        self.latency_stats.on_received(data)
+                        self.video_decoder.submit(data, data.get('image'), agent_id)
+
+                elif msg_type == 'thumbnail_batch':
+                    if self.wall_streaming:
+                        self.update_thumbnails_signal.emit(data.get('thumbnails', []),
+                                                           payload_bytes(data.get('image')))
+
+                elif msg_type == 'job_status':
+                    self.job_status_signal.emit(data)
+
+                elif msg_type == 'job_group':
+                    self.job_group_signal.emit(data)
+
+                elif msg_type == 'command_output':
+                    # 流式命令输出的一段
+                    agent_id = data.get('agent_id', 'Unknown')
+                    output = data.get('output', '').rstrip('\n')
+                    self.update_log_signal.emit(f"[{agent_id}] {output}")
 
                 elif msg_type == 'command_result':
                     agent_id = data.get('agent_id', 'Unknown')
                     command = data.get('command', '')
                     output = data.get('output', '')
-                    self.update_log_signal.emit(f"\n[{agent_id}] 命令: {command}\n输出:\n{output}\n{'-' * 60}")
+                    if data.get('streamed'):
+                        self.update_log_signal.emit(f"[{agent_id}] 命令: {command} - {output}\n{'-' * 60}")
+                    else:
+                        self.update_log_signal.emit(f"\n[{agent_id}] 命令: {command}\n输出:\n{output}\n{'-' * 60}")
+                    self.command_finished_signal.emit(data.get('request_id'), agent_id)
 
                 elif msg_type == 'error':
                     message = data.get('message', 'Unknown error')
@@ -1191,14 +1664,13 @@ class ControllerGUI(QMainWindow):
                     # 文件打开响应
                     filepath = data.get('filepath', '')
                     filename = data.get('filename', '')
-                    content_b64 = data.get('content', '')
                     error = data.get('error', '')
                     if error:
                         self.update_log_signal.emit(f"❌ 打开文件错误: {error}")
                     else:
                         # 解码文件内容
                         try:
-                            content = base64.b64decode(content_b64).decode('utf-8', errors='replace')
+                            content = payload_bytes(data.get('content')).decode('utf-8', errors='replace')
                             self.show_file_content_signal.emit(filepath, filename, content)
                         except Exception as e:
                             self.update_log_signal.emit(f"❌ 解码文件内容错误: {e}")
@@ -1207,15 +1679,32 @@ class ControllerGUI(QMainWindow):
                     # 文件下载响应
                     filepath = data.get('filepath', '')
                     filename = data.get('filename', '')
-                    content_b64 = data.get('content', '')
                     error = data.get('error', '')
+                    download = self.downloads.pop(data.get('request_id'), None)
                     if error:
                         self.update_log_signal.emit(f"❌ 下载文件错误: {error}")
+                    elif download:
+                        # 旧版被控端不支持分块，整个文件在一条消息里
+                        self.write_downloaded_file(download['save_path'], data.get('content'))
                     else:
-                        self.save_downloaded_file(filename, content_b64)
+                        self.save_downloaded_file(filename, data.get('content'))
+
+                elif msg_type == 'file_download_start':
+                    self.on_download_start(data)
+
+                elif msg_type == 'file_download_chunk':
+                    self.on_download_chunk(data)
+
+                elif msg_type == 'file_download_end':
+                    self.on_download_end(data)
+
+                elif msg_type in ('upload_status', 'upload_ack'):
+                    # 分块上传的续传位置或确认
+                    self.on_upload_reply(data)
 
                 elif msg_type == 'file_upload':
                     # 文件上传响应
+                    self.on_upload_reply(data)
                     filepath = data.get('filepath', '')
                     error = data.get('error', '')
                     if error:
@@ -1264,24 +1753,107 @@ class ControllerGUI(QMainWindow):
         self.host_list.clear()
         for host in hosts:
             agent_id = host['id']
-            # 优先使用本地保存的自定义名称，其次使用agent上报的名称
-            if agent_id in self.host_name_mapping:
-                display_name = self.host_name_mapping[agent_id]
-            else:
-                display_name = host.get('custom_name', host.get('hostname', 'Unknown'))
-
-            item_text = f"{display_name} ({host['ip']})"
+            item_text = f"{self.host_display_name(host)} ({host['ip']})"
             item = QListWidgetItem(item_text)
             item.setData(Qt.UserRole, agent_id)
             self.host_list.addItem(item)
 
         self.append_log(f"主机列表已更新: {len(hosts)} 台在线")
 
+    def host_display_name(self, host):
+        """主机显示名：优先使用本地保存的自定义名称，其次使用agent上报的名称"""
+        if host['id'] in self.host_name_mapping:
+            return self.host_name_mapping[host['id']]
+        return host.get('custom_name', host.get('hostname', 'Unknown'))
+
     def update_image(self, img_data, agent_id):
         """更新图像显示"""
         pixmap = QPixmap()
         pixmap.loadFromData(img_data)
+        self.show_pixmap(pixmap, agent_id)
+
+    def show_video_frame(self, result):
+        """显示解码线程准备好的视频帧（已缩放到显示尺寸）"""
+        if not self.video_streaming or result['generation'] != self.video_decoder.generation:
+            return
+        # 保存原始图像尺寸（用于坐标转换）
+        self.original_image_width, self.original_image_height = result['size']
+        self.image_label.setPixmap(QPixmap.fromImage(result['image']))
+        self.current_host_label.setText(f"当前显示: {result['agent_id']}")
+        result['frame']['decoded_at'] = result['decoded_at']
+        self.latency_stats.on_shown(result['frame'], result['agent_id'])
+        # 下一帧按当前的显示尺寸缩放
+        self.video_decoder.target_size = (self.image_label.width(), self.image_label.height())
+        self.send_video_feedback(result['frame'], result['agent_id'], result['decode_time'])
+
+    def toggle_latency_overlay(self, checked):
+        """显示/隐藏延迟统计叠加层"""
+        if checked:
+            self.refresh_latency_overlay()
+            self.latency_overlay.show()
+            self.latency_overlay.raise_()
+            self.latency_timer.start(1000)
+        else:
+            self.latency_timer.stop()
+            self.latency_overlay.hide()
+
+    def refresh_latency_overlay(self):
+        """刷新叠加层上的统计"""
+        self.latency_overlay.setText(self.latency_stats.summary(self.video_decoder.dropped))
+        self.latency_overlay.adjustSize()
+
+    def export_latency_csv(self):
+        """导出延迟统计为CSV"""
+        path, _ = QFileDialog.getSaveFileName(self, "导出延迟统计", "frame_latency.csv", "CSV文件 (*.csv)")
+        if not path:
+            return
+        try:
+            count = self.latency_stats.export_csv(path)
+            self.append_log(f"✅ 已导出 {count} 帧的延迟数据: {path}")
+        except Exception as e:
+            QMessageBox.critical(self, "错误", f"导出失败: {str(e)}")
 
+    def send_video_feedback(self, frame, agent_id, decode_time):
+        """回显帧的发送时间和本地解码耗时，被控端据此自动调整质量（每0.2秒最多一次）"""
+        if frame.get('sent_at') is None or self.video_quality != 'auto':
+            return
+        now = time.time()
+        if now - self.feedback_sent_at < 0.2:
+            return
+        self.feedback_sent_at = now
+        self.send_json({
+            'type': 'controller',
+            'action': 'video_feedback',
+            'targets': [agent_id],
+            'frame': frame.get('frame'),
+            'sent_at': frame['sent_at'],
+            'decode_ms': round(decode_time * 1000, 1),
+            'request_id': self.video_request_id
+        })
+
+    def request_keyframe(self, agent_id):
+        """请求被控端发送整帧（每秒最多一次，避免丢帧时反复请求）"""
+        now = time.time()
+        if now - self.keyframe_requested_at < 1.0:
+            return
+        self.keyframe_requested_at = now
+        self.send_json({
+            'type': 'controller',
+            'action': 'request_keyframe',
+            'targets': [agent_id],
+            'request_id': self.video_request_id
+        })
+
+    def reset_video_canvas(self):
+        """清除增量视频的合成状态"""
+        self.video_decoder.reset()
+        self.video_decoder.target_size = (self.image_label.width(), self.image_label.height())
+        self.keyframe_requested_at = 0
+        self.video_request_id = None
+        self.feedback_sent_at = 0
+
+    def show_pixmap(self, pixmap, agent_id):
+        """显示图像"""
         # 保存原始图像尺寸（用于坐标转换）
         self.original_image_width = pixmap.width()
         self.original_image_height = pixmap.height()
@@ -1345,11 +1917,16 @@ class ControllerGUI(QMainWindow):
             QMessageBox.warning(self, "提示", "视频流只能选择一台主机")
             return
 
+        self.reset_video_canvas()
+        self.latency_stats.reset()
+        self.video_request_id = uuid.uuid4().hex
         self.send_json({
             'type': 'controller',
             'action': 'start_video',
             'targets': targets,
-            'quality': self.video_quality
+            'quality': self.video_quality,
+            'codecs': [CODEC_TILES],  # 支持图块增量编码，旧版被控端会忽略
+            'request_id': self.video_request_id
         })
 
         # 设置视频流状态
@@ -1378,12 +1955,14 @@ class ControllerGUI(QMainWindow):
         self.send_json({
             'type': 'controller',
             'action': 'stop_video',
-            'targets': targets
+            'targets': targets,
+            'request_id': self.video_request_id  # 被控端按start_video的请求ID移除本控制端
         })
 
         # 重置视频流状态
         self.video_streaming = False
         self.current_video_target = None
+        self.reset_video_canvas()
 
         # 清除图像显示
         self.image_label.clear()
@@ -1395,6 +1974,99 @@ class ControllerGUI(QMainWindow):
         self.stop_video_btn.setEnabled(False)
         self.append_log(f"✅ 已停止视频流")
 
+    def start_wall(self):
+        """开始屏幕墙：选中的主机以低帧率发送缩略图，由服务器合并后每秒送达一批"""
+        targets = self.get_selected_targets()
+        if not targets:
+            return
+        if self.wall_streaming:
+            self.stop_wall()
+
+        hosts = {host['id']: host for host in self.current_hosts}
+        self.wall_list.clear()
+        self.wall_items = {}
+        self.wall_images = {}
+        self.wall_dirty = set()
+        for agent_id in targets:
+            host = hosts.get(agent_id, {'id': agent_id})
+            item = QListWidgetItem(self.host_display_name(host))
+            item.setData(Qt.UserRole, agent_id)
+            item.setSizeHint(QSize(THUMBNAIL_SETTINGS['size'][0] + 16, THUMBNAIL_SETTINGS['size'][1] + 36))
+            self.wall_list.addItem(item)
+            self.wall_items[agent_id] = item
+
+        self.wall_request_id = uuid.uuid4().hex
+        self.send_json({
+            'type': 'controller',
+            'action': 'start_thumbnails',
+            'targets': targets,
+            'size': list(THUMBNAIL_SETTINGS['size']),
+            'quality': THUMBNAIL_SETTINGS['quality'],
+            'fps': THUMBNAIL_SETTINGS['fps'],
+            'request_id': self.wall_request_id
+        })
+        self.wall_streaming = True
+        self.wall_targets = targets
+        self.display_tabs.setCurrentWidget(self.wall_list)
+        self.start_wall_btn.setEnabled(False)
+        self.stop_wall_btn.setEnabled(True)
+        self.append_log(f"已开始屏幕墙: {len(targets)} 台主机")
+
+    def stop_wall(self):
+        """停止屏幕墙（保留最后一批缩略图）"""
+        if self.wall_targets and self.connected:
+            self.send_json({
+                'type': 'controller',
+                'action': 'stop_thumbnails',
+                'targets': self.wall_targets,
+                'request_id': self.wall_request_id
+            })
+        self.reset_wall_state()
+        self.append_log("✅ 已停止屏幕墙")
+
+    def reset_wall_state(self):
+        """重置屏幕墙状态和按钮"""
+        self.wall_streaming = False
+        self.wall_targets = []
+        self.wall_request_id = None
+        self.start_wall_btn.setEnabled(True)
+        self.stop_wall_btn.setEnabled(False)
+
+    def update_thumbnails(self, index, data):
+        """收到一批缩略图：只保存数据，可见的格子立即解码，其余的滚动到可见时再解码"""
+        if not self.wall_streaming:
+            return
+        for agent_id, offset, length, sent_at in index:
+            if agent_id in self.wall_items:
+                self.wall_images[agent_id] = data[offset:offset + length]
+                self.wall_dirty.add(agent_id)
+        self.refresh_wall_visible()
+
+    def refresh_wall_visible(self, *args):
+        """解码当前可见且有新缩略图的格子"""
+        if not self.wall_dirty or self.display_tabs.currentWidget() is not self.wall_list:
+            return
+        viewport = self.wall_list.viewport().rect()
+        for agent_id in list(self.wall_dirty):
+            item = self.wall_items.get(agent_id)
+            if item is None:
+                self.wall_dirty.discard(agent_id)
+                continue
+            if not self.wall_list.visualItemRect(item).intersects(viewport):
+                continue
+            pixmap = QPixmap()
+            pixmap.loadFromData(self.wall_images[agent_id])
+            item.setIcon(QIcon(pixmap))
+            self.wall_dirty.discard(agent_id)
+
+    def on_wall_item_double_clicked(self, item):
+        """双击屏幕墙中的主机：在主机列表中选中它并切换到单台主机显示"""
+        agent_id = item.data(Qt.UserRole)
+        for row in range(self.host_list.count()):
+            host_item = self.host_list.item(row)
+            host_item.setSelected(host_item.data(Qt.UserRole) == agent_id)
+        self.display_tabs.setCurrentIndex(0)
+
     def send_command(self):
         """发送命令"""
         targets = self.get_selected_targets()
@@ -1408,26 +2080,161 @@ class ControllerGUI(QMainWindow):
 
         as_admin = self.admin_checkbox.isChecked()
 
-        self.send_json({
+        request_id = uuid.uuid4().hex
+        if len(targets) > 1:
+            # 多台主机：由服务器创建批量任务，按并发限制分批下发，结果按相同输出分组汇总到结果树，不逐台写日志
+            message = {'action': 'run_job'}
+            if self.job_concurrency_spin.value():
+                message['concurrency'] = self.job_concurrency_spin.value()
+        else:
+            # 单台主机：输出由被控端以command_output陆续发回，结束时再收到command_result
+            message = {'action': 'run_command', 'stream': True}
+        message.update({
             'type': 'controller',
-            'action': 'run_command',
             'targets': targets,
             'command': command,
-            'as_admin': as_admin
+            'as_admin': as_admin,
+            'request_id': request_id
         })
+        if not self.send_json(message):
+            return
+        self.running_commands[request_id] = {'command': command, 'targets': set(targets)}
+        self.cancel_cmd_btn.setEnabled(True)
 
         admin_text = " (管理员权限)" if as_admin else ""
         self.append_log(f"已发送命令到 {len(targets)} 台主机{admin_text}: {command}")
         self.cmd_input.clear()
 
+    def cancel_commands(self):
+        """结束所有还在执行的命令"""
+        for request_id, running in self.running_commands.items():
+            self.send_json({
+                'type': 'controller',
+                'action': 'cancel_command',
+                'targets': sorted(running['targets']),
+                'request_id': request_id
+            })
+            self.append_log(f"⏹️ 已请求停止命令: {running['command']} ({len(running['targets'])} 台主机)")
+
+    def on_command_finished(self, request_id, agent_id):
+        """某台主机的命令已结束（在GUI线程中调用）"""
+        running = self.running_commands.get(request_id)
+        if running is None:
+            return
+        running['targets'].discard(agent_id)
+        if not running['targets']:
+            del self.running_commands[request_id]
+        self.cancel_cmd_btn.setEnabled(bool(self.running_commands))
+
+    def update_job_status(self, data):
+        """更新结果树中的批量任务（在GUI线程中调用）"""
+        job_id = data.get('job_id')
+        total = data.get('total', 0)
+        done = data.get('completed', total - data.get('running', 0))
+        item = self.job_items.get(job_id)
+        if item is None:
+            # 新任务放在最上面，只保留最近的若干个
+            item = QTreeWidgetItem()
+            item.setData(0, Qt.UserRole, job_id)
+            self.job_tree.insertTopLevelItem(0, item)
+            self.job_items[job_id] = item
+            while self.job_tree.topLevelItemCount() > MAX_JOB_ITEMS:
+                oldest = self.job_tree.takeTopLevelItem(self.job_tree.topLevelItemCount() - 1)
+                self.job_items.pop(oldest.data(0, Qt.UserRole), None)
+        finished = data.get('finished')
+        if finished:
+            state = f"完成 {done}/{total}"
+        else:
+            state = f"执行中 {done}/{total}, 运行 {data.get('running', 0)}, 排队 {data.get('pending', 0)}"
+            if data.get('waiting'):
+                state += f", 等待重连 {data['waiting']}"
+        item.setText(0, f"{data.get('command', '')}  [{state}]")
+        item.setText(1, str(total))
+
+        item.takeChildren()
+        for group in data.get('groups', []):
+            preview = group.get('preview', '').strip().replace('\r', '').replace('\n', ' ⏎ ')
+            status = {'ok': '✅', 'error': '❌', 'offline': '⚪', 'failed': '⚠️', 'cancelled': '🚫'}.get(group.get('status'), '')
+            child = QTreeWidgetItem(item, [f"{status} {preview}", str(group.get('count', 0)),
+                                           '' if group.get('returncode') is None else str(group['returncode'])])
+            child.setData(0, Qt.UserRole, job_id)
+            child.setData(1, Qt.UserRole, group.get('group'))
+        item.setExpanded(True)
+
+        if finished and job_id in self.running_commands:
+            del self.running_commands[job_id]
+            self.cancel_cmd_btn.setEnabled(bool(self.running_commands))
+            parts = []
+            for group in data.get('groups', []):
+                lines = group.get('preview', '').strip().splitlines()
+                parts.append(f"{group.get('count', 0)} 台: {lines[0][:40] if lines else '(无输出)'}")
+            summary = "; ".join(parts)
+            self.append_log(f"📊 批量任务完成: {data.get('command', '')} ({total} 台主机) - {summary}")
+
+    def on_job_item_double_clicked(self, item, column):
+        """双击分组，向服务器请求该组的完整输出和主机列表"""
+        group = item.data(1, Qt.UserRole)
+        if group is None:
+            return
+        self.send_json({'type': 'controller', 'action': 'job_group',
+                        'job_id': item.data(0, Qt.UserRole), 'group': group})
+
+    def show_job_group(self, data):
+        """显示批量任务某一组的完整输出和主机列表"""
+        names = {host['id']: self.host_display_name(host) for host in self.current_hosts}
+        hosts = [f"{names[agent_id]} ({agent_id})" if agent_id in names else agent_id
+                 for agent_id in data.get('hosts', [])]
+
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f"批量任务结果 - {data.get('command', '')}")
+        dialog.resize(800, 600)
+        layout = QVBoxLayout(dialog)
+
+        returncode = data.get('returncode')
+        info = QLabel(f"💻 命令: {data.get('command', '')}    主机数: {len(hosts)}"
+                      + ("" if returncode is None else f"    返回码: {returncode}"))
+        info.setStyleSheet("font-weight: bold; padding: 5px;")
+        layout.addWidget(info)
+
+        splitter = QSplitter(Qt.Horizontal)
+        host_list = QListWidget()
+        host_list.addItems(hosts)
+        splitter.addWidget(host_list)
+        output_edit = QTextEdit()
+        output_edit.setPlainText(data.get('output', ''))
+        output_edit.setReadOnly(True)
+        output_edit.setStyleSheet("font-family: 'Consolas', 'Monaco', monospace; font-size: 10pt;")
+        splitter.addWidget(output_edit)
+        splitter.setSizes([240, 560])
+        layout.addWidget(splitter)
+
+        button_layout = QHBoxLayout()
+        copy_hosts_btn = QPushButton("📋 复制主机ID")
+        copy_hosts_btn.clicked.connect(lambda: QApplication.clipboard().setText('\n'.join(data.get('hosts', []))))
+        button_layout.addWidget(copy_hosts_btn)
+        copy_output_btn = QPushButton("📋 复制输出")
+        copy_output_btn.clicked.connect(lambda: QApplication.clipboard().setText(data.get('output', '')))
+        button_layout.addWidget(copy_output_btn)
+        button_layout.addStretch()
+        close_btn = QPushButton("关闭")
+        close_btn.clicked.connect(dialog.close)
+        button_layout.addWidget(close_btn)
+        layout.addLayout(button_layout)
+        dialog.exec_()
+
     def send_json(self, data):
-        """发送JSON数据"""
+        """发送JSON数据
+
+        控制命令会自动附带唯一的request_id，服务器据此把被控端的回复只发回本控制端
+        """
         try:
             if not self.sock:
                 return False
-            msg = json.dumps(data).encode('utf-8')
-            length = len(msg)
-            self.sock.sendall(length.to_bytes(4, 'big') + msg)
+            if data.get('action') and 'request_id' not in data:
+                data['request_id'] = uuid.uuid4().hex
+            frame = encode_message(data, self.peer_protocol)
+            with self.send_lock:
+                self.sock.sendall(frame)
             return True
         except Exception as e:
             # 使用信号发送日志，避免线程安全问题
@@ -1435,22 +2242,14 @@ class ControllerGUI(QMainWindow):
             return False
 
     def recv_json(self):
-        """接收JSON数据"""
-        try:
-            raw_len = self.sock.recv(4)
-            if not raw_len or len(raw_len) < 4:
-                return None
-
-            msg_len = int.from_bytes(raw_len, 'big')
+        """接收一条消息（兼容JSON帧和二进制帧）
 
-            msg = b''
-            while len(msg) < msg_len:
-                chunk = self.sock.recv(min(msg_len - len(msg), 4096))
-                if not chunk:
-                    return None
-                msg += chunk
-
-            return json.loads(msg.decode('utf-8'))
+        等待超时抛出socket.timeout，由接收循环继续等待
+        """
+        try:
+            return recv_message(self.sock)
+        except socket.timeout:
+            raise
         except Exception as e:
             return None
 
@@ -1467,6 +2266,16 @@ class ControllerGUI(QMainWindow):
                 "查看磁盘信息": "wmic logicaldisk get name,size,freespace"
             }
 
+    def load_mouse_move_hz(self):
+        """从config.ini读取鼠标移动的最大发送频率"""
+        try:
+            import configparser
+            config = configparser.ConfigParser()
+            config.read('config.ini', encoding='utf-8')
+            return config.getfloat('controller', 'mouse_move_hz', fallback=MOUSE_MOVE_MAX_HZ)
+        except Exception:
+            return MOUSE_MOVE_MAX_HZ
+
     def save_custom_commands(self):
         """保存自定义命令"""
         try:
@@ -1557,7 +2366,7 @@ class ControllerGUI(QMainWindow):
 
     def on_quality_changed(self, index):
         """视频质量改变"""
-        quality_map = {0: 'low', 1: 'medium', 2: 'high', 3: 'ultra'}
+        quality_map = {0: 'low', 1: 'medium', 2: 'high', 3: 'ultra', 4: 'auto'}
         self.video_quality = quality_map[index]
 
     def toggle_remote_control(self):
@@ -1581,6 +2390,10 @@ class ControllerGUI(QMainWindow):
         else:
             self.keyboard_control_btn.setText("⌨️ 键盘控制")
             self.append_log("❌ 远程键盘控制已禁用")
+            # 丢弃被控端还没输入完的内容
+            selected = self.get_selected_targets(show_warning=False)
+            if selected:
+                self.send_json({'type': 'controller', 'action': 'cancel_input', 'targets': selected})
 
     def on_image_mouse_press(self, event):
         """图像区域鼠标按下"""
@@ -1596,6 +2409,10 @@ class ControllerGUI(QMainWindow):
         if x is None:
             return
 
+        # 点击带有自己的坐标，还没发出的移动已经过时，丢弃以免点击后光标被拉回
+        self.pending_mouse_move = None
+        self.mouse_move_timer.stop()
+
         # 发送鼠标点击（包含坐标）
         button = 'left' if event.button() == Qt.LeftButton else 'right'
         self.send_json({
@@ -1622,11 +2439,29 @@ class ControllerGUI(QMainWindow):
         if x is None:
             return
 
-        # 发送鼠标移动
+        # 限频发送鼠标移动，最新位置优先
+        self.pending_mouse_move = (selected, x, y)
+        if self.mouse_move_timer.isActive():
+            return
+        wait = 0
+        if self.mouse_move_hz > 0:
+            wait = self.mouse_move_sent_at + 1.0 / self.mouse_move_hz - time.time()
+        if wait <= 0:
+            self.flush_mouse_move()
+        else:
+            self.mouse_move_timer.start(int(wait * 1000) + 1)
+
+    def flush_mouse_move(self):
+        """发送最新的待发鼠标移动"""
+        if self.pending_mouse_move is None:
+            return
+        targets, x, y = self.pending_mouse_move
+        self.pending_mouse_move = None
+        self.mouse_move_sent_at = time.time()
         self.send_json({
             'type': 'controller',
             'action': 'mouse_move',
-            'targets': selected,
+            'targets': targets,
             'x': x,
             'y': y
         })
@@ -1640,6 +2475,10 @@ class ControllerGUI(QMainWindow):
         if len(selected) != 1:
             return
 
+        # 先发出待发的移动，保证滚轮在最新位置生效
+        self.mouse_move_timer.stop()
+        self.flush_mouse_move()
+
         # 发送滚轮事件
         delta = event.angleDelta().y() // 120
         self.send_json({
@@ -2002,7 +2841,7 @@ class ControllerGUI(QMainWindow):
             self.append_log(f"❌ 打开文件错误: {e}")
 
     def download_file(self, data):
-        """下载文件"""
+        """下载文件（先选择保存位置，被控端分块发送，边收边写入磁盘）"""
         try:
             selected = self.get_selected_targets(show_warning=False)
             if len(selected) != 1:
@@ -2018,24 +2857,176 @@ class ControllerGUI(QMainWindow):
 
             filepath = os.path.join(path, name)
 
+            # 在GUI线程中选择保存位置，接收线程收到数据后直接写入
+            save_path, _ = QFileDialog.getSaveFileName(self, "保存文件", name)
+            if not save_path:
+                return
+
+            request_id = uuid.uuid4().hex
+            self.downloads[request_id] = {
+                'agent_id': selected[0],
+                'filepath': filepath,
+                'save_path': save_path,
+                'part_path': save_path + '.part',
+                'file': None,
+                'size': 0,
+                'received': 0,
+                'sha256': hashlib.sha256(),
+                'last_progress': 0
+            }
+
             self.send_json({
                 'type': 'controller',
                 'action': 'download_file',
                 'targets': selected,
-                'filepath': filepath
+                'filepath': filepath,
+                'chunked': True,
+                'chunk_size': FILE_CHUNK_SIZE,
+                'window': FILE_WINDOW,
+                'request_id': request_id
             })
 
             self.append_log(f"⬇️ 正在下载: {filepath}")
         except Exception as e:
             self.append_log(f"❌ 下载文件错误: {e}")
 
-    def save_downloaded_file(self, filename, content_b64):
+    def on_download_start(self, data):
+        """分块下载开始：创建临时文件"""
+        download = self.downloads.get(data.get('request_id'))
+        if not download:
+            return
+        try:
+            download['size'] = data.get('size', 0)
+            download['file'] = open(download['part_path'], 'wb')
+            self.update_log_signal.emit(
+                f"⬇️ 开始接收: {download['filepath']} ({self.format_file_size(download['size'])})")
+            self.transfer_progress_signal.emit(os.path.basename(download['save_path']), 0, download['size'])
+        except Exception as e:
+            self.abort_download(data.get('request_id'), f'创建文件失败: {e}')
+
+    def on_download_chunk(self, data):
+        """收到一个数据块：校验偏移量和crc32后写入并确认"""
+        request_id = data.get('request_id')
+        download = self.downloads.get(request_id)
+        if not download or download['file'] is None:
+            return
+
+        chunk = payload_bytes(data.get('data'))
+        if data.get('offset') != download['received']:
+            self.abort_download(request_id, f"数据块偏移量不连续 ({data.get('offset')} != {download['received']})")
+            return
+        if zlib.crc32(chunk) != data.get('crc32'):
+            self.abort_download(request_id, f"数据块校验失败 (偏移量 {download['received']})")
+            return
+
+        try:
+            download['file'].write(chunk)
+        except Exception as e:
+            self.abort_download(request_id, f'写入文件失败: {e}')
+            return
+        download['sha256'].update(chunk)
+        download['received'] += len(chunk)
+
+        # 确认已收到的数据，被控端据此继续发送后续的块
+        self.send_json({
+            'type': 'controller',
+            'action': 'download_ack',
+            'targets': [download['agent_id']],
+            'offset': download['received'],
+            'request_id': request_id
+        })
+
+        # 限制进度刷新频率
+        now = time.time()
+        if now - download['last_progress'] >= 0.2:
+            download['last_progress'] = now
+            self.transfer_progress_signal.emit(
+                os.path.basename(download['save_path']), download['received'], download['size'])
+
+    def on_download_end(self, data):
+        """分块下载结束：核对大小和sha256后把临时文件改名为目标文件"""
+        request_id = data.get('request_id')
+        download = self.downloads.get(request_id)
+        if not download:
+            return
+
+        error = data.get('error')
+        if error:
+            self.abort_download(request_id, error, notify_agent=False)
+            return
+        if download['file'] is None:
+            self.abort_download(request_id, '未收到下载开始消息', notify_agent=False)
+            return
+
+        self.downloads.pop(request_id, None)
+        try:
+            download['file'].close()
+            if download['received'] != data.get('size'):
+                raise ValueError(f"文件大小不一致 ({download['received']} != {data.get('size')})")
+            if download['sha256'].hexdigest() != data.get('sha256'):
+                raise ValueError('sha256校验失败')
+            os.replace(download['part_path'], download['save_path'])
+            self.update_log_signal.emit(f"✅ 文件已保存: {download['save_path']}")
+        except Exception as e:
+            self.remove_file_quietly(download['part_path'])
+            self.update_log_signal.emit(f"❌ 下载文件错误: {e}")
+        self.transfer_progress_signal.emit('', -1, 0)
+
+    def abort_download(self, request_id, reason, notify_agent=True):
+        """中止分块下载：关闭并删除临时文件，需要时通知被控端停止发送"""
+        download = self.downloads.pop(request_id, None)
+        if not download:
+            return
+        if download['file'] is not None:
+            try:
+                download['file'].close()
+            except:
+                pass
+            self.remove_file_quietly(download['part_path'])
+        if notify_agent:
+            self.send_json({
+                'type': 'controller',
+                'action': 'cancel_download',
+                'targets': [download['agent_id']],
+                'request_id': request_id
+            })
+        self.update_log_signal.emit(f"❌ 下载失败: {download['filepath']} - {reason}")
+        self.transfer_progress_signal.emit('', -1, 0)
+
+    def remove_file_quietly(self, path):
+        """删除文件，忽略错误"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def update_transfer_progress(self, text, done, total):
+        """更新文件传输进度条，done<0时隐藏"""
+        if done < 0:
+            self.transfer_progress.hide()
+            return
+        percent = int(done * 100 / total) if total else 100
+        self.transfer_progress.setValue(percent)
+        self.transfer_progress.setFormat(
+            f"{text}  {self.format_file_size(done)} / {self.format_file_size(total)}  %p%")
+        self.transfer_progress.show()
+
+    def write_downloaded_file(self, save_path, content):
+        """把一次性收到的文件内容写入已选择的保存位置"""
+        try:
+            with open(save_path, 'wb') as f:
+                f.write(payload_bytes(content))
+            self.update_log_signal.emit(f"✅ 文件已保存: {save_path}")
+        except Exception as e:
+            self.update_log_signal.emit(f"❌ 保存文件错误: {e}")
+
+    def save_downloaded_file(self, filename, content):
         """保存下载的文件"""
         try:
             # 弹出保存对话框
             save_path, _ = QFileDialog.getSaveFileName(self, "保存文件", filename)
             if save_path:
-                content = base64.b64decode(content_b64)
+                content = payload_bytes(content)
                 with open(save_path, 'wb') as f:
                     f.write(content)
                 self.append_log(f"✅ 文件已保存: {save_path}")
@@ -2043,7 +3034,7 @@ class ControllerGUI(QMainWindow):
             self.append_log(f"❌ 保存文件错误: {e}")
 
     def upload_file(self, remote_path):
-        """上传文件"""
+        """上传文件（支持分块上传的被控端断线后可续传）"""
         selected = self.get_selected_targets(show_warning=False)
         if len(selected) != 1:
             return
@@ -2054,24 +3045,172 @@ class ControllerGUI(QMainWindow):
             return
 
         try:
-            with open(local_file, 'rb') as f:
-                content_b64 = base64.b64encode(f.read()).decode('utf-8')
-
             filename = os.path.basename(local_file)
             remote_filepath = os.path.join(remote_path, filename)
 
-            self.send_json({
-                'type': 'controller',
-                'action': 'upload_file',
-                'targets': selected,
-                'filepath': remote_filepath,
-                'content': content_b64
-            })
+            host = next((h for h in self.current_hosts if h['id'] == selected[0]), {})
+            if host.get('protocol', LEGACY_PROTOCOL) < 2:
+                # 旧版被控端只支持整个文件一次发送
+                with open(local_file, 'rb') as f:
+                    content = f.read()
+
+                self.send_json({
+                    'type': 'controller',
+                    'action': 'upload_file',
+                    'targets': selected,
+                    'filepath': remote_filepath,
+                    'content': content
+                })
+            else:
+                request_id = uuid.uuid4().hex
+                upload = {
+                    'request_id': request_id,
+                    'agent_id': selected[0],
+                    'local_path': local_file,
+                    'filepath': remote_filepath,
+                    'size': os.path.getsize(local_file),
+                    'sha256': None,
+                    'offset': None,    # 被控端回复的续传位置
+                    'acked': 0,        # 被控端确认已写入的字节数
+                    'rewind': False,   # 收到upload_status后需要从offset处重发
+                    'result': None     # 被控端最终的file_upload回复
+                }
+                with self.upload_cond:
+                    self.uploads[request_id] = upload
+                threading.Thread(target=self.run_upload, args=(upload,), daemon=True).start()
 
             self.append_log(f"⬆️ 正在上传: {filename} -> {remote_filepath}")
         except Exception as e:
             self.append_log(f"❌ 上传文件错误: {e}")
 
+    def run_upload(self, upload):
+        """上传线程：计算sha256后分块发送，断线或超时后从被控端已写入的位置继续"""
+        try:
+            sha256 = hashlib.sha256()
+            with open(upload['local_path'], 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(block)
+            upload['sha256'] = sha256.hexdigest()
+
+            attempts = 0
+            while upload['result'] is None:
+                if not self.connected:
+                    # 等待自动重连
+                    if not self.auto_reconnect:
+                        raise ConnectionError('连接已断开')
+                    time.sleep(1)
+                    continue
+                attempts += 1
+                if attempts > UPLOAD_MAX_ATTEMPTS:
+                    raise ConnectionError(f'重试{UPLOAD_MAX_ATTEMPTS}次后仍未完成')
+                if attempts > 1:
+                    self.update_log_signal.emit(f"🔄 续传: {upload['filepath']} (第{attempts}次尝试)")
+                self.send_upload(upload)
+
+            error = upload['result'].get('error')
+            if error:
+                self.update_log_signal.emit(f"❌ 上传失败: {upload['filepath']} - {error}")
+        except Exception as e:
+            self.update_log_signal.emit(f"❌ 上传失败: {upload['filepath']} - {e}")
+        finally:
+            with self.upload_cond:
+                self.uploads.pop(upload['request_id'], None)
+            self.transfer_progress_signal.emit('', -1, 0)
+
+    def send_upload(self, upload):
+        """在当前连接上进行一次上传尝试，连接断开或等待超时时返回，由run_upload重试"""
+        seq = self.connection_seq
+        name = os.path.basename(upload['local_path'])
+
+        def wait_for(predicate):
+            """等待接收线程更新上传状态，超时或连接变化返回False（调用方需持有upload_cond）"""
+            deadline = time.time() + UPLOAD_REPLY_TIMEOUT
+            while not predicate():
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.connected or self.connection_seq != seq:
+                    return False
+                self.upload_cond.wait(remaining)
+            return True
+
+        def send(message):
+            message.update({'type': 'controller', 'targets': [upload['agent_id']],
+                            'filepath': upload['filepath'], 'request_id': upload['request_id']})
+            return self.send_json(message)
+
+        # 询问续传位置
+        with self.upload_cond:
+            upload['offset'] = None
+            upload['rewind'] = False
+        if not send({'action': 'upload_start', 'size': upload['size'], 'sha256': upload['sha256']}):
+            return
+        with self.upload_cond:
+            if not wait_for(lambda: upload['offset'] is not None or upload['result'] is not None):
+                return
+            if upload['result'] is not None:
+                return
+            position = upload['offset']
+            upload['acked'] = position
+            upload['rewind'] = False
+
+        window = FILE_CHUNK_SIZE * FILE_WINDOW
+        last_progress = 0
+        with open(upload['local_path'], 'rb') as f:
+            while True:
+                with self.upload_cond:
+                    # 在途数据不超过窗口；全部发完后等待最后的确认
+                    if not wait_for(lambda: upload['rewind'] or upload['result'] is not None
+                                    or upload['acked'] >= upload['size']
+                                    or (position < upload['size'] and position - upload['acked'] < window)):
+                        return
+                    if upload['result'] is not None:
+                        return
+                    if upload['rewind']:
+                        # 被控端要求从它的当前位置重发
+                        position = upload['offset']
+                        upload['acked'] = position
+                        upload['rewind'] = False
+                    if upload['acked'] >= upload['size']:
+                        break
+                    acked = upload['acked']
+
+                now = time.time()
+                if now - last_progress >= 0.2:
+                    last_progress = now
+                    self.transfer_progress_signal.emit(name, acked, upload['size'])
+
+                f.seek(position)
+                chunk = f.read(FILE_CHUNK_SIZE)
+                if not chunk:
+                    # 本地文件在上传过程中变短了
+                    raise ValueError('本地文件已被修改')
+                if not send({'action': 'upload_chunk', 'offset': position,
+                             'crc32': zlib.crc32(chunk), 'data': chunk}):
+                    return
+                position += len(chunk)
+
+        self.transfer_progress_signal.emit(name, upload['size'], upload['size'])
+        if not send({'action': 'upload_finish'}):
+            return
+        with self.upload_cond:
+            # 被控端核对sha256，大文件需要一些时间
+            wait_for(lambda: upload['result'] is not None)
+
+    def on_upload_reply(self, data):
+        """接收线程：更新分块上传的续传位置、确认偏移量或最终结果"""
+        with self.upload_cond:
+            upload = self.uploads.get(data.get('request_id'))
+            if upload is None:
+                return
+            msg_type = data.get('type')
+            if msg_type == 'upload_status':
+                upload['offset'] = data.get('offset', 0)
+                upload['rewind'] = True
+            elif msg_type == 'upload_ack':
+                upload['acked'] = max(upload['acked'], data.get('offset', 0))
+            else:
+                upload['result'] = data
+            self.upload_cond.notify_all()
+
     def delete_file(self, data):
         """删除文件"""
         try:
@@ -0,0 +1,169 @@
+"""
+远程控制系统 - 画面来源
+截图和视频流通过画面来源取得每一帧，便于在没有显示器的机器上测试和测量编码性能
+
+  screen             - 截取屏幕（PIL.ImageGrab，默认）
+  synthetic:<场景>   - 合成画面，场景为 text（滚动文本）、noise（视频类噪声）、static（静止桌面）
+                       可带尺寸，如 synthetic:text:1280x720
+  replay:<路径>      - 循环回放图片文件夹（按文件名排序）或多帧图片（GIF等）
+
+每个来源提供 grab()，返回一张新的RGB图像（调用方可以原地缩放）。
+"""
+
+import os
+
+try:
+    from PIL import Image, ImageDraw, ImageSequence
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    from PIL import ImageGrab
+    IMAGEGRAB_AVAILABLE = True
+except ImportError:
+    IMAGEGRAB_AVAILABLE = False
+
+# 合成画面的默认尺寸
+SYNTHETIC_SIZE = (1920, 1080)
+
+SYNTHETIC_SCENES = ('text', 'noise', 'static')
+
+# 回放时识别的图片扩展名
+REPLAY_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+
+
+class ScreenSource:
+    """截取屏幕"""
+
+    name = 'screen'
+
+    def __init__(self):
+        if not IMAGEGRAB_AVAILABLE:
+            raise RuntimeError('PIL.ImageGrab不可用，无法截取屏幕')
+
+    def grab(self):
+        return ImageGrab.grab()
+
+
+class SyntheticSource:
+    """合成画面，画面内容只由帧序号决定，多次运行结果一致
+
+    - static: 静止的桌面和窗口，每帧相同
+    - text:   桌面上一个窗口里的文本每帧向上滚动，模拟阅读或日志输出
+    - noise:  桌面中央的播放区域每帧都是新的噪声，模拟视频播放
+    """
+
+    SCROLL_STEP = 6         # text场景每帧滚动的像素
+    LINE_HEIGHT = 18
+
+    def __init__(self, scene='text', size=SYNTHETIC_SIZE):
+        if scene not in SYNTHETIC_SCENES:
+            raise ValueError(f'未知的合成场景: {scene}（可选: {", ".join(SYNTHETIC_SCENES)}）')
+        self.scene = scene
+        self.name = f'synthetic:{scene}'
+        self.size = tuple(size)
+        self.index = 0
+        self.desktop = self.draw_desktop()
+
+        width, height = self.size
+        # 文本窗口和视频播放区域的位置
+        self.window = (width // 8, height // 8, width * 5 // 8, height * 7 // 8)
+        self.player = (width // 4, height // 4, width * 3 // 4, height * 3 // 4)
+        if scene == 'text':
+            self.text_page = self.draw_text_page()
+
+    def draw_desktop(self):
+        """桌面背景：纵向渐变加几个静止的窗口和任务栏"""
+        width, height = self.size
+        image = Image.new('RGB', self.size)
+        draw = ImageDraw.Draw(image)
+        for y in range(height):
+            shade = 60 + 80 * y // height
+            draw.line((0, y, width, y), fill=(20, shade, 120 + shade // 2))
+        for i in range(3):
+            x = width // 2 + i * width // 12
+            y = height // 10 + i * height // 10
+            draw.rectangle((x, y, x + width // 3, y + height // 3), fill=(235, 235, 235), outline=(90, 90, 90))
+            draw.rectangle((x, y, x + width // 3, y + 24), fill=(40, 90, 160))
+            for line in range(6):
+                draw.text((x + 12, y + 36 + line * 20), f'窗口 {i + 1} - 第 {line + 1} 行 static content', fill=(30, 30, 30))
+        draw.rectangle((0, height - 40, width, height), fill=(30, 30, 40))
+        return image
+
+    def draw_text_page(self):
+        """滚动文本的内容，高度为窗口的两倍，循环滚动"""
+        left, top, right, bottom = self.window
+        width, height = right - left, (bottom - top) * 2
+        page = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(page)
+        for line in range(height // self.LINE_HEIGHT):
+            text = f'{line:05d}  INFO  worker-{line % 7} processed batch {line * 37 % 1000} in {line % 90 + 10} ms'
+            draw.text((8, line * self.LINE_HEIGHT), text, fill=(20, 20, 20))
+        return page
+
+    def grab(self):
+        image = self.desktop.copy()
+        if self.scene == 'text':
+            left, top, right, bottom = self.window
+            window_height = bottom - top
+            offset = (self.index * self.SCROLL_STEP) % (self.text_page.height - window_height)
+            image.paste(self.text_page.crop((0, offset, right - left, offset + window_height)), (left, top))
+        elif self.scene == 'noise':
+            left, top, right, bottom = self.player
+            size = (right - left, bottom - top)
+            # 低强度噪声叠加在随帧变化的底色上，接近真实视频的压缩难度
+            base = Image.new('RGB', size, ((self.index * 7) % 256, 90, 255 - (self.index * 5) % 256))
+            noise = Image.merge('RGB', [Image.effect_noise(size, 40)] * 3)
+            image.paste(Image.blend(base, noise, 0.5), (left, top))
+        self.index += 1
+        return image
+
+
+class ReplaySource:
+    """循环回放图片文件夹或多帧图片，所有帧预先解码到内存"""
+
+    def __init__(self, path):
+        self.name = f'replay:{path}'
+        self.frames = []
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.lower().endswith(REPLAY_EXTENSIONS):
+                    with Image.open(os.path.join(path, filename)) as image:
+                        self.frames.append(image.convert('RGB'))
+        else:
+            with Image.open(path) as image:
+                for frame in ImageSequence.Iterator(image):
+                    self.frames.append(frame.convert('RGB'))
+        if not self.frames:
+            raise ValueError(f'没有可回放的图片: {path}')
+        self.index = 0
+
+    def grab(self):
+        image = self.frames[self.index % len(self.frames)].copy()
+        self.index += 1
+        return image
+
+
+def parse_size(text):
+    """解析 '1280x720' 格式的尺寸"""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def create_frame_source(spec='screen'):
+    """按描述创建画面来源，描述格式见模块说明"""
+    if not PIL_AVAILABLE:
+        raise RuntimeError('PIL/Pillow未安装，无法取得画面')
+    spec = (spec or 'screen').strip()
+    kind, _, arg = spec.partition(':')
+    if kind == 'screen':
+        return ScreenSource()
+    if kind == 'synthetic':
+        scene, _, size = arg.partition(':')
+        return SyntheticSource(scene or 'text', parse_size(size) if size else SYNTHETIC_SIZE)
+    if kind == 'replay':
+        if not arg:
+            raise ValueError('replay需要指定图片文件夹或文件: replay:<路径>')
+        return ReplaySource(arg)
+    raise ValueError(f'未知的画面来源: {spec}')
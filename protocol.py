@@ -0,0 +1,308 @@
+"""
+远程控制系统 - 通信协议
+被控端、服务器、控制端共用的消息帧编解码
+
+每一帧都以4字节大端长度开头（长度不含这4个字节本身），正文有两种格式:
+  v1 JSON帧:   [长度][JSON(UTF-8)]
+               正文总是以 '{' 开头，二进制数据以base64字符串放在JSON里
+  v2 二进制帧: [长度][魔数0xB2][版本2][头长度(4字节)][头JSON][原始负载]
+               头JSON中 '_bin' 记录负载对应的字段名，负载是原始字节不做base64
+
+消息在程序内部是dict，最多一个字段的值为bytes/bytearray/memoryview（截图、视频帧、文件内容）。
+按对端协商的版本编码: v1对端收到base64字符串，v2对端收到原始字节。
+接收端两种帧都能解析，取二进制字段时统一用 payload_bytes()。
+
+版本协商: 被控端/控制端的注册消息中带 'protocol': PROTOCOL_VERSION，
+服务器回复 {'type': 'welcome', 'protocol': 协商版本}（JSON帧，旧版本会忽略），
+双方之后按协商版本发送。旧版服务器不回复welcome，客户端保持v1。
+
+服务器转发时使用 decode_relay()/RelayMessage: 只解析路由需要的字段，
+负载原样转发，附加的agent_id/request_id只拼接到头部，每个协议版本只编码一次。
+"""
+
+import asyncio
+import base64
+import json
+import socket
+
+# 当前实现支持的最高协议版本
+PROTOCOL_VERSION = 2
+
+# 未协商时使用的版本（旧版纯JSON协议）
+LEGACY_PROTOCOL = 1
+
+# v2二进制帧的首字节，JSON帧首字节总是 '{'，两者不会冲突
+FRAME_MAGIC = 0xB2
+
+# v2帧头中记录二进制字段名的键
+BINARY_KEY = '_bin'
+
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+# 文件分块传输的默认块大小和窗口（未确认的块数上限），在途数据最多 块大小 x 窗口
+FILE_CHUNK_SIZE = 256 * 1024
+FILE_WINDOW = 8
+
+# 单帧正文的默认最大长度，超过视为数据错误并断开连接（防止错误的长度头导致分配超大内存）
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+
+def negotiate(peer_version):
+    """根据对端声明的版本返回双方共同支持的版本"""
+    try:
+        peer_version = int(peer_version or LEGACY_PROTOCOL)
+    except (TypeError, ValueError):
+        return LEGACY_PROTOCOL
+    return max(LEGACY_PROTOCOL, min(peer_version, PROTOCOL_VERSION))
+
+
+def find_binary_field(data):
+    """返回消息中值为二进制的字段名，没有则返回None"""
+    for key, value in data.items():
+        if isinstance(value, BINARY_TYPES):
+            return key
+    return None
+
+
+def encode_message(data, version=LEGACY_PROTOCOL):
+    """把消息编码为带长度头的帧
+
+    Args:
+        data: 消息dict
+        version: 对端协商的协议版本
+    """
+    key = find_binary_field(data)
+
+    if key is None or version < 2:
+        if key is not None:
+            # 旧版对端: 二进制字段转为base64字符串
+            data = dict(data)
+            data[key] = base64.b64encode(data[key]).decode('ascii')
+        body = json.dumps(data).encode('utf-8')
+        return len(body).to_bytes(4, 'big') + body
+
+    header = {k: v for k, v in data.items() if k != key}
+    header[BINARY_KEY] = key
+    header_bytes = json.dumps(header).encode('utf-8')
+    payload = data[key]
+    length = 2 + 4 + len(header_bytes) + len(payload)
+    return b''.join((
+        length.to_bytes(4, 'big'),
+        bytes((FRAME_MAGIC, 2)),
+        len(header_bytes).to_bytes(4, 'big'),
+        header_bytes,
+        payload,
+    ))
+
+
+def decode_frame(body):
+    """解析帧正文（不含长度头）为消息dict
+
+    v2帧的负载以memoryview返回，不做拷贝；转发时可直接写出。
+    """
+    if body[:1] == bytes((FRAME_MAGIC,)):
+        header_len = int.from_bytes(body[2:6], 'big')
+        header = json.loads(str(body[6:6 + header_len], 'utf-8'))
+        key = header.pop(BINARY_KEY, None)
+        if key:
+            header[key] = memoryview(body)[6 + header_len:]
+        return header
+    return json.loads(str(body, 'utf-8'))
+
+
+def payload_bytes(value):
+    """取出二进制字段为bytes，兼容v1的base64字符串和v2的原始字节"""
+    if value is None:
+        return b''
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    if isinstance(value, bytes):
+        return value
+    return bytes(value)
+
+
+def splice_json(body, fields):
+    """把fields拼接到JSON对象正文的末尾，原有内容不解析也不重新序列化
+
+    JSON对象出现重复键时以后出现的为准，所以fields覆盖原消息中的同名字段，
+    与RelayMessage.get、to_dict中附加字段优先一致（被控端不能冒充服务器写入的agent_id等字段）。
+    """
+    if not fields:
+        return bytes(body)
+    return b''.join(splice_parts(body, fields))
+
+
+def splice_parts(body, fields):
+    """同splice_json，但不拼成一个缓冲区：返回 (去掉结尾 '}' 的原正文memoryview, 新的结尾)"""
+    end = len(body) - 1
+    while bytes(body[end:end + 1]).isspace():
+        end -= 1
+    last = end - 1  # 结尾 '}' 之前最后一个非空白字符
+    while last > 0 and bytes(body[last:last + 1]).isspace():
+        last -= 1
+    separator = b'' if body[last:last + 1] == b'{' else b', '
+    suffix = json.dumps(fields).encode('utf-8')[1:]  # 去掉开头的 '{'
+    return memoryview(body)[:end], separator + suffix
+
+
+class RelayMessage:
+    """中转消息：只解析路由需要的字段，负载原样转发，每个协议版本只编码一次
+
+    - v2二进制帧: 只解析头JSON，负载保持为接收缓冲区上的memoryview
+    - v1 JSON帧: 保留原始正文，转发时把附加字段拼接到JSON末尾，不重新序列化
+    同一条消息发给多个对端时共享编码结果。
+    """
+
+    __slots__ = ('data', 'raw', 'extra', 'encoded')
+
+    def __init__(self, data, raw=None):
+        self.data = data      # 解析出的字段（v2帧的负载字段为memoryview）
+        self.raw = raw        # v1 JSON帧的原始正文，None表示需要按字段编码
+        self.extra = {}       # 中转时附加或覆盖的字段
+        self.encoded = {}     # 协议版本 -> 编码好的帧
+
+    def get(self, key, default=None):
+        if key in self.extra:
+            return self.extra[key]
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.extra[key] = value
+        self.encoded.clear()
+
+    def __contains__(self, key):
+        return key in self.extra or key in self.data
+
+    def to_dict(self):
+        """合并附加字段后的完整消息dict"""
+        data = dict(self.data)
+        data.update(self.extra)
+        return data
+
+    def encode(self, version):
+        """按对端协议版本编码（带缓存）"""
+        frame = self.encoded.get(version)
+        if frame is None:
+            if self.raw is not None:
+                # JSON正文对任何版本的对端都可用，直接拼接转发
+                body = splice_json(self.raw, self.extra)
+                frame = len(body).to_bytes(4, 'big') + body
+            else:
+                frame = encode_message(self.to_dict(), version)
+            self.encoded[version] = frame
+        return frame
+
+    def encode_parts(self, version, fields):
+        """附加只用于这一次发送的字段后编码（不写入缓存），返回依次写出的缓冲区列表
+
+        v2二进制帧只重新生成头部，负载以原memoryview单独写出，不拷贝；
+        JSON帧复用缓存的编码结果，只生成拼接了fields的结尾，正文不拷贝
+        """
+        if self.raw is None and version >= 2:
+            data = self.to_dict()
+            data.update(fields)
+            key = find_binary_field(data)
+            if key is not None:
+                payload = data.pop(key)
+                data[BINARY_KEY] = key
+                header_bytes = json.dumps(data).encode('utf-8')
+                length = 2 + 4 + len(header_bytes) + len(payload)
+                return [b''.join((
+                    length.to_bytes(4, 'big'),
+                    bytes((FRAME_MAGIC, 2)),
+                    len(header_bytes).to_bytes(4, 'big'),
+                    header_bytes,
+                )), payload]
+
+        body, tail = splice_parts(memoryview(self.encode(version))[4:], fields)
+        return [(len(body) + len(tail)).to_bytes(4, 'big'), body, tail]
+
+
+def decode_relay(body):
+    """把帧正文解析为RelayMessage（服务器转发用）"""
+    if body[:1] == bytes((FRAME_MAGIC,)):
+        return RelayMessage(decode_frame(body))
+    return RelayMessage(json.loads(str(body, 'utf-8')), body)
+
+
+def encode_outbound(msg, version):
+    """编码待发送的消息，msg可以是dict或RelayMessage"""
+    if isinstance(msg, RelayMessage):
+        return msg.encode(version)
+    return encode_message(msg, version)
+
+
+def recv_exactly(sock, size, can_timeout=False):
+    """从socket接收恰好size个字节，连接关闭返回None
+
+    用recv_into直接写入一次性分配的bytearray，避免逐块拼接带来的反复拷贝。
+
+    Args:
+        can_timeout: 为True时，一个字节都没收到就超时会抛出socket.timeout（调用方可借此发送心跳）；
+            已经收到部分数据后的超时总是继续等待，避免丢掉半帧破坏消息边界
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        try:
+            n = sock.recv_into(view[received:], size - received)
+        except socket.timeout:
+            if can_timeout and received == 0:
+                raise
+            continue
+        if n == 0:
+            return None
+        received += n
+    return buffer
+
+
+def recv_frame(sock, max_size=MAX_FRAME_SIZE):
+    """从socket接收一帧正文，连接关闭或出错返回None
+
+    正文长度超过max_size时抛出ValueError，调用方应断开连接。
+    """
+    # 接收长度（可能分多次到达）
+    raw_len = recv_exactly(sock, 4, can_timeout=True)
+    if raw_len is None:
+        return None
+
+    msg_len = int.from_bytes(raw_len, 'big')
+    if msg_len > max_size:
+        raise ValueError(f'帧长度 {msg_len} 超过上限 {max_size}')
+
+    # 接收数据，整帧写入一次性分配的缓冲区
+    return recv_exactly(sock, msg_len)
+
+
+def recv_message(sock, decode=decode_frame, max_size=MAX_FRAME_SIZE):
+    """从socket接收并解析一条消息，连接关闭或出错返回None
+
+    Args:
+        decode: 帧正文解析函数，服务器转发时使用decode_relay
+        max_size: 单帧正文的最大长度
+    """
+    body = recv_frame(sock, max_size)
+    if body is None:
+        return None
+    return decode(body)
+
+
+async def read_message_async(reader, timeout=None, decode=decode_frame, max_size=MAX_FRAME_SIZE):
+    """从asyncio StreamReader读取并解析一条消息
+
+    timeout只作用于等待下一条消息的长度头，超时抛出asyncio.TimeoutError；
+    readexactly在数据不足时不会消费缓冲区，超时取消不会破坏消息边界。
+    正文长度超过max_size时抛出ValueError。
+    """
+    raw_len = await asyncio.wait_for(reader.readexactly(4), timeout)
+    msg_len = int.from_bytes(raw_len, 'big')
+    if msg_len > max_size:
+        raise ValueError(f'帧长度 {msg_len} 超过上限 {max_size}')
+    body = await reader.readexactly(msg_len)
+    return decode(body)
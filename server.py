@@ -2,25 +2,628 @@
 远程控制系统 - 服务器端
 作为控制端和被控端之间的中转桥梁
 支持多个被控端和一个控制端同时连接
+支持两种运行模式: thread (每连接一个线程) 和 asyncio (单线程事件循环)
 """
 
+import asyncio
+import collections
 import socket
 import threading
-import json
 import time
+import uuid
 from datetime import datetime
 
+from protocol import (LEGACY_PROTOCOL, MAX_FRAME_SIZE, RelayMessage, decode_relay, encode_outbound,
+                      negotiate, payload_bytes, read_message_async, recv_message)
+from video_codec import CODEC_TILES
+
+
+def log_time():
+    """获取当前时间字符串（供连接类打印日志）"""
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def outbound_parts(data, version):
+    """编码待发送的消息为依次写出的缓冲区列表
+
+    带relay_in的视频帧在真正写出时才盖上relay_out时间戳，两者之差即在发送队列中等待的时间；
+    时间戳只写入v2帧的头部或拼接到JSON正文末尾，负载不拷贝
+    """
+    if isinstance(data, RelayMessage) and 'relay_in' in data:
+        return data.encode_parts(version, {'relay_out': time.time()})
+    return [encode_outbound(data, version)]
+
+
+class OutboundQueue:
+    """单个连接的有界发送队列
+
+    消息按类别分到三个优先级通道，写线程总是先发高优先级通道里的消息：
+      0 - 输入和控制消息（鼠标键盘、命令、回复、心跳等）
+      1 - 画面（视频帧、缩略图、截图）
+      2 - 文件传输的数据流（分块下载/上传）
+    同一通道内保持先后顺序，所以分块传输的开始、数据块和结束不会乱序；
+    文件传输每块不超过FILE_CHUNK_SIZE，点击最多排在一个正在发送的数据块之后。
+
+    按消息类型决定积压时的策略：
+      - 'latest': 同一来源只保留最新一条，旧的在队列里被原地替换（视频帧）；
+        图块编码的整帧不会被增量帧替换，之后的增量帧排在它后面另占一个位置，
+        这样请求的整帧总能发出去，控制端据此从丢帧中恢复
+      - 其他类型可靠投递，从不丢弃（command_result、文件回复等）
+    可靠消息积压超过max_pending条时put返回False，由调用方断开过慢的连接。
+    """
+
+    # 消息类型 -> 积压策略
+    DROP_POLICY = {
+        'video_frame': 'latest',
+    }
+
+    PRIORITY_CONTROL = 0
+    PRIORITY_VIDEO = 1
+    PRIORITY_BULK = 2
+
+    # 消息类型 -> 优先级，未列出的按控制消息处理
+    TYPE_PRIORITY = {
+        'video_frame': PRIORITY_VIDEO,
+        'thumbnail_batch': PRIORITY_VIDEO,
+        'screenshot': PRIORITY_VIDEO,
+        'file_download': PRIORITY_BULK,
+        'file_download_start': PRIORITY_BULK,
+        'file_download_chunk': PRIORITY_BULK,
+        'file_download_end': PRIORITY_BULK,
+    }
+
+    # 转发给被控端的控制端命令 -> 优先级
+    ACTION_PRIORITY = {
+        'upload_file': PRIORITY_BULK,
+        'upload_start': PRIORITY_BULK,
+        'upload_chunk': PRIORITY_BULK,
+        'upload_finish': PRIORITY_BULK,
+    }
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self.lanes = [collections.deque() for _ in range(3)]  # 每个优先级一个通道: [slot_key, data]
+        self.pending = 0  # 所有通道中的消息数
+        self.slots = {}  # slot_key -> 队列中的条目
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # 统计计数
+        self.queued = 0          # 累计入队消息数
+        self.sent = 0            # 累计取出发送的消息数
+        self.frames_queued = 0   # 累计入队的可丢弃帧数
+        self.frames_dropped = 0  # 被更新帧替换掉的帧数
+        self.sent_by_priority = [0, 0, 0]
+        self.overtaken = 0       # 越过低优先级积压先发出的消息数
+
+    def slot_key(self, data):
+        """可丢弃消息的合并键，可靠消息返回None"""
+        msg_type = data.get('type')
+        if self.DROP_POLICY.get(msg_type) == 'latest':
+            return (msg_type, data.get('agent_id'))
+        return None
+
+    @staticmethod
+    def is_keyframe(data):
+        """图块编码的整帧：之后的增量帧都依赖它，不能被增量帧替换"""
+        return data.get('codec') == CODEC_TILES and bool(data.get('keyframe'))
+
+    def priority(self, data):
+        """消息所在的优先级通道"""
+        msg_type = data.get('type')
+        if msg_type == 'controller':
+            return self.ACTION_PRIORITY.get(data.get('action'), self.PRIORITY_CONTROL)
+        return self.TYPE_PRIORITY.get(msg_type, self.PRIORITY_CONTROL)
+
+    def put(self, data):
+        """入队，可靠消息积压超限时返回False"""
+        with self.cond:
+            if self.closed:
+                return False
+
+            key = self.slot_key(data)
+            if key is not None:
+                self.frames_queued += 1
+                if self.replace_frame(key, data):
+                    return True
+                if self.is_keyframe(data):
+                    key += ('keyframe',)
+            elif self.pending - len(self.slots) >= self.max_pending:
+                return False
+
+            entry = [key, data]
+            self.lanes[self.priority(data)].append(entry)
+            self.pending += 1
+            if key is not None:
+                self.slots[key] = entry
+            self.queued += 1
+            self.cond.notify()
+            return True
+
+    def replace_frame(self, key, data):
+        """用新帧替换队列中还没发出去的旧帧（调用方需持有self.cond），没有可替换的返回False
+
+        整帧占用 key+('keyframe',) 位置，只能被更新的整帧替换；其后的帧占用key位置。
+        """
+        keyframe_key = key + ('keyframe',)
+        if self.is_keyframe(data):
+            keyframe_entry = self.slots.get(keyframe_key)
+            entry = self.slots.pop(key, None)
+            if keyframe_entry is None:
+                if entry is None:
+                    return False
+                # 排队的增量帧原地替换为整帧，改占整帧位置
+                entry[0] = keyframe_key
+                entry[1] = data
+                self.slots[keyframe_key] = entry
+                self.frames_dropped += 1
+                return True
+            # 新整帧替换旧整帧，排在旧整帧之后的帧已经过时
+            keyframe_entry[1] = data
+            self.frames_dropped += 1
+            if entry is not None:
+                self.lanes[self.priority(entry[1])].remove(entry)
+                self.pending -= 1
+                self.frames_dropped += 1
+            return True
+
+        entry = self.slots.get(key)
+        if entry is None:
+            return False
+        # 还没发出去的旧帧直接替换为最新帧
+        entry[1] = data
+        self.frames_dropped += 1
+        return True
+
+    def pop(self, block=True):
+        """取出优先级最高的下一条消息，队列关闭（或非阻塞且为空）时返回None"""
+        with self.cond:
+            while not self.pending:
+                if self.closed or not block:
+                    return None
+                self.cond.wait()
+            for priority, lane in enumerate(self.lanes):
+                if lane:
+                    break
+            key, data = lane.popleft()
+            self.pending -= 1
+            if key is not None:
+                del self.slots[key]
+            if any(self.lanes[priority + 1:]):
+                self.overtaken += 1
+            self.sent += 1
+            self.sent_by_priority[priority] += 1
+            return data
+
+    def close(self):
+        """关闭队列，丢弃未发送的消息并唤醒写线程"""
+        with self.cond:
+            self.closed = True
+            for lane in self.lanes:
+                lane.clear()
+            self.pending = 0
+            self.slots.clear()
+            self.cond.notify_all()
+
+    def get_stats(self):
+        """返回队列统计"""
+        with self.cond:
+            return {
+                'pending': self.pending,
+                'pending_by_priority': [len(lane) for lane in self.lanes],
+                'queued': self.queued,
+                'sent': self.sent,
+                'sent_by_priority': list(self.sent_by_priority),
+                'overtaken': self.overtaken,
+                'frames_queued': self.frames_queued,
+                'frames_dropped': self.frames_dropped,
+            }
+
+
+class ClientConnection:
+    """线程模式下的客户端连接
+
+    每个连接有自己的发送队列和写线程，send()只负责入队，
+    慢速对端只会阻塞自己的写线程，不会拖住其他连接的转发。
+    """
+
+    def __init__(self, sock, addr, max_pending=1000):
+        self.sock = sock
+        self.addr = addr
+        self.protocol = LEGACY_PROTOCOL  # 注册握手后按对端版本更新
+        self.closed = False
+        self.queue = OutboundQueue(max_pending)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, data):
+        """消息入队，连接已关闭时返回False"""
+        if self.closed:
+            return False
+        if not self.queue.put(data):
+            print(f"[{log_time()}] 发送队列积压过多，断开 {self.addr}")
+            self.close()
+            return False
+        return True
+
+    def write_loop(self):
+        """写线程：依次取出消息并发送"""
+        while True:
+            data = self.queue.pop()
+            if data is None:
+                break
+            try:
+                for part in outbound_parts(data, self.protocol):
+                    self.sock.sendall(part)
+            except Exception as e:
+                print(f"[{log_time()}] 发送数据错误 {self.addr}: {e}")
+                self.close()
+                break
+
+    def get_stats(self):
+        """返回发送队列统计"""
+        return self.queue.get_stats()
+
+    def close(self):
+        """关闭连接，读线程会随之收到EOF并退出"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
+
+
+class AsyncClientConnection:
+    """asyncio模式下的客户端连接，由独立的写协程负责发送和drain"""
+
+    def __init__(self, writer, addr, max_pending=1000):
+        self.writer = writer
+        self.addr = addr
+        self.protocol = LEGACY_PROTOCOL  # 注册握手后按对端版本更新
+        self.closed = False
+        self.queue = OutboundQueue(max_pending)
+        self.wakeup = asyncio.Event()
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    def send(self, data):
+        """消息入队，连接已关闭时返回False"""
+        if self.closed:
+            return False
+        if not self.queue.put(data):
+            print(f"[{log_time()}] 发送队列积压过多，断开 {self.addr}")
+            self.close()
+            return False
+        self.wakeup.set()
+        return True
+
+    async def write_loop(self):
+        """写协程：依次取出消息写入并等待缓冲区排空"""
+        while not self.closed:
+            data = self.queue.pop(block=False)
+            if data is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            try:
+                self.writer.writelines(outbound_parts(data, self.protocol))
+                await self.writer.drain()
+            except Exception as e:
+                print(f"[{log_time()}] 发送数据错误 {self.addr}: {e}")
+                self.close()
+                break
+
+    def get_stats(self):
+        """返回发送队列统计"""
+        return self.queue.get_stats()
+
+    def close(self):
+        """关闭连接"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        self.wakeup.set()
+        try:
+            self.writer.close()
+        except:
+            pass
+
+
+class BatchJob:
+    """服务器上的批量命令任务：一个任务ID对应多台被控端，由服务器按限制分批下发
+
+    每台主机的状态：
+      pending  - 排队等待下发
+      running  - 已下发，等待结果
+      waiting  - 不在线或执行中断开，等待被控端重连后重新下发
+      done     - 已返回结果
+      offline / failed / cancelled - 等待重连超时、重试次数用完或运行超时、任务被取消
+    同时运行的主机数不超过concurrency，每秒新下发的主机数不超过rate（令牌桶，允许一秒的突发）。
+
+    结果按 (结果, 返回码, 输出) 去重分组，相同输出只保存一份，
+    控制端先看到分组摘要（如 "287台: 成功; 13台: 错误X"），需要时再取某一组的完整输出和主机列表。
+    """
+
+    # 分组摘要中输出预览的最大字符数
+    PREVIEW_LENGTH = 200
+
+    # 还没有最终结果的状态
+    ACTIVE_STATES = ('pending', 'running', 'waiting')
+
+    # 被控端繁忙时等待多少秒再重新下发，每次重试翻倍
+    BUSY_BACKOFF = 2.0
+
+    def __init__(self, job_id, controller_id, command, targets, forward,
+                 concurrency, rate, retries, reconnect_wait, run_timeout):
+        self.job_id = job_id
+        self.controller_id = controller_id
+        self.command = command
+        self.forward = forward          # 下发给被控端的run_command消息
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries          # 断开或繁忙后最多重新下发的次数
+        self.reconnect_wait = reconnect_wait  # 等待离线主机重连的最长时间（秒）
+        self.run_timeout = run_timeout  # 下发后等待结果的最长时间（秒）
+        self.created = time.time()
+        self.finished_at = None
+        self.hosts = {agent_id: 'pending' for agent_id in targets}  # {agent_id: 状态}
+        self.queue = collections.deque(targets)  # 待下发的主机
+        self.attempts = {}        # {agent_id: 已下发次数}
+        self.waiting_since = {}   # {agent_id: 开始等待重连的时间}
+        self.not_before = {}      # {agent_id: 繁忙退避结束的时间}
+        self.started_at = {}      # {agent_id: 最近一次下发的时间}
+        self.tokens = float(rate)
+        self.refilled_at = time.time()
+        self.groups = {}      # {(结果, 返回码, 输出): 分组}
+        self.group_ids = {}   # {分组ID: 分组}
+        self.dirty = True     # 上次发送摘要后有变化
+        self.reported = False  # 已在服务器日志中记录完成
+
+    def take_starts(self, online):
+        """取出现在可以下发的主机，online(agent_id)判断主机是否在线
+
+        不在线的主机转为等待重连，等待超过reconnect_wait的记为离线；
+        繁忙退避还没结束的主机留在队列中，由之后的定期调度下发
+        """
+        now = time.time()
+        for agent_id, since in list(self.waiting_since.items()):
+            if now - since >= self.reconnect_wait:
+                self.record(agent_id, 'offline', '主机不在线（等待重连超时）')
+
+        self.tokens = min(float(self.rate), self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        running = sum(1 for status in self.hosts.values() if status == 'running')
+        starts = []
+        deferred = []
+        while self.queue and running < self.concurrency and self.tokens >= 1:
+            agent_id = self.queue.popleft()
+            if self.hosts.get(agent_id) != 'pending':
+                continue
+            if self.not_before.get(agent_id, 0) > now:
+                deferred.append(agent_id)
+                continue
+            self.not_before.pop(agent_id, None)
+            if not online(agent_id):
+                self.wait_reconnect(agent_id)
+                continue
+            self.hosts[agent_id] = 'running'
+            self.started_at[agent_id] = now
+            self.attempts[agent_id] = self.attempts.get(agent_id, 0) + 1
+            self.tokens -= 1
+            running += 1
+            starts.append(agent_id)
+        self.queue.extendleft(reversed(deferred))
+        if starts:
+            self.dirty = True
+        return starts
+
+    def expire_running(self):
+        """下发后超过run_timeout秒还没有结果的主机记为失败，返回这些主机（由调用方通知被控端结束命令）"""
+        now = time.time()
+        expired = [agent_id for agent_id, started in self.started_at.items()
+                   if self.hosts.get(agent_id) == 'running' and now - started >= self.run_timeout]
+        for agent_id in expired:
+            self.record(agent_id, 'failed', f'错误: 命令执行超时 ({self.run_timeout:g}秒)')
+        return expired
+
+    def wait_reconnect(self, agent_id):
+        """主机不在线，等它重连后再下发"""
+        self.hosts[agent_id] = 'waiting'
+        self.waiting_since[agent_id] = time.time()
+        self.dirty = True
+
+    def retry(self, agent_id, output, disconnected=False):
+        """执行中断开或被控端繁忙：还有重试次数时重新下发（断开的等重连后），否则以output记为失败
+
+        Returns:
+            bool: 是否会重新下发
+        """
+        if self.hosts.get(agent_id) != 'running':
+            return False
+        if self.attempts.get(agent_id, 0) > self.retries:
+            self.record(agent_id, 'failed', output)
+            return False
+        self.started_at.pop(agent_id, None)
+        if disconnected:
+            self.wait_reconnect(agent_id)
+        else:
+            # 繁忙时立即重发多半还是繁忙，退避一段时间再下发
+            self.hosts[agent_id] = 'pending'
+            self.not_before[agent_id] = time.time() + self.BUSY_BACKOFF * 2 ** (self.attempts.get(agent_id, 1) - 1)
+            self.queue.append(agent_id)
+            self.dirty = True
+        return True
+
+    def host_reconnected(self, agent_id):
+        """等待中的主机重新上线，排到队首尽快下发"""
+        if self.hosts.get(agent_id) != 'waiting':
+            return False
+        del self.waiting_since[agent_id]
+        self.not_before.pop(agent_id, None)
+        self.hosts[agent_id] = 'pending'
+        self.queue.appendleft(agent_id)
+        self.dirty = True
+        return True
+
+    def cancel(self):
+        """取消还没下发的主机，返回仍在运行的主机（由调用方通知被控端取消）"""
+        for agent_id, status in list(self.hosts.items()):
+            if status in ('pending', 'waiting'):
+                self.record(agent_id, 'cancelled', '任务已取消，未执行')
+        self.queue.clear()
+        return [agent_id for agent_id, status in self.hosts.items() if status == 'running']
+
+    def record(self, agent_id, status, output, returncode=None, error=False):
+        """记录一台主机的最终结果，主机不属于本任务或已有结果时返回False
+
+        status为done时按返回码分为ok和error，error为True表示命令没能执行（没有返回码）
+        """
+        if self.hosts.get(agent_id) not in self.ACTIVE_STATES:
+            return False
+        self.hosts[agent_id] = status
+        self.waiting_since.pop(agent_id, None)
+        self.not_before.pop(agent_id, None)
+        self.started_at.pop(agent_id, None)
+        if status == 'done':
+            result = 'error' if error or returncode not in (0, None) else 'ok'
+        else:
+            result = status
+        key = (result, returncode, output)
+        group = self.groups.get(key)
+        if group is None:
+            group = {
+                'group': str(len(self.groups) + 1),
+                'status': result,
+                'returncode': returncode,
+                'output': output,
+                'hosts': []
+            }
+            self.groups[key] = group
+            self.group_ids[group['group']] = group
+        group['hosts'].append(agent_id)
+        self.dirty = True
+        if self.finished:
+            self.finished_at = time.time()
+        return True
+
+    @property
+    def finished(self):
+        return not any(status in self.ACTIVE_STATES for status in self.hosts.values())
+
+    def summary(self):
+        """任务进度和分组摘要（job_status消息）"""
+        counts = collections.Counter(self.hosts.values())
+        groups = sorted(self.groups.values(), key=lambda g: -len(g['hosts']))
+        return {
+            'type': 'job_status',
+            'job_id': self.job_id,
+            'command': self.command,
+            'total': len(self.hosts),
+            'pending': counts['pending'],
+            'running': counts['running'],
+            'waiting': counts['waiting'],
+            'completed': len(self.hosts) - sum(counts[status] for status in self.ACTIVE_STATES),
+            'finished': self.finished,
+            'concurrency': self.concurrency,
+            'rate': self.rate,
+            'groups': [{
+                'group': group['group'],
+                'count': len(group['hosts']),
+                'status': group['status'],
+                'returncode': group['returncode'],
+                'preview': group['output'][:self.PREVIEW_LENGTH]
+            } for group in groups]
+        }
+
+    def group_detail(self, group_id):
+        """某一组的完整输出和主机列表（job_group消息），分组不存在时返回None"""
+        group = self.group_ids.get(group_id)
+        if group is None:
+            return None
+        return {
+            'type': 'job_group',
+            'job_id': self.job_id,
+            'command': self.command,
+            'group': group_id,
+            'status': group['status'],
+            'returncode': group['returncode'],
+            'output': group['output'],
+            'hosts': sorted(group['hosts'])
+        }
+
+
 class RemoteControlServer:
-    def __init__(self, host='0.0.0.0', port=5000):
+    # 需要转发给被控端的控制端命令
+    FORWARD_ACTIONS = ('screenshot', 'start_video', 'stop_video', 'run_command', 'cancel_command',
+                       'mouse_move', 'mouse_click', 'mouse_scroll',
+                       'keyboard_press', 'keyboard_type', 'cancel_input',
+                       'get_drives', 'list_files', 'open_file', 'download_file', 'upload_file',
+                       'delete_file', 'create_folder',
+                       'download_ack', 'cancel_download',
+                       'upload_start', 'upload_chunk', 'upload_finish',
+                       'request_keyframe', 'video_feedback',
+                       'start_thumbnails', 'stop_thumbnails')
+
+    # 被控端不会回复的命令，不登记请求路由（取消、停止类命令沿用原请求的路由）
+    NO_REPLY_ACTIONS = ('mouse_move', 'mouse_click', 'mouse_scroll',
+                        'keyboard_press', 'keyboard_type', 'cancel_input',
+                        'stop_video', 'stop_thumbnails', 'request_keyframe', 'video_feedback',
+                        'cancel_command', 'download_ack', 'cancel_download')
+
+    # 请求路由表条目的过期时间（秒），从最后一次收到对应回复开始计算
+    REQUEST_TTL = 600
+
+    # 屏幕墙缩略图合并发送的周期（秒），批量任务的进度摘要也按这个周期发送
+    THUMBNAIL_BATCH_INTERVAL = 1.0
+
+    # 最多保留的批量任务数，超过时丢弃最早结束的任务
+    MAX_JOBS = 100
+
+    # 批量任务的默认调度限制，控制端可在run_job中按任务指定
+    JOB_CONCURRENCY = 50        # 每个任务同时运行的主机数
+    JOB_RATE = 20               # 每个任务每秒新下发的主机数
+    JOB_RETRIES = 2             # 执行中断开或被控端繁忙后重新下发的次数
+    JOB_RECONNECT_WAIT = 300    # 等待离线主机重连的最长时间（秒）
+    JOB_TIMEOUT = 600           # 每台主机上命令的执行时间上限（秒），由被控端结束超时的命令
+    JOB_RESULT_GRACE = 30       # 超过执行时间上限这么多秒还没收到结果时，服务器直接记为失败
+
+    def __init__(self, host='0.0.0.0', port=5000, max_frame_size=MAX_FRAME_SIZE,
+                 job_concurrency=JOB_CONCURRENCY, job_rate=JOB_RATE):
         self.host = host
         self.port = port
+        self.max_frame_size = max_frame_size  # 单帧正文上限，超过则断开该连接
+        self.job_concurrency = job_concurrency  # 批量任务默认并发数
+        self.job_rate = job_rate                # 批量任务默认每秒下发数
         self.server_socket = None
         
         # 存储连接的客户端
         self.agents = {}  # {agent_id: {'conn': conn, 'addr': addr, 'info': info}}
         self.controllers = {}  # {controller_id: {'conn': conn, 'addr': addr}} - 支持多个控制端
+
+        # 请求路由表: {request_id: {'controller_id': id, 'time': t}}，回复只发给发起请求的控制端
+        self.pending_requests = {}
+        # 视频订阅: {agent_id: set(controller_id)}，视频帧只发给订阅了该被控端的控制端
+        self.video_subscribers = {}
+        # 被控端上正在运行的视频流: {agent_id: 启动它的start_video消息}
+        # 多个控制端共享同一路视频流，第一个订阅者加入时才启动，最后一个离开时才停止
+        self.video_streams = {}
+        # 屏幕墙缩略图，订阅方式与视频相同，但不直接转发，由服务器缓存后按控制端定期合并发送
+        self.thumbnail_subscribers = {}  # {agent_id: set(controller_id)}
+        self.thumbnail_streams = {}      # {agent_id: 启动它的start_thumbnails消息}
+        self.thumbnails = {}             # {agent_id: (最新缩略图JPEG, sent_at)}
+        self.thumbnail_pending = {}      # {controller_id: set(上一批之后有更新的agent_id)}
+        # 批量命令任务: {job_id: BatchJob}，由服务器按并发和速率限制分批下发，
+        # 被控端对任务的回复由服务器汇总，不逐条转发
+        self.jobs = {}
         
-        # 线程锁
+        # 注册表锁：只保护agents/controllers字典，持锁期间不做任何网络发送
         self.lock = threading.Lock()
         
         self.running = True
@@ -30,14 +633,15 @@ class RemoteControlServer:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(10)
+        self.server_socket.listen(128)
         
         print(f"[{self.get_time()}] 服务器启动成功")
         print(f"[{self.get_time()}] 监听地址: {self.host}:{self.port}")
         print("-" * 60)
         
-        # 启动心跳检测线程
+        # 启动心跳检测线程和缩略图批量发送线程
         threading.Thread(target=self.heartbeat_check, daemon=True).start()
+        threading.Thread(target=self.thumbnail_loop, daemon=True).start()
         
         while self.running:
             try:
@@ -61,9 +665,9 @@ class RemoteControlServer:
             client_type = data.get('type')
             
             if client_type == 'agent':
-                self.handle_agent(conn, addr, data)
+                self.handle_agent(ClientConnection(conn, addr), addr, data)
             elif client_type == 'controller':
-                self.handle_controller(conn, addr)
+                self.handle_controller(ClientConnection(conn, addr), addr, data)
             else:
                 print(f"[{self.get_time()}] 未知客户端类型: {client_type}")
                 conn.close()
@@ -74,8 +678,27 @@ class RemoteControlServer:
     
     def handle_agent(self, conn, addr, data):
         """处理被控端连接"""
+        agent_id = self.register_agent(conn, addr, data)
+        
+        # 接收被控端消息
+        while self.running:
+            try:
+                msg = self.recv_json(conn.sock)
+                if not msg:
+                    break
+                self.route_agent_message(agent_id, msg)
+                    
+            except Exception as e:
+                print(f"[{self.get_time()}] 被控端 {agent_id} 错误: {e}")
+                break
+        
+        self.unregister_agent(agent_id, conn)
+    
+    def register_agent(self, conn, addr, data):
+        """登记被控端并通知控制端，返回agent_id"""
         agent_id = data.get('agent_id', f"{addr[0]}:{addr[1]}")
         agent_info = data.get('info', {})
+        self.negotiate_protocol(conn, data)
         
         with self.lock:
             self.agents[agent_id] = {
@@ -84,6 +707,15 @@ class RemoteControlServer:
                 'info': agent_info,
                 'last_heartbeat': time.time()
             }
+            # 被控端断线重连：还有控制端在观看时重新启动缩略图流；旧连接还没清理时视频流也重新启动
+            restarts = [start for start in (self.video_streams.get(agent_id), self.thumbnail_streams.get(agent_id))
+                        if start is not None]
+            # 等待该被控端重连的批量任务重新下发
+            resumed = [job for job in self.jobs.values() if job.host_reconnected(agent_id)]
+        for start in restarts:
+            self.send_json(conn, start)
+        if resumed:
+            self.schedule_jobs(resumed)
         
         print(f"[{self.get_time()}] 被控端上线: {agent_id}")
         print(f"  - 主机名: {agent_info.get('hostname', 'Unknown')}")
@@ -92,131 +724,519 @@ class RemoteControlServer:
         
         # 通知控制端更新主机列表
         self.notify_controller_host_list()
-        
-        # 接收被控端消息
-        while self.running:
-            try:
-                msg = self.recv_json(conn)
-                if not msg:
-                    break
-                
-                # 更新心跳时间
-                if msg.get('action') == 'heartbeat':
-                    with self.lock:
-                        if agent_id in self.agents:
-                            self.agents[agent_id]['last_heartbeat'] = time.time()
-                    continue
-                
-                # 转发消息给所有控制端
-                msg['agent_id'] = agent_id
-                with self.lock:
-                    dead_controllers = []
-                    for controller_id, controller_data in self.controllers.items():
-                        try:
-                            self.send_json(controller_data['conn'], msg)
-                        except:
-                            dead_controllers.append(controller_id)
-
-                    # 清理失败的控制端
-                    for controller_id in dead_controllers:
-                        if controller_id in self.controllers:
-                            del self.controllers[controller_id]
-                    
-            except Exception as e:
-                print(f"[{self.get_time()}] 被控端 {agent_id} 错误: {e}")
-                break
-        
-        # 清理断开的被控端
+        return agent_id
+    
+    def unregister_agent(self, agent_id, conn):
+        """清理断开的被控端"""
         with self.lock:
-            if agent_id in self.agents:
-                del self.agents[agent_id]
+            # 同一ID可能已经重连，只删除属于本连接的记录
+            if agent_id in self.agents and self.agents[agent_id]['conn'] is conn:
+                finished = self.drop_agent(agent_id)
+            else:
+                finished = []
+        self.send_job_status(finished)
         
         print(f"[{self.get_time()}] 被控端下线: {agent_id}")
-        conn.close()
+        try:
+            conn.close()
+        except:
+            pass
         
         # 通知控制端更新主机列表
         self.notify_controller_host_list()
+
+    def drop_agent(self, agent_id):
+        """删除被控端记录并处理它的批量任务（调用方需持有self.lock），返回因此结束的任务
+
+        还没返回结果的批量任务等待重连后重新下发，重试次数用完的记为失败
+        """
+        del self.agents[agent_id]
+        # 视频流随连接结束，控制端需要重新发start_video；缩略图在重连后重新发来
+        self.clear_video_stream(agent_id)
+        self.thumbnails.pop(agent_id, None)
+        finished = []
+        for job in self.jobs.values():
+            if job.hosts.get(agent_id) == 'running':
+                job.retry(agent_id, '执行过程中被控端断开', disconnected=True)
+                if job.finished:
+                    finished.append(job)
+        return finished
     
-    def handle_controller(self, conn, addr):
-        """处理控制端连接 - 支持多个控制端"""
-        controller_id = f"{addr[0]}:{addr[1]}"
-        print(f"[{self.get_time()}] 控制端连接: {addr} (ID: {controller_id})")
+    def route_agent_message(self, agent_id, msg):
+        """处理被控端发来的一条消息：心跳或转发给控制端"""
+        # 更新心跳时间
+        if msg.get('action') == 'heartbeat':
+            with self.lock:
+                if agent_id in self.agents:
+                    self.agents[agent_id]['last_heartbeat'] = time.time()
+            return
 
-        # 设置socket超时
-        conn.settimeout(60)  # 60秒超时
+        # 屏幕墙缩略图由服务器缓存，定期按控制端合并发送
+        if msg.get('type') == 'thumbnail':
+            self.store_thumbnail(agent_id, msg)
+            return
 
+        # 批量任务的结果由服务器汇总
+        if msg.get('request_id') in self.jobs:
+            self.record_job_result(agent_id, msg)
+            return
+        
+        # 转发给相关控制端（锁内只查路由表，发送只是入队）
+        # agent_id只在编码时拼接到头部，负载不解码也不重新序列化，所有控制端共享同一份编码
+        msg['agent_id'] = agent_id
+        if msg.get('type') == 'video_frame':
+            msg['relay_in'] = time.time()  # 延迟统计: 服务器收到帧的时间
         with self.lock:
-            self.controllers[controller_id] = {
-                'conn': conn,
-                'addr': addr,
-                'last_active': time.time()
-            }
+            controller_conns = self.select_recipients(agent_id, msg)
+        for controller_conn in controller_conns:
+            self.send_json(controller_conn, msg)
+    
+    def select_recipients(self, agent_id, msg):
+        """根据路由表选出应接收该消息的控制端连接（调用方需持有self.lock）
 
-        print(f"[{self.get_time()}] 当前控制端数量: {len(self.controllers)}")
+        - 视频帧只发给订阅了该被控端的控制端
+        - 带已知request_id的回复只发给发起请求的控制端
+        - 其他消息（旧版被控端不回传request_id）广播给所有控制端
+        - 视频流出错时清除该视频流的记录，错误同时发给所有观看者
+        """
+        if msg.get('type') == 'video_frame':
+            controller_ids = self.video_subscribers.get(agent_id, ())
+        else:
+            request = self.pending_requests.get(msg.get('request_id'))
+            if request:
+                request['time'] = time.time()
+                controller_ids = (request['controller_id'],)
+            else:
+                controller_ids = self.controllers.keys()
+            if msg.get('type') == 'error':
+                controller_ids = set(controller_ids) | self.clear_video_stream(agent_id, msg.get('request_id'))
 
-        # 发送当前在线主机列表
-        self.notify_controller_host_list(conn)
+        return [self.controllers[cid]['conn'] for cid in controller_ids if cid in self.controllers]
+    
+    def handle_controller(self, conn, addr, data):
+        """处理控制端连接 - 支持多个控制端"""
+        controller_id = self.register_controller(conn, addr, data)
+
+        # 设置socket超时（只影响读取；发送在写线程中进行）
+        conn.sock.settimeout(60)  # 60秒超时
 
         # 接收控制端命令
         while self.running:
             try:
-                msg = self.recv_json(conn)
+                msg = self.recv_json(conn.sock)
                 if not msg:
                     break
-
-                # 更新活跃时间
-                with self.lock:
-                    if controller_id in self.controllers:
-                        self.controllers[controller_id]['last_active'] = time.time()
-
-                action = msg.get('action')
-
-                if action == 'register':
-                    # 控制端注册，发送主机列表
-                    print(f"[{self.get_time()}] 控制端 {controller_id} 注册成功")
-                    self.notify_controller_host_list(conn)
-
-                elif action == 'list_hosts':
-                    # 返回主机列表
-                    self.notify_controller_host_list(conn)
-
-                elif action in ['screenshot', 'start_video', 'stop_video', 'run_command',
-                               'mouse_move', 'mouse_click', 'mouse_scroll',
-                               'keyboard_press', 'keyboard_type',
-                               'get_drives', 'list_files', 'open_file', 'download_file', 'upload_file',
-                               'delete_file', 'create_folder']:
-                    # 转发命令给指定的被控端
-                    targets = msg.get('targets', [])
-                    for target in targets:
-                        with self.lock:
-                            if target in self.agents:
-                                agent_conn = self.agents[target]['conn']
-                                self.send_json(agent_conn, msg)
-                            else:
-                                # 通知控制端目标不存在
-                                self.send_json(conn, {
-                                    'type': 'error',
-                                    'message': f'目标 {target} 不在线'
-                                })
+                self.dispatch_controller_message(controller_id, conn, msg)
 
             except socket.timeout:
                 # 超时，发送心跳检测
-                try:
-                    self.send_json(conn, {'type': 'ping'})
-                except:
+                if not self.send_json(conn, {'type': 'ping'}):
                     print(f"[{self.get_time()}] 控制端 {controller_id} 心跳失败")
                     break
             except Exception as e:
                 print(f"[{self.get_time()}] 控制端 {controller_id} 错误: {e}")
                 break
 
+        self.unregister_controller(controller_id, conn, addr)
+
+    def register_controller(self, conn, addr, data):
+        """登记控制端并发送当前主机列表，返回controller_id"""
+        controller_id = f"{addr[0]}:{addr[1]}"
+        print(f"[{self.get_time()}] 控制端连接: {addr} (ID: {controller_id})")
+        self.negotiate_protocol(conn, data)
+
+        with self.lock:
+            self.controllers[controller_id] = {
+                'conn': conn,
+                'addr': addr,
+                'last_active': time.time()
+            }
+
+        print(f"[{self.get_time()}] 当前控制端数量: {len(self.controllers)}")
+
+        # 发送当前在线主机列表
+        self.notify_controller_host_list(conn)
+        return controller_id
+
+    def unregister_controller(self, controller_id, conn, addr):
+        """清理断开的控制端"""
         print(f"[{self.get_time()}] 控制端断开: {addr} (ID: {controller_id})")
         with self.lock:
             if controller_id in self.controllers:
                 del self.controllers[controller_id]
+
+            # 清理该控制端的请求路由、视频和缩略图订阅
+            for request_id in [rid for rid, r in self.pending_requests.items()
+                               if r['controller_id'] == controller_id]:
+                del self.pending_requests[request_id]
+            stream_stops = []
+            for action, subscribers_table in (('stop_video', self.video_subscribers),
+                                              ('stop_thumbnails', self.thumbnail_subscribers)):
+                for agent_id in [aid for aid, subscribers in subscribers_table.items()
+                                 if controller_id in subscribers]:
+                    stop = self.unsubscribe_stream(action, agent_id, controller_id)
+                    if stop:
+                        stream_stops.append(stop)
+            self.thumbnail_pending.pop(controller_id, None)
         print(f"[{self.get_time()}] 剩余控制端数量: {len(self.controllers)}")
-        conn.close()
-    
+        # 该控制端是最后一个观看者的视频流和缩略图流随之停止
+        for agent_conn, stop in stream_stops:
+            self.send_json(agent_conn, stop)
+        try:
+            conn.close()
+        except:
+            pass
+
+    def dispatch_controller_message(self, controller_id, conn, msg):
+        """处理控制端发来的一条消息：注册、查询主机或转发命令"""
+        # 更新活跃时间
+        with self.lock:
+            if controller_id in self.controllers:
+                self.controllers[controller_id]['last_active'] = time.time()
+
+        action = msg.get('action')
+
+        if action == 'register':
+            # 控制端注册，发送主机列表
+            print(f"[{self.get_time()}] 控制端 {controller_id} 注册成功")
+            self.notify_controller_host_list(conn)
+
+        elif action == 'list_hosts':
+            # 返回主机列表
+            self.notify_controller_host_list(conn)
+
+        elif action == 'server_stats':
+            # 返回各控制端发送队列统计
+            self.send_json(conn, {'type': 'server_stats', 'controllers': self.get_stats()})
+
+        elif action == 'run_job':
+            self.start_job(controller_id, conn, msg)
+
+        elif action == 'cancel_command' and msg.get('request_id') in self.jobs:
+            self.cancel_job(msg['request_id'])
+
+        elif action == 'job_group':
+            # 查看批量任务某一组的完整输出
+            with self.lock:
+                job = self.jobs.get(msg.get('job_id'))
+                detail = job.group_detail(str(msg.get('group'))) if job else None
+            if detail is None:
+                detail = {'type': 'error', 'message': f"批量任务 {msg.get('job_id')} 的分组 {msg.get('group')} 不存在"}
+            self.send_json(conn, detail)
+
+        elif action in self.FORWARD_ACTIONS:
+            # 旧版控制端不带请求ID，由服务器生成，保证新版被控端的回复仍能定向返回
+            if not msg.get('request_id'):
+                msg['request_id'] = uuid.uuid4().hex
+
+            targets = msg.get('targets', [])
+            if action not in self.NO_REPLY_ACTIONS:
+                with self.lock:
+                    self.pending_requests[msg['request_id']] = {
+                        'controller_id': controller_id,
+                        'time': time.time()
+                    }
+
+            # 转发命令给指定的被控端
+            for target in targets:
+                with self.lock:
+                    agent_data = self.agents.get(target)
+                    agent_conn = agent_data['conn'] if agent_data else None
+                    if action == 'start_video' and agent_conn:
+                        forwards = self.subscribe_video(target, controller_id, msg)
+                    elif action == 'stop_video':
+                        forwards = [self.stop_stream_message(action, target, controller_id, msg)]
+                    elif action == 'start_thumbnails' and agent_conn:
+                        forwards = [self.subscribe_thumbnails(target, controller_id, msg)]
+                    elif action == 'stop_thumbnails':
+                        forwards = [self.stop_stream_message(action, target, controller_id, msg)]
+                    else:
+                        forwards = [msg]
+                forwards = [forward for forward in forwards if forward is not None]
+                if not forwards:
+                    continue
+                if agent_conn:
+                    for forward in forwards:
+                        self.send_json(agent_conn, forward)
+                else:
+                    # 通知控制端目标不存在
+                    self.send_json(conn, {
+                        'type': 'error',
+                        'message': f'目标 {target} 不在线'
+                    })
+
+    def subscribe_video(self, agent_id, controller_id, msg):
+        """控制端订阅被控端的视频，返回要依次转发给被控端的消息列表（调用方需持有self.lock）
+
+        第一个订阅者的start_video原样转发并记录，视频流使用它的质量、编码等参数；
+        之后加入的控制端不再启动新的视频流，只请求一次整帧，让它从完整画面开始显示。
+        加入者不支持视频流允许的编码（如旧版控制端不能解码图块增量帧）时，
+        改用双方都支持的编码重新启动视频流
+        """
+        self.video_subscribers.setdefault(agent_id, set()).add(controller_id)
+        stream = self.video_streams.get(agent_id)
+        if stream is None:
+            self.video_streams[agent_id] = msg
+            return [msg]
+        viewers = len(self.video_subscribers[agent_id])
+        codecs = stream.get('codecs') or []
+        joiner_codecs = msg.get('codecs') or []
+        common = [codec for codec in codecs if codec in joiner_codecs]
+        if common != codecs:
+            print(f"[{self.get_time()}] 控制端 {controller_id} 加入 {agent_id} 的视频流，"
+                  f"编码改为 {common or ['jpeg']} 后重新启动 (观看者: {viewers})")
+            start = stream.to_dict() if isinstance(stream, RelayMessage) else dict(stream)
+            start['codecs'] = common
+            self.video_streams[agent_id] = start
+            stop = {'type': 'controller', 'action': 'stop_video', 'request_id': stream['request_id']}
+            return [stop, start]
+        print(f"[{self.get_time()}] 控制端 {controller_id} 加入 {agent_id} 的视频流 (观看者: {viewers})")
+        return [{
+            'type': 'controller',
+            'action': 'request_keyframe',
+            'request_id': stream['request_id']
+        }]
+
+    def clear_video_stream(self, agent_id, request_id=None):
+        """清除被控端的视频流和订阅者（调用方需持有self.lock），返回原来的订阅者
+
+        request_id不为None时只在它是该视频流的请求ID时清除
+        """
+        stream = self.video_streams.get(agent_id)
+        if stream is None or (request_id is not None and stream.get('request_id') != request_id):
+            return set()
+        del self.video_streams[agent_id]
+        return self.video_subscribers.pop(agent_id, set())
+
+    def subscribe_thumbnails(self, agent_id, controller_id, msg):
+        """控制端订阅被控端的屏幕墙缩略图，返回要转发给被控端的消息（调用方需持有self.lock）
+
+        同一被控端只运行一路缩略图流；新加入的控制端在下一批中先收到缓存的最新缩略图
+        """
+        self.thumbnail_subscribers.setdefault(agent_id, set()).add(controller_id)
+        if agent_id in self.thumbnails:
+            self.thumbnail_pending.setdefault(controller_id, set()).add(agent_id)
+        if agent_id in self.thumbnail_streams:
+            return None
+        self.thumbnail_streams[agent_id] = msg
+        return msg
+
+    def stream_tables(self, action):
+        """返回stop动作对应的 (订阅表, 运行中的流, 停止动作)"""
+        if action in ('start_thumbnails', 'stop_thumbnails'):
+            return self.thumbnail_subscribers, self.thumbnail_streams, 'stop_thumbnails'
+        return self.video_subscribers, self.video_streams, 'stop_video'
+
+    def unsubscribe_stream(self, action, agent_id, controller_id):
+        """取消视频或缩略图订阅（调用方需持有self.lock）
+
+        最后一个订阅者离开时返回 (被控端连接, 停止消息)，否则返回None
+        """
+        subscribers_table, streams, stop_action = self.stream_tables(action)
+        subscribers = subscribers_table.get(agent_id)
+        if subscribers is None or controller_id not in subscribers:
+            return None
+        subscribers.discard(controller_id)
+        if subscribers:
+            return None
+        del subscribers_table[agent_id]
+        if stop_action == 'stop_thumbnails':
+            # 没有控制端再看，缓存的缩略图不再需要
+            self.thumbnails.pop(agent_id, None)
+        stream = streams.pop(agent_id, None)
+        agent_data = self.agents.get(agent_id)
+        if stream is None or agent_data is None:
+            return None
+        # 被控端按启动时的请求ID识别要停止的流
+        return agent_data['conn'], {
+            'type': 'controller',
+            'action': stop_action,
+            'request_id': stream['request_id']
+        }
+
+    def stop_stream_message(self, action, agent_id, controller_id, msg):
+        """处理控制端的stop_video/stop_thumbnails，返回要转发给被控端的消息（调用方需持有self.lock）"""
+        if agent_id not in self.stream_tables(action)[1]:
+            # 服务器没有记录该流（例如服务器重启过），照旧转发，停止可能残留的流
+            return msg
+        stop = self.unsubscribe_stream(action, agent_id, controller_id)
+        return stop[1] if stop else None
+
+    def store_thumbnail(self, agent_id, msg):
+        """缓存被控端的最新缩略图，等下一批统一发给订阅的控制端"""
+        image = payload_bytes(msg.get('image'))
+        with self.lock:
+            self.thumbnails[agent_id] = (image, msg.get('sent_at'))
+            for controller_id in self.thumbnail_subscribers.get(agent_id, ()):
+                self.thumbnail_pending.setdefault(controller_id, set()).add(agent_id)
+
+    def flush_thumbnails(self):
+        """把上一批之后更新过的缩略图按控制端合并为一条thumbnail_batch发送
+
+        所有JPEG首尾相接放在image中，thumbnails为 [[agent_id, 偏移, 长度, sent_at], ...]；
+        被控端在一个周期内发来多张时只发送最新的一张
+        """
+        with self.lock:
+            pending, self.thumbnail_pending = self.thumbnail_pending, {}
+            batches = []
+            for controller_id, agent_ids in pending.items():
+                controller = self.controllers.get(controller_id)
+                if controller is None:
+                    continue
+                entries = [(agent_id,) + self.thumbnails[agent_id]
+                           for agent_id in agent_ids if agent_id in self.thumbnails]
+                if entries:
+                    batches.append((controller['conn'], entries))
+
+        for conn, entries in batches:
+            index = []
+            offset = 0
+            for agent_id, image, sent_at in entries:
+                index.append([agent_id, offset, len(image), sent_at])
+                offset += len(image)
+            self.send_json(conn, {
+                'type': 'thumbnail_batch',
+                'thumbnails': index,
+                'image': b''.join(entry[1] for entry in entries)
+            })
+
+    def thumbnail_loop(self):
+        """按THUMBNAIL_BATCH_INTERVAL定期发送缩略图批次和批量任务进度"""
+        while self.running:
+            time.sleep(self.THUMBNAIL_BATCH_INTERVAL)
+            self.flush_thumbnails()
+            self.schedule_jobs()
+            self.flush_jobs()
+
+    def start_job(self, controller_id, conn, msg):
+        """创建批量命令任务，任务ID即控制端的request_id
+
+        可选参数 concurrency / rate / retries / reconnect_wait / timeout 覆盖服务器默认的调度限制
+        """
+        job_id = msg.get('request_id') or uuid.uuid4().hex
+        command = msg.get('command', '')
+        targets = list(dict.fromkeys(msg.get('targets', [])))
+        forward = {
+            'type': 'controller',
+            'action': 'run_command',
+            'command': command,
+            'as_admin': msg.get('as_admin', False),
+            'request_id': job_id,
+            # 批量任务不流式返回，总是带上执行时间上限，命令不会无限期占用被控端和任务的名额
+            'timeout': max(1.0, float(msg.get('timeout') or self.JOB_TIMEOUT))
+        }
+
+        job = BatchJob(job_id, controller_id, command, targets, forward,
+                       concurrency=max(1, int(msg.get('concurrency') or self.job_concurrency)),
+                       rate=max(1.0, float(msg.get('rate') or self.job_rate)),
+                       retries=max(0, int(msg.get('retries', self.JOB_RETRIES))),
+                       reconnect_wait=max(0.0, float(msg.get('reconnect_wait', self.JOB_RECONNECT_WAIT))),
+                       run_timeout=forward['timeout'] + self.JOB_RESULT_GRACE)
+        with self.lock:
+            self.jobs[job_id] = job
+            self.trim_jobs()
+        print(f"[{self.get_time()}] 批量任务 {job_id}: {command} -> {len(targets)} 台主机 "
+              f"(并发 {job.concurrency}, 每秒 {job.rate:g} 台)")
+
+        self.schedule_jobs([job])
+        self.send_job_status([job])
+
+    def schedule_jobs(self, jobs=None):
+        """按并发和速率限制下发批量任务中排队的主机，jobs为None时检查所有未完成的任务
+
+        在创建任务、收到结果、被控端重连时立即调用，另外随缩略图周期定期调用以补充速率令牌和处理等待、运行超时
+        """
+        sends = []
+        finished = []
+        cancels = []
+        with self.lock:
+            if jobs is None:
+                jobs = [job for job in self.jobs.values() if not job.finished]
+            for job in jobs:
+                if job.finished:
+                    continue
+                # 被控端没有按时回复（例如旧版被控端），通知它结束命令，名额留给排队的主机
+                for agent_id in job.expire_running():
+                    if agent_id in self.agents:
+                        cancels.append((self.agents[agent_id]['conn'],
+                                        {'type': 'controller', 'action': 'cancel_command', 'request_id': job.job_id}))
+                for agent_id in job.take_starts(lambda aid: aid in self.agents):
+                    sends.append((self.agents[agent_id]['conn'], job.forward))
+                if job.finished:
+                    finished.append(job)
+        for agent_conn, forward in cancels + sends:
+            self.send_json(agent_conn, forward)
+        if finished:
+            self.send_job_status(finished)
+
+    def record_job_result(self, agent_id, msg):
+        """记录被控端对批量任务的回复，空出的名额立即下发给排队的主机，任务全部完成时立即发送最终摘要"""
+        if msg.get('type') != 'command_result':
+            return
+        output = msg.get('output', '')
+        with self.lock:
+            job = self.jobs.get(msg.get('request_id'))
+            if job is None:
+                return
+            if msg.get('busy'):
+                # 被控端的命令工作池已满，退避后由定期调度重新下发
+                job.retry(agent_id, output)
+            elif msg.get('cancelled'):
+                job.record(agent_id, 'cancelled', output, msg.get('returncode'))
+            else:
+                # 只有旧版被控端的回复总是没有返回码，新版被控端没有返回码表示命令没能执行
+                agent_data = self.agents.get(agent_id)
+                legacy = agent_data is None or agent_data['conn'].protocol <= LEGACY_PROTOCOL
+                error = msg.get('error') or (msg.get('returncode') is None and not legacy)
+                job.record(agent_id, 'done', output, msg.get('returncode'), error=bool(error))
+            finished = job.finished
+        if finished:
+            self.send_job_status([job])
+        else:
+            self.schedule_jobs([job])
+
+    def cancel_job(self, job_id):
+        """取消批量任务：排队和等待中的主机不再下发，正在运行的通知被控端结束命令"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            running = job.cancel()
+            agent_conns = [self.agents[agent_id]['conn'] for agent_id in running if agent_id in self.agents]
+        print(f"[{self.get_time()}] 批量任务 {job_id} 已取消 (运行中 {len(running)} 台)")
+        for agent_conn in agent_conns:
+            self.send_json(agent_conn, {'type': 'controller', 'action': 'cancel_command', 'request_id': job_id})
+        self.send_job_status([job])
+
+    def trim_jobs(self):
+        """丢弃超出MAX_JOBS的最早结束的任务（调用方需持有self.lock）"""
+        finished = sorted((job for job in self.jobs.values() if job.finished), key=lambda job: job.finished_at)
+        for job in finished[:max(0, len(self.jobs) - self.MAX_JOBS)]:
+            del self.jobs[job.job_id]
+
+    def send_job_status(self, jobs):
+        """把任务摘要发给创建任务的控制端"""
+        messages = []
+        with self.lock:
+            for job in jobs:
+                controller = self.controllers.get(job.controller_id)
+                job.dirty = False
+                if job.finished and not job.reported:
+                    job.reported = True
+                    print(f"[{self.get_time()}] 批量任务 {job.job_id} 完成: " +
+                          ", ".join(f"{group['status']} {len(group['hosts'])} 台" for group in job.groups.values()))
+                if controller:
+                    messages.append((controller['conn'], job.summary()))
+        for conn, summary in messages:
+            self.send_json(conn, summary)
+
+    def flush_jobs(self):
+        """发送上个周期之后有进展的任务摘要"""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.dirty]
+        if jobs:
+            self.send_job_status(jobs)
+
     def notify_controller_host_list(self, target_conn=None):
         """通知控制端更新主机列表
 
@@ -224,6 +1244,10 @@ class RemoteControlServer:
             target_conn: 指定的控制端连接，如果为None则通知所有控制端
         """
         with self.lock:
+            # 没有控制端在线时无需构建列表（大量被控端同时上线时避免O(N²)开销）
+            if target_conn is None and not self.controllers:
+                return
+
             hosts = []
             for agent_id, agent_data in self.agents.items():
                 info = agent_data['info']
@@ -232,90 +1256,100 @@ class RemoteControlServer:
                     'hostname': info.get('hostname', 'Unknown'),
                     'ip': info.get('ip', 'Unknown'),
                     'platform': info.get('platform', 'Unknown'),
-                    'custom_name': info.get('custom_name', '')
+                    'custom_name': info.get('custom_name', ''),
+                    'protocol': agent_data['conn'].protocol  # 控制端据此判断被控端是否支持分块上传
                 })
 
-            message = {
-                'type': 'host_list',
-                'hosts': hosts
-            }
-
-            # 如果指定了目标连接，只发送给该连接
+            # 如果指定了目标连接，只发送给该连接，否则发送给所有控制端
             if target_conn:
-                try:
-                    self.send_json(target_conn, message)
-                except:
-                    pass
+                target_conns = [target_conn]
             else:
-                # 否则发送给所有控制端
-                dead_controllers = []
-                for controller_id, controller_data in self.controllers.items():
-                    try:
-                        self.send_json(controller_data['conn'], message)
-                    except:
-                        dead_controllers.append(controller_id)
-
-                # 清理失败的控制端
-                for controller_id in dead_controllers:
-                    if controller_id in self.controllers:
-                        del self.controllers[controller_id]
+                target_conns = [c['conn'] for c in self.controllers.values()]
+
+        # 同一份列表发给所有控制端，每个协议版本只编码一次
+        message = RelayMessage({
+            'type': 'host_list',
+            'hosts': hosts
+        })
+        for conn in target_conns:
+            self.send_json(conn, message)
     
     def heartbeat_check(self):
         """心跳检测，清理超时的被控端"""
         while self.running:
             time.sleep(30)  # 每30秒检查一次
+            self.check_heartbeats()
+            self.report_stats()
+    
+    def get_stats(self):
+        """返回每个控制端的发送队列统计 {controller_id: stats}"""
+        with self.lock:
+            controller_conns = [(cid, c['conn']) for cid, c in self.controllers.items()]
+        return {cid: conn.get_stats() for cid, conn in controller_conns}
+    
+    def report_stats(self):
+        """打印有丢帧或积压的控制端统计"""
+        for controller_id, stats in self.get_stats().items():
+            if stats['frames_dropped'] or stats['pending']:
+                print(f"[{self.get_time()}] 控制端 {controller_id} 发送统计: "
+                      f"积压 {stats['pending']} 条, 已入队帧 {stats['frames_queued']}, "
+                      f"丢弃旧帧 {stats['frames_dropped']}, 优先发出 {stats['overtaken']} 条")
+    
+    def check_heartbeats(self, timeout=60):
+        """关闭超过timeout秒没有心跳的被控端"""
+        current_time = time.time()
+        
+        with self.lock:
+            disconnected = []
+            for agent_id, agent_data in self.agents.items():
+                if current_time - agent_data['last_heartbeat'] > timeout:
+                    disconnected.append(agent_id)
             
-            timeout = 60  # 60秒超时
-            current_time = time.time()
-            
-            with self.lock:
-                disconnected = []
-                for agent_id, agent_data in self.agents.items():
-                    if current_time - agent_data['last_heartbeat'] > timeout:
-                        disconnected.append(agent_id)
-                
-                for agent_id in disconnected:
-                    print(f"[{self.get_time()}] 被控端超时: {agent_id}")
-                    try:
-                        self.agents[agent_id]['conn'].close()
-                    except:
-                        pass
-                    del self.agents[agent_id]
-            
-            if disconnected:
-                self.notify_controller_host_list()
+            timed_out = [self.agents[agent_id]['conn'] for agent_id in disconnected]
+            finished = []
+            for agent_id in disconnected:
+                finished.extend(self.drop_agent(agent_id))
+
+            # 清理过期的请求路由
+            expired = [rid for rid, r in self.pending_requests.items()
+                       if current_time - r['time'] > self.REQUEST_TTL]
+            for request_id in expired:
+                del self.pending_requests[request_id]
+        self.send_job_status(finished)
+        
+        for agent_id, conn in zip(disconnected, timed_out):
+            print(f"[{self.get_time()}] 被控端超时: {agent_id}")
+            conn.close()
+        
+        if disconnected:
+            self.notify_controller_host_list()
+    
+    def negotiate_protocol(self, conn, data):
+        """根据注册消息协商协议版本，支持新协议的对端回复welcome"""
+        conn.protocol = negotiate(data.get('protocol'))
+        if conn.protocol > LEGACY_PROTOCOL:
+            self.send_json(conn, {'type': 'welcome', 'protocol': conn.protocol})
     
     def send_json(self, conn, data):
-        """发送JSON数据"""
-        try:
-            msg = json.dumps(data).encode('utf-8')
-            length = len(msg)
-            conn.sendall(length.to_bytes(4, 'big') + msg)
-            return True
-        except Exception as e:
-            print(f"[{self.get_time()}] 发送数据错误: {e}")
-            return False
+        """发送消息（放入连接的发送队列，由写线程按对端协议版本编码发送）
+
+        data可以是dict或RelayMessage，同一个RelayMessage发给多个连接时共享编码结果
+        """
+        return conn.send(data)
     
     def recv_json(self, conn):
-        """接收JSON数据"""
+        """接收一条消息为RelayMessage，只解析路由字段，负载原样转发
+
+        等待超时抛出socket.timeout，连接关闭或数据错误返回None
+        """
         try:
-            # 接收长度
-            raw_len = conn.recv(4)
-            if not raw_len or len(raw_len) < 4:
-                return None
-            
-            msg_len = int.from_bytes(raw_len, 'big')
-            
-            # 接收数据
-            msg = b''
-            while len(msg) < msg_len:
-                chunk = conn.recv(min(msg_len - len(msg), 4096))
-                if not chunk:
-                    return None
-                msg += chunk
-            
-            return json.loads(msg.decode('utf-8'))
-        except Exception as e:
+            return recv_message(conn, decode_relay, self.max_frame_size)
+        except socket.timeout:
+            raise
+        except ValueError as e:
+            print(f"[{self.get_time()}] 接收数据错误: {e}")
+            return None
+        except Exception:
             return None
     
     def get_time(self):
@@ -328,16 +1362,181 @@ class RemoteControlServer:
         if self.server_socket:
             self.server_socket.close()
 
+class AsyncRemoteControlServer(RemoteControlServer):
+    """基于asyncio事件循环的服务器
+
+    与RemoteControlServer使用相同的协议和转发逻辑，
+    但所有连接都在一个线程内处理，不再为每个连接创建线程，
+    适合单个中转服务器承载上万个空闲被控端。
+    """
+
+    def __init__(self, host='0.0.0.0', port=5000, backlog=1024, max_frame_size=MAX_FRAME_SIZE,
+                 job_concurrency=RemoteControlServer.JOB_CONCURRENCY, job_rate=RemoteControlServer.JOB_RATE):
+        super().__init__(host, port, max_frame_size, job_concurrency, job_rate)
+        self.backlog = backlog
+        self.loop = None
+
+    def start(self):
+        """启动服务器"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """事件循环主协程"""
+        self.loop = asyncio.get_running_loop()
+        self.server_socket = await asyncio.start_server(
+            self.handle_client_async, self.host, self.port, backlog=self.backlog)
+
+        print(f"[{self.get_time()}] 服务器启动成功 (asyncio模式)")
+        print(f"[{self.get_time()}] 监听地址: {self.host}:{self.port}")
+        print("-" * 60)
+
+        heartbeat_task = asyncio.create_task(self.heartbeat_check_async())
+        thumbnail_task = asyncio.create_task(self.thumbnail_loop_async())
+        try:
+            async with self.server_socket:
+                await self.server_socket.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            heartbeat_task.cancel()
+            thumbnail_task.cancel()
+
+    async def handle_client_async(self, reader, writer):
+        """处理客户端连接"""
+        addr = writer.get_extra_info('peername')
+        print(f"[{self.get_time()}] 新连接来自: {addr}")
+
+        try:
+            # 接收第一条消息以识别客户端类型
+            data = await self.recv_json_async(reader)
+            if not data:
+                writer.close()
+                return
+
+            client_type = data.get('type')
+
+            if client_type == 'agent':
+                await self.handle_agent_async(reader, AsyncClientConnection(writer, addr), addr, data)
+            elif client_type == 'controller':
+                await self.handle_controller_async(reader, AsyncClientConnection(writer, addr), addr, data)
+            else:
+                print(f"[{self.get_time()}] 未知客户端类型: {client_type}")
+                writer.close()
+
+        except Exception as e:
+            print(f"[{self.get_time()}] 处理客户端错误: {e}")
+            writer.close()
+
+    async def handle_agent_async(self, reader, conn, addr, data):
+        """处理被控端连接"""
+        agent_id = self.register_agent(conn, addr, data)
+
+        # 接收被控端消息
+        while self.running:
+            try:
+                msg = await self.recv_json_async(reader)
+                if not msg:
+                    break
+                self.route_agent_message(agent_id, msg)
+
+            except Exception as e:
+                print(f"[{self.get_time()}] 被控端 {agent_id} 错误: {e}")
+                break
+
+        self.unregister_agent(agent_id, conn)
+
+    async def handle_controller_async(self, reader, conn, addr, data):
+        """处理控制端连接 - 支持多个控制端"""
+        controller_id = self.register_controller(conn, addr, data)
+
+        # 接收控制端命令
+        while self.running:
+            try:
+                msg = await self.recv_json_async(reader, timeout=60)
+                if not msg:
+                    break
+                self.dispatch_controller_message(controller_id, conn, msg)
+
+            except asyncio.TimeoutError:
+                # 超时，发送心跳检测
+                if not self.send_json(conn, {'type': 'ping'}):
+                    print(f"[{self.get_time()}] 控制端 {controller_id} 心跳失败")
+                    break
+            except Exception as e:
+                print(f"[{self.get_time()}] 控制端 {controller_id} 错误: {e}")
+                break
+
+        self.unregister_controller(controller_id, conn, addr)
+
+    async def heartbeat_check_async(self):
+        """心跳检测，清理超时的被控端"""
+        while self.running:
+            await asyncio.sleep(30)  # 每30秒检查一次
+            self.check_heartbeats()
+            self.report_stats()
+
+    async def thumbnail_loop_async(self):
+        """按THUMBNAIL_BATCH_INTERVAL定期发送缩略图批次和批量任务进度"""
+        while self.running:
+            await asyncio.sleep(self.THUMBNAIL_BATCH_INTERVAL)
+            self.flush_thumbnails()
+            self.schedule_jobs()
+            self.flush_jobs()
+
+    async def recv_json_async(self, reader, timeout=None):
+        """接收一条消息为RelayMessage
+
+        timeout只作用于等待下一条消息的长度头，超时抛出asyncio.TimeoutError；
+        连接关闭或数据错误返回None
+        """
+        try:
+            return await read_message_async(reader, timeout, decode_relay, self.max_frame_size)
+        except asyncio.TimeoutError:
+            raise
+        except ValueError as e:
+            print(f"[{self.get_time()}] 接收数据错误: {e}")
+            return None
+        except Exception:
+            return None
+
+    def stop(self):
+        """停止服务器"""
+        self.running = False
+        if self.server_socket and self.loop:
+            self.loop.call_soon_threadsafe(self.server_socket.close)
+
+
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='远程控制系统 - 服务器端')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread',
+                        help='连接处理模式: thread=每连接一个线程, asyncio=单线程事件循环（适合大量被控端）')
+    parser.add_argument('--max-frame-mb', type=int, default=MAX_FRAME_SIZE // (1024 * 1024),
+                        help='单条消息的最大长度(MB)，超过则断开连接')
+    parser.add_argument('--job-concurrency', type=int, default=RemoteControlServer.JOB_CONCURRENCY,
+                        help='批量任务同时运行的主机数')
+    parser.add_argument('--job-rate', type=float, default=RemoteControlServer.JOB_RATE,
+                        help='批量任务每秒新下发的主机数')
+    args = parser.parse_args()
+
     print("=" * 60)
     print("远程控制系统 - 服务器端")
     print("=" * 60)
     
-    server = RemoteControlServer(host='0.0.0.0', port=5000)
+    if args.mode == 'asyncio':
+        server = AsyncRemoteControlServer(host=args.host, port=args.port,
+                                          max_frame_size=args.max_frame_mb * 1024 * 1024,
+                                          job_concurrency=args.job_concurrency, job_rate=args.job_rate)
+    else:
+        server = RemoteControlServer(host=args.host, port=args.port,
+                                     max_frame_size=args.max_frame_mb * 1024 * 1024,
+                                     job_concurrency=args.job_concurrency, job_rate=args.job_rate)
     
     try:
         server.start()
     except KeyboardInterrupt:
         print(f"\n[{server.get_time()}] 服务器关闭")
         server.stop()
-
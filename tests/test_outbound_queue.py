@@ -0,0 +1,66 @@
+import unittest
+
+from server import OutboundQueue
+from video_codec import CODEC_TILES
+
+
+def tile_frame(number, keyframe=False, agent_id='A'):
+    return {'type': 'video_frame', 'agent_id': agent_id, 'codec': CODEC_TILES,
+            'keyframe': keyframe, 'frame': number}
+
+
+def drain(queue):
+    frames = []
+    while True:
+        data = queue.pop(block=False)
+        if data is None:
+            return frames
+        frames.append(data)
+
+
+class LatestFramePolicyTest(unittest.TestCase):
+    def test_jpeg_frames_keep_only_newest(self):
+        queue = OutboundQueue()
+        for number in range(3):
+            queue.put({'type': 'video_frame', 'agent_id': 'A', 'frame': number})
+        self.assertEqual([f['frame'] for f in drain(queue)], [2])
+
+    def test_delta_does_not_replace_pending_keyframe(self):
+        queue = OutboundQueue()
+        queue.put(tile_frame(10, keyframe=True))
+        queue.put(tile_frame(11))
+        frames = drain(queue)
+        self.assertEqual([(f['frame'], f['keyframe']) for f in frames], [(10, True), (11, False)])
+
+    def test_deltas_after_keyframe_keep_newest(self):
+        queue = OutboundQueue()
+        queue.put(tile_frame(10, keyframe=True))
+        queue.put(tile_frame(11))
+        queue.put(tile_frame(12))
+        self.assertEqual([f['frame'] for f in drain(queue)], [10, 12])
+
+    def test_keyframe_replaces_pending_delta(self):
+        queue = OutboundQueue()
+        queue.put(tile_frame(10))
+        queue.put(tile_frame(11, keyframe=True))
+        queue.put(tile_frame(12))
+        frames = drain(queue)
+        self.assertEqual([(f['frame'], f['keyframe']) for f in frames], [(11, True), (12, False)])
+
+    def test_newer_keyframe_drops_older_frames(self):
+        queue = OutboundQueue()
+        queue.put(tile_frame(10, keyframe=True))
+        queue.put(tile_frame(11))
+        queue.put(tile_frame(12, keyframe=True))
+        self.assertEqual([f['frame'] for f in drain(queue)], [12])
+        self.assertEqual(queue.get_stats()['pending'], 0)
+
+    def test_agents_have_separate_slots(self):
+        queue = OutboundQueue()
+        queue.put(tile_frame(10, keyframe=True, agent_id='A'))
+        queue.put(tile_frame(5, agent_id='B'))
+        self.assertEqual([(f['agent_id'], f['frame']) for f in drain(queue)], [('A', 10), ('B', 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
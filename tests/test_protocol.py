@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from protocol import decode_relay, encode_message, splice_json
+
+
+def frame_body(parts):
+    frame = b''.join(bytes(part) for part in parts)
+    length = int.from_bytes(frame[:4], 'big')
+    body = frame[4:]
+    assert length == len(body)
+    return json.loads(body)
+
+
+class SpliceJsonTest(unittest.TestCase):
+    def test_fields_override_duplicate_keys(self):
+        body = json.dumps({'type': 'file_list', 'agent_id': 'spoofed'}).encode('utf-8')
+        self.assertEqual(json.loads(splice_json(body, {'agent_id': 'real'}))['agent_id'], 'real')
+
+    def test_empty_object(self):
+        self.assertEqual(json.loads(splice_json(b'{ }', {'a': 1})), {'a': 1})
+
+    def test_trailing_whitespace(self):
+        self.assertEqual(json.loads(splice_json(b'{"b": 2} \n', {'a': 1})), {'a': 1, 'b': 2})
+
+
+class RelayMessageTest(unittest.TestCase):
+    def test_server_fields_win_over_agent_fields(self):
+        raw = json.dumps({'type': 'video_frame', 'agent_id': 'spoofed', 'relay_in': None,
+                          'image': 'AAAA'}).encode('utf-8')
+        msg = decode_relay(raw)
+        msg['agent_id'] = 'real'
+        msg['relay_in'] = 1.0
+        self.assertEqual(msg.get('agent_id'), 'real')
+        for version in (1, 2):
+            data = json.loads(msg.encode(version)[4:])
+            self.assertEqual((data['agent_id'], data['relay_in']), ('real', 1.0))
+            data = frame_body(msg.encode_parts(version, {'relay_out': 2.0, 'agent_id': 'other'}))
+            self.assertEqual((data['agent_id'], data['relay_in'], data['relay_out']), ('other', 1.0, 2.0))
+            self.assertEqual(data['image'], 'AAAA')
+
+    def test_binary_frame_to_legacy_peer(self):
+        frame = encode_message({'type': 'video_frame', 'image': b'\x00\x01'}, 2)
+        msg = decode_relay(memoryview(frame)[4:])
+        msg['agent_id'] = 'A'
+        data = frame_body(msg.encode_parts(1, {'relay_out': 2.0}))
+        self.assertEqual((data['agent_id'], data['relay_out'], data['image']), ('A', 2.0, 'AAE='))
+
+
+if __name__ == '__main__':
+    unittest.main()
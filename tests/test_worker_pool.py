@@ -0,0 +1,39 @@
+import threading
+import time
+import unittest
+
+from agent import WorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_burst_after_idle_starts_new_threads(self):
+        pool = WorkerPool('test', workers=4, max_queue=4)
+        warmed_up = threading.Event()
+        self.assertTrue(pool.submit(warmed_up.set))
+        self.assertTrue(warmed_up.wait(1))
+        time.sleep(0.05)  # 让线程回到空闲状态
+
+        release = threading.Event()
+        short_done = threading.Event()
+        self.assertTrue(pool.submit(release.wait, 5))
+        self.assertTrue(pool.submit(short_done.set))
+        try:
+            self.assertTrue(short_done.wait(1), '短任务排在长任务后面')
+            self.assertEqual(pool.get_stats()['threads'], 2)
+        finally:
+            release.set()
+
+    def test_rejects_when_full(self):
+        pool = WorkerPool('test', workers=1, max_queue=1)
+        release = threading.Event()
+        try:
+            self.assertTrue(pool.submit(release.wait, 5))
+            self.assertTrue(pool.submit(release.wait, 5))
+            self.assertFalse(pool.submit(release.wait, 5))
+            self.assertEqual(pool.get_stats()['rejected'], 1)
+        finally:
+            release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,450 @@
+"""
+远程控制系统 - 视频增量编码
+按固定大小的图块比较相邻两帧，只把发生变化的图块编码为JPEG发送
+
+视频帧消息字段（codec为'tiles'时）:
+  keyframe: True  - image为整帧JPEG
+  keyframe: False - image为所有变化图块的JPEG首尾相接，
+                    tiles为 [[x, y, 宽, 高, 在image中的偏移, 长度], ...]
+  width/height: 整帧尺寸
+控制端把图块绘制到上一帧上；发现丢帧（frame不连续）时发送request_keyframe。
+
+FrameChangeDetector在缩放和编码之前用缩小后像素的哈希判断画面是否变化，
+画面不变时整帧跳过，只按keyframe_interval定期刷新一次整帧。
+
+质量为'auto'时由BitrateController按控制端回传的video_feedback
+（回显帧的sent_at和解码耗时）在QUALITY_LADDER上调整分辨率、JPEG质量和帧率。
+
+FramePipeline把采集、编码、发送放在三个线程里并行，阶段之间用容量1~2的队列衔接，
+采集按截止时间定时，编码或发送较慢时丢弃过时的截图而不是拖慢采集。
+"""
+
+import hashlib
+import io
+import queue
+import threading
+import time
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# 编码器名称，控制端在start_video的codecs中声明支持后才会使用
+CODEC_TILES = 'tiles'
+
+# 图块边长（像素），取16的倍数与JPEG宏块对齐
+TILE_SIZE = 64
+
+# 画面指纹的缩小倍数（每个方向按块取平均）
+FINGERPRINT_FACTOR = 8
+
+# 画面不变时重发整帧的默认间隔（秒），0表示不刷新
+KEYFRAME_INTERVAL = 10
+
+# 固定质量档位
+QUALITY_PRESETS = {
+    'low': {'size': (640, 480), 'quality': 50, 'fps': 5},
+    'medium': {'size': (800, 600), 'quality': 70, 'fps': 10},
+    'high': {'size': (1280, 720), 'quality': 85, 'fps': 15},
+    'ultra': {'size': (1920, 1080), 'quality': 90, 'fps': 20}  # 90%无损画质
+}
+
+# 屏幕墙缩略图的默认参数（帧率可低于1）
+THUMBNAIL_SETTINGS = {'size': (240, 135), 'quality': 40, 'fps': 1}
+
+# 屏幕墙缩略图帧率的上限
+MAX_THUMBNAIL_FPS = 2
+
+# 自动质量的档位，从低到高
+QUALITY_LADDER = [
+    {'size': (480, 360), 'quality': 40, 'fps': 4},
+    {'size': (640, 480), 'quality': 50, 'fps': 5},
+    {'size': (800, 600), 'quality': 60, 'fps': 8},
+    {'size': (800, 600), 'quality': 70, 'fps': 10},
+    {'size': (1024, 768), 'quality': 75, 'fps': 12},
+    {'size': (1280, 720), 'quality': 85, 'fps': 15},
+    {'size': (1920, 1080), 'quality': 90, 'fps': 20},
+]
+
+# 自动质量的起始档位（与medium相同）
+DEFAULT_LADDER_LEVEL = 3
+
+# 自动质量的默认目标延迟（毫秒）：帧从被控端发出、控制端解码显示、反馈回到被控端的往返时间
+TARGET_LATENCY_MS = 250
+
+
+def frame_fingerprint(image, factor=FINGERPRINT_FACTOR):
+    """画面指纹：按factor块平均缩小后像素的哈希
+
+    块平均（而不是隔点取样）保证任意一个像素明显变化都会改变指纹
+    """
+    small = image.reduce(factor) if factor > 1 else image
+    return hashlib.blake2b(small.tobytes(), digest_size=16).digest()
+
+
+class FrameChangeDetector:
+    """判断截取的画面相对上一帧是否变化
+
+    check()返回:
+      SKIP     - 画面没有变化，不需要缩放、编码和发送
+      SEND     - 画面有变化，正常编码发送
+      KEYFRAME - 距上次刷新超过keyframe_interval或请求了整帧，发送整帧
+    """
+
+    SKIP = 'skip'
+    SEND = 'send'
+    KEYFRAME = 'keyframe'
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, factor=FINGERPRINT_FACTOR):
+        self.keyframe_interval = keyframe_interval
+        self.factor = factor
+        self.fingerprint = None
+        self.last_keyframe = 0
+        self.skipped = 0  # 累计跳过的帧数
+        self.keyframe_requested = False
+
+    def request_keyframe(self):
+        """下一帧即使画面没有变化也发送整帧（控制端丢帧或新的观看者加入时）"""
+        self.keyframe_requested = True
+
+    def check(self, image, now=None):
+        """检查一帧PIL图像"""
+        now = time.time() if now is None else now
+        fingerprint = frame_fingerprint(image, self.factor)
+
+        if self.keyframe_requested or \
+                (self.keyframe_interval and now - self.last_keyframe >= self.keyframe_interval):
+            self.keyframe_requested = False
+            self.fingerprint = fingerprint
+            self.last_keyframe = now
+            return self.KEYFRAME
+
+        if fingerprint == self.fingerprint:
+            self.skipped += 1
+            return self.SKIP
+
+        self.fingerprint = fingerprint
+        return self.SEND
+
+
+def encode_video_frame(image, settings, detector=None, encoder=None):
+    """按质量参数编码一帧截图，返回视频帧消息的字段；不需要发送时返回None
+
+    Args:
+        image: 截取的PIL图像（会被原地缩放）
+        settings: QUALITY_PRESETS/QUALITY_LADDER中的一项
+        detector: FrameChangeDetector，画面不变时跳过缩放和编码
+        encoder: TileEncoder，为None时整帧编码为JPEG
+    """
+    if detector:
+        status = detector.check(image)
+        if status == FrameChangeDetector.SKIP:
+            return None
+        if status == FrameChangeDetector.KEYFRAME and encoder:
+            encoder.request_keyframe()
+
+    # 调整大小
+    image.thumbnail(settings['size'])
+
+    if encoder:
+        # 只编码变化的图块（画面没有变化时返回None）
+        return encoder.encode(image, settings['quality'])
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=settings['quality'])
+    return {'image': buffer.getvalue()}
+
+
+class TileEncoder:
+    """图块增量编码器（需要NumPy）
+
+    保存上一帧的像素，用向量化比较找出变化的图块；
+    同一行相邻的变化图块合并为一个矩形再编码，减少JPEG头的开销。
+    """
+
+    def __init__(self, tile_size=TILE_SIZE, keyframe_ratio=0.5):
+        self.tile_size = tile_size
+        self.keyframe_ratio = keyframe_ratio  # 变化图块超过该比例时直接发送整帧
+        self.previous = None
+        self.keyframe_requested = True
+
+    def request_keyframe(self):
+        """下一帧发送整帧（控制端丢帧或刚加入时）"""
+        self.keyframe_requested = True
+
+    def changed_tiles(self, current):
+        """返回变化图块的布尔矩阵，形状为 (图块行数, 图块列数)"""
+        t = self.tile_size
+        height, width = current.shape[:2]
+
+        # 每行按字节展开；宽度对齐时按8字节一组比较，参与比较的元素减少为1/8
+        row_bytes = width * 3
+        current = current.reshape(height, row_bytes)
+        previous = self.previous.reshape(height, row_bytes)
+        unit = 8 if row_bytes % 8 == 0 and (t * 3) % 8 == 0 else 1
+        if unit == 8:
+            current = current.view(np.uint64)
+            previous = previous.view(np.uint64)
+        diff = current != previous
+
+        # 先按图块列、再按图块行归并，最后一行/列不满一个图块时也能正确处理
+        cols = np.logical_or.reduceat(diff, np.arange(0, diff.shape[1], t * 3 // unit), axis=1)
+        return np.logical_or.reduceat(cols, np.arange(0, height, t), axis=0)
+
+    def changed_rects(self, mask, width, height):
+        """把变化图块按行合并为矩形 [(x, y, 宽, 高), ...]"""
+        t = self.tile_size
+        rects = []
+        for row in range(mask.shape[0]):
+            cols = np.flatnonzero(mask[row])
+            if not len(cols):
+                continue
+            # 连续的列合并为一段
+            breaks = np.flatnonzero(np.diff(cols) > 1)
+            starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+            ends = np.concatenate((cols[breaks], [cols[-1]]))
+            y = row * t
+            h = min(t, height - y)
+            for start, end in zip(starts, ends):
+                x = int(start) * t
+                w = min((int(end) + 1) * t, width) - x
+                rects.append((x, y, w, h))
+        return rects
+
+    def encode(self, image, quality=70):
+        """编码一帧PIL图像，返回视频帧消息的字段；画面没有变化时返回None"""
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        current = np.asarray(image)
+        width, height = image.size
+
+        if self.keyframe_requested or self.previous is None or self.previous.shape != current.shape:
+            return self.encode_keyframe(image, current, quality)
+
+        mask = self.changed_tiles(current)
+        changed = int(mask.sum())
+        if changed == 0:
+            return None
+        if changed >= mask.size * self.keyframe_ratio:
+            return self.encode_keyframe(image, current, quality)
+
+        parts = []
+        tiles = []
+        offset = 0
+        for x, y, w, h in self.changed_rects(mask, width, height):
+            buffer = io.BytesIO()
+            image.crop((x, y, x + w, y + h)).save(buffer, format='JPEG', quality=quality)
+            data = buffer.getvalue()
+            tiles.append([x, y, w, h, offset, len(data)])
+            parts.append(data)
+            offset += len(data)
+
+        self.previous = current
+        return {
+            'codec': CODEC_TILES,
+            'keyframe': False,
+            'width': width,
+            'height': height,
+            'tiles': tiles,
+            'image': b''.join(parts)
+        }
+
+    def encode_keyframe(self, image, current, quality):
+        """编码整帧"""
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        self.previous = current
+        self.keyframe_requested = False
+        width, height = image.size
+        return {
+            'codec': CODEC_TILES,
+            'keyframe': True,
+            'width': width,
+            'height': height,
+            'image': buffer.getvalue()
+        }
+
+
+class BitrateController:
+    """自动质量：根据控制端回传的延迟在QUALITY_LADDER上升降档位
+
+    - 平滑后的延迟超过目标的1.5倍，或已发出的帧超过FEEDBACK_TIMEOUT秒没有反馈：降一档
+    - 延迟持续UPGRADE_HOLD秒低于目标的一半：升一档
+    换档后清空延迟样本并等待冷却时间，避免在两个档位之间来回振荡。
+    反馈在接收线程中更新，视频线程每帧调用update()取当前档位。
+    """
+
+    FEEDBACK_TIMEOUT = 2.0
+    DOWNGRADE_COOLDOWN = 1.0
+    UPGRADE_HOLD = 3.0
+
+    def __init__(self, target_latency_ms=TARGET_LATENCY_MS, level=DEFAULT_LADDER_LEVEL):
+        self.target = target_latency_ms / 1000.0
+        self.level = level
+        self.latency = None        # 平滑后的延迟（秒）
+        self.waiting_since = None  # 最早一个尚未收到反馈的帧的发送时间
+        self.good_since = None     # 延迟开始持续低于目标一半的时间
+        self.last_change = time.time()
+        self.lock = threading.Lock()
+
+    def on_frame_sent(self, now=None):
+        """视频线程发出一帧后调用"""
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.waiting_since is None:
+                self.waiting_since = now
+
+    def on_feedback(self, sent_at, decode_ms=0, now=None):
+        """收到控制端反馈：sent_at为回显的帧发送时间（被控端时钟），decode_ms为控制端解码耗时"""
+        now = time.time() if now is None else now
+        sample = max(0.0, now - sent_at) + max(0.0, decode_ms) / 1000.0
+        with self.lock:
+            self.latency = sample if self.latency is None else 0.7 * self.latency + 0.3 * sample
+            self.waiting_since = None
+
+    def update(self, now=None):
+        """根据最新的延迟调整档位，返回当前档位的参数"""
+        now = time.time() if now is None else now
+        with self.lock:
+            since_change = now - self.last_change
+            if self.waiting_since is not None and now - self.waiting_since > self.FEEDBACK_TIMEOUT \
+                    and since_change > self.FEEDBACK_TIMEOUT:
+                # 帧发出去迟迟没有反馈：链路或控制端已经拥塞
+                self.step(-1, now)
+            elif self.latency is not None:
+                if self.latency > self.target * 1.5:
+                    if since_change > self.DOWNGRADE_COOLDOWN:
+                        self.step(-1, now)
+                elif self.latency < self.target * 0.5:
+                    if self.good_since is None:
+                        self.good_since = now
+                    elif now - self.good_since >= self.UPGRADE_HOLD and since_change >= self.UPGRADE_HOLD:
+                        self.step(1, now)
+                else:
+                    self.good_since = None
+            return QUALITY_LADDER[self.level]
+
+    def step(self, delta, now):
+        """升降一档（调用方需持有self.lock）"""
+        self.level = min(max(self.level + delta, 0), len(QUALITY_LADDER) - 1)
+        self.latency = None
+        self.waiting_since = None
+        self.good_since = None
+        self.last_change = now
+
+
+class FramePipeline:
+    """视频流水线：采集 -> 编码 -> 发送，各阶段一个线程
+
+    - 采集线程按截止时间（而不是固定sleep）定时，处理耗时不会降低实际帧率；
+      落后超过一帧时从当前时间重新计时，不连续补帧
+    - 采集队列容量为1：编码跟不上时用最新的截图替换还没编码的旧截图
+    - 发送队列容量为depth：发送阻塞时编码线程等待，压力传回采集队列丢帧，
+      已编码的帧不丢弃（图块增量帧依赖前一帧）
+    - encode返回的消息加上延迟统计字段: captured_at（截取完成）、encoded_at（编码完成）、
+      capture_dropped（累计在编码前被替换掉的帧数）
+
+    Args:
+        capture: 截取一帧，返回图像
+        encode: encode(image) 返回要发送的消息，返回None表示这一帧不发送
+        send: send(message) 发送消息
+        fps: 返回当前目标帧率的函数（自动质量会在运行中调整帧率）
+        running: 返回是否继续运行的函数
+    """
+
+    POLL_INTERVAL = 0.2  # 阶段线程检查停止标志的间隔（秒）
+
+    def __init__(self, capture, encode, send, fps, running, depth=2):
+        self.capture = capture
+        self.encode = encode
+        self.send = send
+        self.fps = fps
+        self.running = running
+        self.captured = queue.Queue(maxsize=1)
+        self.encoded = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.error = None
+        self.captured_count = 0
+        self.dropped = 0  # 编码前被更新的截图替换掉的帧数
+        self.sent = 0
+
+    def active(self):
+        return not self.stopped.is_set() and self.running()
+
+    def stop(self, error=None):
+        if error is not None and self.error is None:
+            self.error = error
+        self.stopped.set()
+
+    def run(self):
+        """启动采集和编码线程，在当前线程发送，直到停止"""
+        threads = [
+            threading.Thread(target=self.stage, args=(self.capture_loop,), daemon=True),
+            threading.Thread(target=self.stage, args=(self.encode_loop,), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        self.stage(self.send_loop)
+        self.stopped.set()
+        for thread in threads:
+            thread.join()
+
+    def stage(self, loop):
+        """运行一个阶段，任一阶段出错时停止整个流水线"""
+        try:
+            loop()
+        except Exception as e:
+            self.stop(e)
+
+    def capture_loop(self):
+        deadline = time.monotonic()
+        while self.active():
+            item = (self.capture(), time.time())
+            self.captured_count += 1
+            try:
+                self.captured.put_nowait(item)
+            except queue.Full:
+                # 编码还没取走上一帧：换成最新的截图
+                try:
+                    self.captured.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                self.captured.put_nowait(item)
+
+            deadline += 1.0 / self.fps()
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            else:
+                self.stopped.wait(deadline - now)
+
+    def encode_loop(self):
+        while self.active():
+            try:
+                image, captured_at = self.captured.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            message = self.encode(image)
+            if message is None:
+                continue
+            message['captured_at'] = captured_at
+            message['encoded_at'] = time.time()
+            message['capture_dropped'] = self.dropped
+            while self.active():
+                try:
+                    self.encoded.put(message, timeout=self.POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+
+    def send_loop(self):
+        while self.active():
+            try:
+                message = self.encoded.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            self.send(message)
+            self.sent += 1